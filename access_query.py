@@ -1,5 +1,4 @@
 import argparse
-import math
 import random
 import time
 from datetime import datetime, timedelta
@@ -11,7 +10,8 @@ import requests
 import yaml
 from sqlalchemy.sql import text
 
-from modelling.open_trip_planner import parse_response, request_otp
+from modelling.open_trip_planner import OTPClient, parse_response
+from modelling.spatial import NearestNeighbours
 from app import db
 
 #REMOVE
@@ -71,11 +71,6 @@ def sample_random_time(start_interval: datetime, end_interval: datetime):
     return time_sample
 
 
-def distance(lat_a: float, lon_a: float, lat_b: float, lon_b: float) -> float:
-    dist = math.sqrt((lat_a - lat_b)**2 + (lon_a - lon_b)**2)
-    return dist
-
-
 def select_oas(oa_ids: Iterable[str]) -> Set[OA]:
     if not oa_ids:
         # If OA IDS is empty, select all of them
@@ -102,14 +97,16 @@ def generate_trips(oa_ids: Iterable[str], poi_types: Iterable[str],
                    time_interval_end: datetime,
                    num_trips: int) -> Set[Trip]:
     k = 3
-    oas = select_oas(oa_ids)
-    pois = select_pois(poi_types)
+    oas = list(select_oas(oa_ids))
+    pois = list(select_pois(poi_types))
+
+    # The k closest POIs of every OA in one query of a spatial index
+    index = NearestNeighbours([p.lat for p in pois], [p.lon for p in pois])
+    _, k_closest = index.query([oa.lat for oa in oas], [oa.lon for oa in oas], k)
 
     trips = set()
-    for oa in oas:
-        k_closest = sorted(
-            pois, key=lambda p: distance(p.lat, p.lon, oa.lat, oa.lon))[0:k]
-        for poi in k_closest:
+    for oa, closest in zip(oas, k_closest):
+        for poi in (pois[i] for i in closest):
             for t in range(num_trips):
                 random_time = sample_random_time(time_interval_start,
                                                  time_interval_end)
@@ -118,7 +115,10 @@ def generate_trips(oa_ids: Iterable[str], poi_types: Iterable[str],
     return trips
 
 
-def process_trips(host: str, trips: Set[Trip]):
+def process_trips(host: str, trips: Set[Trip], client: OTPClient = None):
+    # Reuse the caller's client (and its open connections) if there is one
+    if client is None:
+        client = OTPClient()
     results = []
 
     #REMOVE
@@ -128,7 +128,7 @@ def process_trips(host: str, trips: Set[Trip]):
     # get rid of the pb.progress bar call and
     # iterate over `trips` instead
     for trip in pb.progressbar(trips):
-        response = request_otp(host, trip.to_dict())
+        response = client.request(host, trip.to_dict())
 
         #REMOVE
         responses.append(ET.tostring(ET.fromstring(response.content)))
@@ -235,7 +235,8 @@ if __name__ == "__main__":
 
     start_time = time.time()
     # REMOVE RESPONSES
-    results, responses = process_trips(otp_url, trips)
+    with OTPClient() as client:
+        results, responses = process_trips(otp_url, trips, client)
     # REMOVE
     import csv
 
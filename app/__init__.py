@@ -1,9 +1,14 @@
 from flask import Flask
 from config import Config
 from flask_sqlalchemy import SQLAlchemy
+from app.database import set_sqlite_pragmas, sqlite_engine_options, sqlite_read_only
 
 app = Flask(__name__)
 app.config.from_object(Config)
+app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', sqlite_engine_options(app.config, app.root_path))
 db = SQLAlchemy(app)
+if sqlite_read_only(app.config):
+    with app.app_context():
+        set_sqlite_pragmas(db.engine, app.config)
 
 from app.views import *
@@ -0,0 +1,78 @@
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache:
+    """
+    Thread-safe LRU cache of serialised API responses. The data only changes when
+    upload_csv_to_sqlite.py runs, which bumps the data version stamp of the database,
+    so every entry is dropped as soon as the stamp changes.
+
+    Parameters:
+    data_version (callable): Returns the current data version stamp
+    max_entries (int): Maximum number of responses kept
+    max_bytes (int): Maximum total size in bytes of the responses kept
+    """
+
+    def __init__(self, data_version, max_entries=128, max_bytes=64 * 1024 * 1024):
+        self.data_version = data_version
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._size = 0
+        self._version = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_or_compute(self, key, compute):
+        """
+        Get the cached response for a key, or compute and cache it.
+        Responses are only cached if the data version is unchanged after computing them,
+        so a response computed while new data was being uploaded is never kept.
+
+        Parameters:
+        key (tuple): Hashable key of the response, e.g. the endpoint and its normalised arguments
+        compute (callable): Returns the response as bytes, or None if it should not be cached
+
+        Returns:
+        bytes: The response
+        """
+        version = self.data_version()
+        with self._lock:
+            if version != self._version:
+                self._clear(version)
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return body
+            self.misses += 1
+        body = compute()
+        if body is not None and len(body) <= self.max_bytes and self.data_version() == version:
+            with self._lock:
+                if version == self._version:
+                    self._put(key, body)
+        return body
+
+    def clear(self):
+        with self._lock:
+            self._clear(self._version)
+
+    def _put(self, key, body):
+        if key in self._entries:
+            self._size -= len(self._entries.pop(key))
+        self._entries[key] = body
+        self._size += len(body)
+        # Evict the least recently used responses
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            (_, evicted) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+
+    def _clear(self, version):
+        self._entries.clear()
+        self._size = 0
+        self._version = version
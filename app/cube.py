@@ -0,0 +1,234 @@
+import numpy as np
+
+SUMMARY_KEYS = ('oa_id', 'poi_type', 'stratum')
+
+
+def encode(values):
+    """
+    Integer-code a column of values in order of first appearance
+
+    Parameters:
+    values (list): Column of values. None is coded like any other value
+
+    Returns:
+    tuple: (dict of value -> code, numpy array of the code of each value)
+    """
+    codes = {}
+    encoded = np.fromiter((codes.setdefault(value, len(codes)) for value in values), dtype=np.intp, count=len(values))
+    return codes, encoded
+
+
+def selection(codes, values):
+    """
+    Boolean mask of the codes to aggregate over. As in the SQL queries,
+    an empty list of values selects every code.
+    """
+    mask = np.zeros(len(codes), dtype=bool)
+    if not values:
+        mask[:] = True
+    else:
+        for value in set(values):
+            if value in codes:
+                mask[codes[value]] = True
+    return mask
+
+
+class SummaryCubeTooLarge(Exception):
+    """Raised rather than loading a cube which would take more memory than allowed"""
+
+
+def cube_nbytes(num_oas, num_poi_types, num_strata, num_columns):
+    """
+    Memory taken by the arrays of a cube: one of float64 sums per non-key column of
+    otp_results_summary and one of int64 row counts, each with a cell per OA, POI type and stratum
+    """
+    return num_oas * num_poi_types * num_strata * (num_columns - len(SUMMARY_KEYS) + 1) * 8
+
+
+class SummaryCube:
+    """
+    In-memory copy of otp_results_summary as dense NumPy arrays indexed by integer-coded
+    OA, POI type and time stratum, so that metrics filtered by POI types and time strata
+    are masked reductions rather than SQL aggregations. Population counts are held as a
+    matrix of OA by population group, aligned with the OAs of the summary.
+
+    Every cell takes 8 bytes per array whether or not it has a row (see cube_nbytes), e.g.
+    640MB per column for 200,000 OAs, 20 POI types and 20 strata. from_database refuses to
+    load a cube larger than its max_bytes.
+
+    Parameters:
+    summary_columns (list): Column names of otp_results_summary
+    summary_rows (list): Rows of otp_results_summary
+    population_rows (list): (oa_id, population, count) rows of populations, in table order
+    """
+
+    def __init__(self, summary_columns, summary_rows, population_rows):
+        columns = list(summary_columns)
+        key_indexes = [columns.index(key) for key in SUMMARY_KEYS]
+        keys = [[row[i] for row in summary_rows] for i in key_indexes]
+        self.oa_codes, oa_index = encode(keys[0])
+        self.poi_codes, poi_index = encode(keys[1])
+        self.stratum_codes, stratum_index = encode(keys[2])
+        cells = (oa_index, poi_index, stratum_index)
+        shape = (len(self.oa_codes), len(self.poi_codes), len(self.stratum_codes))
+
+        # Number of summary rows in each cell. Cells without rows are left out of
+        # metrics, like OAs with no matching rows are left out of a GROUP BY
+        self.rows = np.zeros(shape, dtype=np.int64)
+        np.add.at(self.rows, cells, 1)
+        # num_trips and every sum column, e.g. sum_fare and sum_of_squared_fare
+        self.totals = {}
+        for i, column in enumerate(columns):
+            if i in key_indexes:
+                continue
+            values = np.array([row[i] for row in summary_rows], dtype=np.float64)
+            total = np.zeros(shape, dtype=np.float64)
+            # SQL sums skip NULLs
+            np.add.at(total, cells, np.nan_to_num(values))
+            self.totals[column] = total
+
+        self.population_codes = {}
+        population_oa_index = []
+        population_index = []
+        counts = []
+        self.oas_by_total_population = []
+        for (oa_id, population, count) in population_rows:
+            if population == 'total':
+                self.oas_by_total_population.append((oa_id, count or 0))
+            if oa_id not in self.oa_codes:
+                # OAs with a population but no summary rows never get a metric
+                continue
+            population_oa_index.append(self.oa_codes[oa_id])
+            population_index.append(self.population_codes.setdefault(population, len(self.population_codes)))
+            counts.append(count or 0)
+        # Python's sort is stable, so OAs with equal populations stay in table order
+        self.oas_by_total_population.sort(key=lambda oa: oa[1], reverse=True)
+        self.populations = np.zeros((len(self.oa_codes), len(self.population_codes)), dtype=np.float64)
+        np.add.at(self.populations, (np.array(population_oa_index, dtype=np.intp), np.array(population_index, dtype=np.intp)),
+                  np.array(counts, dtype=np.float64))
+        self.oa_ids = np.empty(len(self.oa_codes), dtype=object)
+        for oa_id, code in self.oa_codes.items():
+            self.oa_ids[code] = oa_id
+        # At-risk scores are only calculated for the 50% most populated OAs
+        half_number_of_oas = len(self.oas_by_total_population) // 2
+        self.most_populated_oas = np.array([
+            self.oa_codes[oa_id] for (oa_id, _) in self.oas_by_total_population[:half_number_of_oas + 1]
+            if oa_id in self.oa_codes
+        ], dtype=np.intp)
+
+    @classmethod
+    def from_database(cls, execute_query, max_bytes=None):
+        """
+        Load the cube using the given function to execute queries, e.g. app.utils.execute_query
+
+        Raises:
+        SummaryCubeTooLarge: If the arrays of the cube would take more than max_bytes. This is
+                             checked before any rows are fetched
+        """
+        summary = execute_query("SELECT * FROM otp_results_summary")
+        summary_columns = summary.keys()
+        if max_bytes is not None:
+            # count(DISTINCT) leaves out NULL keys, which are rare enough not to matter here
+            shape = execute_query("""SELECT count(DISTINCT oa_id), count(DISTINCT poi_type), count(DISTINCT stratum)
+                FROM otp_results_summary""").fetchone()
+            nbytes = cube_nbytes(*shape, len(summary_columns))
+            if nbytes > max_bytes:
+                summary.close()
+                raise SummaryCubeTooLarge(f'Summary cube of {nbytes} bytes is larger than the limit of {max_bytes}')
+        summary_rows = summary.fetchall()
+        population_rows = execute_query("SELECT oa_id, population, count FROM populations").fetchall()
+        return cls(summary_columns, summary_rows, population_rows)
+
+    def has_metric(self, access_metric):
+        return f'sum_{access_metric}' in self.totals
+
+    def _select(self, poi_types, time_strata):
+        return np.ix_(
+            np.ones(len(self.oa_codes), dtype=bool),
+            selection(self.poi_codes, poi_types),
+            selection(self.stratum_codes, time_strata)
+        )
+
+    def oa_totals(self, column, poi_types, time_strata):
+        """Per-OA sums of a column over the selected POI types and time strata, and the number of rows summed"""
+        cells = self._select(poi_types, time_strata)
+        return self.totals[column][cells].sum(axis=(1, 2)), self.rows[cells].sum(axis=(1, 2))
+
+    def access_metric(self, access_metric, poi_types, time_strata):
+        """
+        Per-OA mean of an accessibility metric, the equivalent of sum(sum_metric) / sum(num_trips) grouped by OA
+
+        Returns:
+        tuple: (numpy array of OA IDs, numpy array of the metric of each). OAs without selected rows are left out
+        """
+        sums, rows = self.oa_totals(f'sum_{access_metric}', poi_types, time_strata)
+        trips, _ = self.oa_totals('num_trips', poi_types, time_strata)
+        present = rows > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metric = sums[present] / trips[present]
+        return self.oa_ids[present], metric
+
+    def high_level_totals(self, access_metric, poi_types, time_strata):
+        """Sum of an accessibility metric, sum of its squares, and number of trips over the selected rows"""
+        cells = self._select(poi_types, time_strata)
+        return (
+            float(self.totals[f'sum_{access_metric}'][cells].sum()),
+            float(self.totals[f'sum_of_squared_{access_metric}'][cells].sum()),
+            float(self.totals['num_trips'][cells].sum())
+        )
+
+    def demographic_totals(self, access_metric, poi_types, time_strata):
+        """
+        Population-weighted sums of the per-OA mean of an accessibility metric
+
+        Returns:
+        dict: Keyed by population group, values of the form {'sum_d': total population, 'sum_a_d': weighted sum}
+        """
+        sums, rows = self.oa_totals(f'sum_{access_metric}', poi_types, time_strata)
+        trips, _ = self.oa_totals('num_trips', poi_types, time_strata)
+        present = (rows > 0) & (trips != 0)
+        metric = np.zeros(len(sums))
+        metric[present] = sums[present] / trips[present]
+        populations = self.populations[rows > 0]
+        sum_d = populations.sum(axis=0)
+        sum_a_d = metric[rows > 0] @ populations
+        return {
+            population: {'sum_d': float(sum_d[code]), 'sum_a_d': float(sum_a_d[code])}
+            for population, code in self.population_codes.items()
+        }
+
+    def at_risk_scores(self, demographic_group_sets, poi_types, time_strata):
+        """
+        At-risk scores of the 50% most populated OAs for several sets of demographic groups at once:
+        the generalised cost of each OA divided by its population in each set of groups.
+        The generalised cost and the population of every group are only aggregated once.
+
+        Parameters:
+        demographic_group_sets (list): List of lists of demographic groups. An empty list means all groups
+        poi_types (list): List of POI types as strings.
+        time_strata (list): List of Time Strata as strings.
+
+        Returns:
+        list: (numpy array of OA IDs, numpy array of the at-risk score of each) for each set of groups.
+              OAs with no population in the groups, or no generalised cost, are left out
+        """
+        sums, rows = self.oa_totals('sum_generalised_cost', poi_types, time_strata)
+        trips, _ = self.oa_totals('num_trips', poi_types, time_strata)
+        oas = self.most_populated_oas[rows[self.most_populated_oas] > 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            generalised_cost = sums[oas] / trips[oas]
+        # Population of each OA in each set of groups, as one matrix product
+        groups = np.zeros((len(self.population_codes), len(demographic_group_sets)), dtype=np.float64)
+        for (i, demographic_groups) in enumerate(demographic_group_sets):
+            groups[:, i] = selection(self.population_codes, demographic_groups)
+        density = self.populations[oas] @ groups
+        scores = []
+        for i in range(len(demographic_group_sets)):
+            populated = density[:, i] > 0
+            scores.append((self.oa_ids[oas[populated]], generalised_cost[populated] / density[populated, i]))
+        return scores
+
+    def population_density(self, demographic_groups):
+        """Per-OA population of the given groups, or of all groups if none are given"""
+        groups = selection(self.population_codes, demographic_groups)
+        return self.populations[:, groups].sum(axis=1)
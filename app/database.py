@@ -0,0 +1,85 @@
+import os
+import sqlite3
+from urllib.request import pathname2url
+
+from sqlalchemy.engine.url import make_url
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+
+def sqlite_pragmas(config):
+    """
+    PRAGMAs set on every connection of the read-only engine
+
+    Parameters:
+    config (dict): The Flask app config
+
+    Returns:
+    dict: PRAGMA name -> value
+    """
+    return {
+        # Reads come straight from the OS page cache rather than being copied into SQLite's own
+        'mmap_size': config['SQLITE_MMAP_SIZE'],
+        'cache_size': config['SQLITE_CACHE_SIZE'],
+        'temp_store': 'MEMORY',
+        'query_only': 'ON'
+    }
+
+
+def sqlite_read_only(config):
+    """Whether the database is a SQLite file to be opened read-only"""
+    url = make_url(config['SQLALCHEMY_DATABASE_URI'])
+    return url.drivername == 'sqlite' and url.database not in (None, '', ':memory:') and config['SQLITE_READ_ONLY']
+
+
+def sqlite_engine_options(config, root_path):
+    """
+    Engine options opening a SQLite database read-only, for the API which never writes to it.
+    Connections are kept open in a pool between requests, so their page cache, memory map and
+    prepared statements stay warm rather than every query opening the file afresh. A connection
+    is only ever used by the thread which has checked it out of the pool.
+    The database is only opened as immutable if asked to, as SQLite then assumes it never
+    changes and uploads made while the app is running would go unnoticed.
+
+    Parameters:
+    config (dict): The Flask app config
+    root_path (str): Directory that relative database paths are relative to, as for Flask-SQLAlchemy
+
+    Returns:
+    dict: Keyword arguments of create_engine, empty unless the database is a SQLite file and SQLITE_READ_ONLY is set
+    """
+    if not sqlite_read_only(config):
+        return {}
+    path = os.path.join(root_path, make_url(config['SQLALCHEMY_DATABASE_URI']).database)
+    uri = f'file:{pathname2url(path)}?mode=ro'
+    if config['SQLITE_IMMUTABLE']:
+        uri += '&immutable=1'
+
+    def connect():
+        # The pool hands each connection to one thread at a time, but not always the same thread
+        return sqlite3.connect(uri, uri=True, check_same_thread=False, cached_statements=config['SQLITE_CACHED_STATEMENTS'])
+
+    return {
+        'creator': connect,
+        'poolclass': QueuePool,
+        # Flask-SQLAlchemy replaces the pool with a NullPool unless a pool size is given
+        'pool_size': config['SQLITE_POOL_SIZE'],
+        # Threads beyond the pool size get a connection of their own, closed when they return it
+        'max_overflow': config['SQLITE_POOL_OVERFLOW']
+    }
+
+
+def set_sqlite_pragmas(engine, config):
+    """
+    Set the PRAGMAs of sqlite_pragmas on every new connection of an engine
+
+    Parameters:
+    engine (sqlalchemy.engine.Engine): The engine of the read-only database
+    config (dict): The Flask app config
+    """
+    pragmas = sqlite_pragmas(config)
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        for name, value in pragmas.items():
+            dbapi_connection.execute(f'PRAGMA {name}={value}')
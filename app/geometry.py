@@ -0,0 +1,177 @@
+import gzip
+import hashlib
+import json
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+GZIP_LEVEL = 9
+# Quality 11 takes many seconds on a large payload for a few percent more compression
+BROTLI_QUALITY = 9
+TOPOJSON_QUANTIZATION = 100000  # Grid points per axis that coordinates are snapped to
+
+
+def to_topojson(geo_json, object_name='output_areas', quantization=TOPOJSON_QUANTIZATION):
+    """
+    Convert a GeoJSON FeatureCollection of Polygons and MultiPolygons to TopoJSON, with
+    coordinates quantised to a grid and delta-encoded. Each ring becomes its own arc;
+    rings are not split into arcs shared between neighbouring polygons.
+
+    Parameters:
+    geo_json (dict): GeoJSON FeatureCollection
+    object_name (str): Name of the geometry collection in the topology's objects
+    quantization (int): Number of grid points along each axis
+
+    Returns:
+    dict: TopoJSON Topology
+    """
+    features = geo_json['features']
+    points = [
+        point
+        for feature in features
+        for polygon in polygons_of(feature['geometry'])
+        for ring in polygon
+        for point in ring
+    ]
+    x0 = min(point[0] for point in points) if points else 0.0
+    y0 = min(point[1] for point in points) if points else 0.0
+    x1 = max(point[0] for point in points) if points else 0.0
+    y1 = max(point[1] for point in points) if points else 0.0
+    kx = (x1 - x0) / (quantization - 1) or 1.0
+    ky = (y1 - y0) / (quantization - 1) or 1.0
+
+    arcs = []
+
+    def add_arc(ring):
+        arc = []
+        (px, py) = (0, 0)
+        for (x, y) in ((round((point[0] - x0) / kx), round((point[1] - y0) / ky)) for point in ring):
+            # Points which fall on the same grid point as the previous one are dropped
+            if arc and x == px and y == py:
+                continue
+            arc.append([x - px, y - py])
+            (px, py) = (x, y)
+        arcs.append(arc)
+        return len(arcs) - 1
+
+    geometries = []
+    for feature in features:
+        geometry = feature['geometry']
+        topology_geometry = {'type': geometry['type']}
+        if geometry['type'] == 'Polygon':
+            topology_geometry['arcs'] = [[add_arc(ring)] for ring in geometry['coordinates']]
+        else:
+            topology_geometry['arcs'] = [[[add_arc(ring)] for ring in polygon] for polygon in geometry['coordinates']]
+        if 'id' in feature:
+            topology_geometry['id'] = feature['id']
+        if feature.get('properties'):
+            topology_geometry['properties'] = feature['properties']
+        geometries.append(topology_geometry)
+
+    return {
+        'type': 'Topology',
+        'transform': {'scale': [kx, ky], 'translate': [x0, y0]},
+        'objects': {object_name: {'type': 'GeometryCollection', 'geometries': geometries}},
+        'arcs': arcs
+    }
+
+
+def polygons_of(geometry):
+    if geometry['type'] == 'Polygon':
+        return [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        return geometry['coordinates']
+    raise ValueError(f"Unsupported geometry type {geometry['type']}")
+
+
+class Representation:
+    """
+    A serialised variant of the geometry. Each encoding is compressed on first use and kept.
+
+    Parameters:
+    body (bytes): The uncompressed JSON
+    """
+
+    ENCODINGS = ('br', 'gzip', 'identity') if brotli is not None else ('gzip', 'identity')
+
+    def __init__(self, body):
+        digest = hashlib.sha1(body).hexdigest()
+        self._bodies = {'identity': body}
+        self._lock = threading.Lock()
+        # Each encoding is a different sequence of bytes, so needs its own strong ETag
+        self.etags = {encoding: f'{digest}-{encoding}' for encoding in self.ENCODINGS}
+
+    def body(self, encoding):
+        """Get the body in an encoding, compressing it if this is the first time it is asked for"""
+        if encoding not in self._bodies:
+            with self._lock:
+                if encoding not in self._bodies:
+                    self._bodies[encoding] = self._compress(encoding)
+        return self._bodies[encoding]
+
+    def _compress(self, encoding):
+        body = self._bodies['identity']
+        if encoding == 'br':
+            return brotli.compress(body, quality=BROTLI_QUALITY)
+        return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+    def negotiate(self, accept_encodings):
+        """
+        Choose the encoding to respond with, preferring the smallest the client accepts
+
+        Parameters:
+        accept_encodings (werkzeug.datastructures.MIMEAccept): The parsed Accept-Encoding header
+
+        Returns:
+        str: The encoding
+        """
+        for encoding in self.ENCODINGS[:-1]:
+            if accept_encodings[encoding] > 0:
+                return encoding
+        return 'identity'
+
+
+class OutputAreaGeometry:
+    """
+    The output area boundaries served by /output-areas, kept as precompressed bytes of each
+    variant: the GeoJSON itself and, if asked for, a quantised TopoJSON. A variant is built
+    the first time it is asked for, and each of its encodings the first time that is.
+    Call preload when the app starts so no client waits for the default variant, whatever
+    encodings it accepts.
+
+    Parameters:
+    path (str): Path to the GeoJSON file
+    """
+
+    FORMATS = ('geojson', 'topojson')
+    DEFAULT_FORMAT = 'geojson'
+
+    def __init__(self, path):
+        self.path = path
+        self._representations = {}
+        self._lock = threading.Lock()
+
+    def preload(self):
+        """Build the default variant in every encoding"""
+        representation = self.representation(self.DEFAULT_FORMAT)
+        for encoding in Representation.ENCODINGS:
+            representation.body(encoding)
+
+    def representation(self, variant):
+        if variant not in self._representations:
+            with self._lock:
+                if variant not in self._representations:
+                    self._representations[variant] = self._load(variant)
+        return self._representations[variant]
+
+    def _load(self, variant):
+        # The file is parsed again for each variant rather than keeping the parsed GeoJSON around
+        with open(self.path, 'r') as json_file:
+            geo_json = json.load(json_file)
+        if variant == 'topojson':
+            geo_json = to_topojson(geo_json)
+        # Serialised as jsonify would, with sorted keys and no whitespace
+        return Representation(json.dumps(geo_json, sort_keys=True, separators=(',', ':')).encode('utf-8'))
@@ -0,0 +1,99 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import has_request_context, request
+
+# Upper bounds in seconds of the buckets of latency histograms
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4'
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(label_names, label_values, extra=()):
+    labels = [f'{name}="{escape_label_value(value)}"' for (name, value) in zip(label_names, label_values)]
+    labels += [f'{name}="{value}"' for (name, value) in extra]
+    return '{' + ','.join(labels) + '}' if labels else ''
+
+
+class Histogram:
+    """
+    Thread-safe histogram of observations, e.g. latencies, rendered in the Prometheus text format.
+    There is a series of buckets for each combination of label values observed.
+
+    Parameters:
+    name (str): Name of the metric
+    description (str): Help text of the metric
+    label_names (tuple): Names of the labels each observation is made with
+    buckets (tuple): Upper bounds of the buckets, in increasing order
+    """
+
+    def __init__(self, name, description, label_names=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        # Counts are kept per bucket and made cumulative when rendered
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            series['counts'][bucket] += 1
+            series['sum'] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        """Observe the time taken by the body of a with statement"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, list(values['counts']), values['sum']) for (labels, values) in self._series.items())
+        for (label_values, counts, total) in series:
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = format_labels(self.label_names, label_values, [('le', bound)])
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+def render_counter(name, description, value):
+    """Render a counter without labels in the Prometheus text format"""
+    return f'# HELP {name} {description}\n# TYPE {name} counter\n{name} {value}\n'
+
+
+def request_endpoint():
+    """The route of the request being handled, e.g. /population-metrics, or '' outside of a request"""
+    if has_request_context() and request.url_rule is not None:
+        return request.url_rule.rule
+    return ''
+
+
+# Metrics of this process. Under mod_wsgi each daemon process has its own
+request_seconds = Histogram(
+    'tfwm_request_duration_seconds', 'Time taken to handle requests', ('endpoint', 'method', 'status')
+)
+query_seconds = Histogram(
+    'tfwm_query_duration_seconds', 'Time taken to execute SQL queries, by the endpoint they were made for', ('endpoint',)
+)
+serialisation_seconds = Histogram(
+    'tfwm_serialisation_duration_seconds', 'Time taken to serialise metrics to JSON', ('endpoint', 'layout')
+)
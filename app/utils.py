@@ -1,8 +1,20 @@
 from functools import reduce
-from app import db
+from app import app, db
+from app.cube import SummaryCube, SummaryCubeTooLarge
+from app.instrumentation import query_seconds, request_endpoint
 from sqlalchemy import exc
 from flask import jsonify
+import json
 import math
+import threading
+import time
+import numpy as np
+
+try:
+    # orjson serialises NumPy arrays directly and is much faster than the json module
+    import orjson
+except ImportError:
+    orjson = None
 
 
 def execute_query(sql_string, args=None):
@@ -20,10 +32,71 @@ def execute_query(sql_string, args=None):
     Returns:
     SQLAlchemy.engine.ResultProxy: The result of the query
     """
-    if args:
-        return db.engine.execute(sql_string, *args)
-    else:
-        return db.engine.execute(sql_string)
+    start = time.perf_counter()
+    try:
+        if args:
+            return db.engine.execute(sql_string, *args)
+        else:
+            return db.engine.execute(sql_string)
+    finally:
+        log_query(sql_string, args, time.perf_counter() - start)
+
+
+def log_query(sql_string, args, seconds):
+    """
+    Record the time taken to execute a query, and log it with its bound parameters if it took
+    at least SLOW_QUERY_SECONDS. Rows fetched after execute_query returns are not included.
+    """
+    endpoint = request_endpoint()
+    query_seconds.observe(seconds, endpoint)
+    threshold = app.config['SLOW_QUERY_SECONDS']
+    if 0 <= threshold <= seconds:
+        app.logger.warning('Slow query for %s took %.3fs: %s; parameters: %s',
+                           endpoint or 'no request', seconds, ' '.join(sql_string.split()), args or [])
+
+
+def get_data_version():
+    """
+    Get the data version stamp of the database, which upload_csv_to_sqlite.py
+    increments whenever it changes the data.
+
+    Returns:
+    int: The data version stamp
+    """
+    return execute_query('PRAGMA user_version').scalar()
+
+
+_summary_cube = {'version': None, 'cube': None}
+_summary_cube_lock = threading.Lock()
+
+
+def get_summary_cube():
+    """
+    Get the in-memory cube of otp_results_summary, (re)loading it on first use and
+    whenever the data version changes. Metrics fall back to SQL queries if the cube
+    is disabled with the SUMMARY_CUBE setting, cannot be loaded, or would be larger
+    than SUMMARY_CUBE_MAX_BYTES.
+
+    Returns:
+    SummaryCube: The cube, or None if metrics should be calculated in SQL
+    """
+    if not app.config['SUMMARY_CUBE']:
+        return None
+    try:
+        version = get_data_version()
+        with _summary_cube_lock:
+            if _summary_cube['version'] != version:
+                try:
+                    _summary_cube['cube'] = SummaryCube.from_database(execute_query, app.config['SUMMARY_CUBE_MAX_BYTES'])
+                except SummaryCubeTooLarge as err:
+                    # Not retried until the data changes
+                    app.logger.warning('%s, calculating metrics in SQL', err)
+                    _summary_cube['cube'] = None
+                _summary_cube['version'] = version
+            return _summary_cube['cube']
+    except exc.SQLAlchemyError as err:
+        print(err)
+        return None
 
 
 def get_json(db_results):
@@ -164,13 +237,15 @@ def population_density(demographic_groups):
     """
     if not demographic_groups:
         where_clause = ''
+        args = []
     else:
-        where_clause = f'WHERE population IN {construct_in_clause_args(demographic_groups)}'
+        (condition, args) = construct_filter('population', demographic_groups)
+        where_clause = f'WHERE {condition}'
     query = (f"SELECT oa_id, sum(count) AS pop_count "
             f"FROM populations {where_clause} "
             f"GROUP BY oa_id "
             f"ORDER BY pop_count DESC")
-    results = execute_query(query, demographic_groups)
+    results = execute_query(query, args)
 
     return get_metrics(results)
 
@@ -190,27 +265,73 @@ def at_risk_scores(demographics, poi_types, time_strata):
     Returns:
     dict: A dictionary keyed by OA ID, with the value being the at-risk score
     """
-    results = execute_query(
-        "SELECT oa_id FROM populations WHERE population = 'total' ORDER BY count DESC"
-    )
-    oa_ids_ordered_by_population = results.fetchall()
-    half_number_of_oas = len(oa_ids_ordered_by_population) // 2
-    density = population_density(demographics)
-    generalised_score = calculate_access_metric('generalised_cost', poi_types, time_strata)
-
-    oa_count = 0
-    at_risk_score = {}
-    for (oa_id,) in oa_ids_ordered_by_population:
-        # We only want at-risk score for the 50% most populated OAs
-        if oa_count <= half_number_of_oas:
-            if density[oa_id] > 0:
-                at_risk_score[oa_id] = generalised_score[oa_id] / density[oa_id] 
-            oa_count += 1
-        else:
-            break
+    [at_risk_score] = at_risk_scores_for_groups([demographics], poi_types, time_strata)
     return at_risk_score
 
 
+def at_risk_scores_for_groups(demographic_group_sets, poi_types, time_strata):
+    """
+    Calculate at-risk scores for several sets of demographic groups in one pass, sharing
+    the generalised access score and the ordering of OAs by population between them.
+
+    Parameters:
+    demographic_group_sets (list): List of lists of demographic groups as strings, e.g. [['white'], ['asian', 'black']].
+                                   An empty list calculates density over all groups, as in population_density
+    poi_types (list): List of POI types as strings.
+    time_strata (list): List of Time Strata as strings.
+
+    Returns:
+    list: A dictionary for each set of groups, keyed by OA ID, with the value being the at-risk score.
+          OAs with no population in the groups, or no generalised access score, are left out
+    """
+    cube = get_summary_cube()
+    if cube is not None:
+        return [
+            dict(zip(oa_ids, scores.tolist()))
+            for (oa_ids, scores) in cube.at_risk_scores(demographic_group_sets, poi_types, time_strata)
+        ]
+    return sql_at_risk_scores(demographic_group_sets, poi_types, time_strata)
+
+
+def sql_at_risk_scores(demographic_group_sets, poi_types, time_strata):
+    """
+    Calculate at-risk scores in a single SQL statement, with the cut to the 50% most
+    populated OAs applied in the database. The ordering of OAs and the generalised access
+    score are calculated once, and the population of each set of groups is a column of
+    the same aggregation. See at_risk_scores_for_groups.
+    """
+    density_columns = []
+    density_args = []
+    for (i, demographics) in enumerate(demographic_group_sets):
+        if demographics:
+            (condition, args) = construct_filter('population', demographics)
+            density_columns.append(f'sum(CASE WHEN {condition} THEN count ELSE 0 END) AS pop_{i}')
+            density_args += args
+        else:
+            density_columns.append(f'sum(count) AS pop_{i}')
+    if not density_columns:
+        return []
+    (where_clause, filter_args) = construct_access_metric_where_clause(poi_types, time_strata)
+    # Without window functions, the top 50% is a LIMIT of half the number of OAs
+    query = (f"SELECT top.oa_id, access.generalised_cost, density.* "
+             f"FROM (SELECT oa_id, count FROM populations WHERE population = 'total' "
+             f"      ORDER BY count DESC "
+             f"      LIMIT (SELECT count(*) / 2 + 1 FROM populations WHERE population = 'total')) AS top "
+             f"JOIN (SELECT oa_id AS density_oa_id, {', '.join(density_columns)} FROM populations "
+             f"      GROUP BY oa_id) AS density ON density.density_oa_id = top.oa_id "
+             f"JOIN (SELECT oa_id, sum(sum_generalised_cost) / sum(num_trips) AS generalised_cost "
+             f"      FROM otp_results_summary {where_clause} "
+             f"      GROUP BY oa_id) AS access ON access.oa_id = top.oa_id "
+             f"ORDER BY top.count DESC")
+    results = execute_query(query, density_args + filter_args).fetchall()
+    at_risk_scores = [{} for _ in demographic_group_sets]
+    for (oa_id, generalised_cost, _, *densities) in results:
+        for (at_risk_score, density) in zip(at_risk_scores, densities):
+            if density > 0:
+                at_risk_score[oa_id] = None if generalised_cost is None else generalised_cost / density
+    return at_risk_scores
+
+
 def construct_access_metric_where_clause(poi_types, time_strata):
     """
     Construct a WHERE clause for use querying the otp_results_summary table
@@ -221,24 +342,62 @@ def construct_access_metric_where_clause(poi_types, time_strata):
     time_strata (list): List of Time Strata as strings.
 
     Returns:
-    str: a string containing a where clause to be used in a otp_results_summary query
+    tuple: (str, list) a where clause to be used in a otp_results_summary query, and its bind arguments
     """
     where_clause = ''
+    args = []
     if poi_types or time_strata:
         where_clause = 'WHERE '
         poi_str = ''
         strata_str = ''
         if poi_types:
-            poi_str = 'poi_type IN ' + construct_in_clause_args(poi_types)
+            (poi_str, poi_args) = construct_filter('poi_type', poi_types)
+            args += poi_args
         if time_strata:
-            strata_str = 'stratum IN ' + construct_in_clause_args(time_strata)
+            (strata_str, strata_args) = construct_filter('stratum', time_strata)
+            args += strata_args
 
         if poi_str and strata_str:
             where_clause += f'{poi_str} AND {strata_str}'
         else:
             where_clause += poi_str + strata_str
 
-    return where_clause
+    return where_clause, args
+
+
+def construct_filter(column, values):
+    """
+    Construct a condition that a column is one of the given values. Where the database has
+    SQLite's json_each, the values are bound as a single JSON array so that the statement text
+    is the same whatever the number of values, and its prepared statement is reused.
+    Otherwise there is a bind parameter per value, see construct_in_clause_args.
+
+    Parameters:
+    column (str): Name of the column
+    values (list): Values of the column to keep
+
+    Returns:
+    tuple: (str, list) the condition, and its bind arguments
+    """
+    if json_filters_supported():
+        return f'{column} IN (SELECT value FROM json_each(?))', [json.dumps(values)]
+    return f'{column} IN {construct_in_clause_args(values)}', list(values)
+
+
+_json_filters = {}
+
+
+def json_filters_supported():
+    """Whether filters can be bound as JSON arrays, i.e. the database is SQLite built with JSON1"""
+    if 'supported' not in _json_filters:
+        supported = db.engine.dialect.name == 'sqlite'
+        if supported:
+            try:
+                execute_query("SELECT count(*) FROM json_each('[]')")
+            except exc.SQLAlchemyError:
+                supported = False
+        _json_filters['supported'] = supported
+    return _json_filters['supported']
 
 
 def calculate_access_metric(access_metric, poi_types, time_strata):
@@ -255,11 +414,18 @@ def calculate_access_metric(access_metric, poi_types, time_strata):
     dict: A dictionary keyed by OA ID, with the value being the accessibility metric.
           Will return 404 if the access metric supplied doesn't exist in the database
     """
-    where_clause = construct_access_metric_where_clause(poi_types, time_strata)
+    cube = get_summary_cube()
+    if cube is not None:
+        if not cube.has_metric(access_metric):
+            return {'error': 'Not found'}
+        oa_ids, metrics = cube.access_metric(access_metric, poi_types, time_strata)
+        # Like SQL, dividing by zero trips gives NULL
+        return {oa_id: (metric if math.isfinite(metric) else None) for (oa_id, metric) in zip(oa_ids, metrics.tolist())}
+
+    (where_clause, args) = construct_access_metric_where_clause(poi_types, time_strata)
 
     query = (f"SELECT oa_id, sum(sum_{access_metric}) / sum(num_trips) "
              f"FROM otp_results_summary {where_clause} GROUP BY oa_id")
-    args = poi_types + time_strata
 
     try:
         results = execute_query(query, args)
@@ -270,6 +436,34 @@ def calculate_access_metric(access_metric, poi_types, time_strata):
     return get_metrics(results)
 
 
+def calculate_access_metric_columns(access_metric, poi_types, time_strata):
+    """
+    Calculate an accessibility metric for OAs as parallel arrays rather than a dict,
+    see calculate_access_metric.
+
+    Parameters:
+    access_metric (str): The accessibility metric to calculate.
+    poi_types (list): List of POI types as strings.
+    time_strata (list): List of Time Strata as strings.
+
+    Returns:
+    tuple: (list of OA IDs, numpy array of the metric of each OA), or None if the access metric
+           supplied doesn't exist in the database. Metrics which are NULL in SQL are NaN
+    """
+    cube = get_summary_cube()
+    if cube is not None:
+        if not cube.has_metric(access_metric):
+            return None
+        oa_ids, metrics = cube.access_metric(access_metric, poi_types, time_strata)
+        metrics[~np.isfinite(metrics)] = np.nan
+        return oa_ids.tolist(), metrics
+
+    metrics = calculate_access_metric(access_metric, poi_types, time_strata)
+    if 'error' in metrics:
+        return None
+    return list(metrics), np.array(list(metrics.values()), dtype=np.float64)
+
+
 def calculate_high_level_metrics(access_metric, poi_types, time_strata):
     """
     Calculate a high level accessibility metric (journey time, walking distance, fare, generalised access score)
@@ -284,8 +478,15 @@ def calculate_high_level_metrics(access_metric, poi_types, time_strata):
     dict: A dictionary keyed by metric type, with the value being the value of the metric.
           Will return a dict with the key 'error' if the access metric supplied doesn't exist in the database
     """
-    where_clause = construct_access_metric_where_clause(poi_types, time_strata)
-    args = poi_types + time_strata
+    cube = get_summary_cube()
+    if cube is not None:
+        try:
+            (summation_a, summation_of_squared_a, n) = cube.high_level_totals(access_metric, poi_types, time_strata)
+        except KeyError as err:
+            return {'error': f"High level metric calculation error: no column {err}"}
+        return high_level_metrics({'summation_a': summation_a, 'summation_of_squared_a': summation_of_squared_a, 'n': n})
+
+    (where_clause, args) = construct_access_metric_where_clause(poi_types, time_strata)
 
     try:
         query = (f"SELECT sum(sum_{access_metric}) as summation_a, \
@@ -293,18 +494,25 @@ def calculate_high_level_metrics(access_metric, poi_types, time_strata):
                    sum(num_trips) as n \
                    FROM otp_results_summary {where_clause}")
         i_vals = get_metric_with_fields(execute_query(query, args))  # (i_vals = intermediate values)
-
-        mean = i_vals['summation_a'] / i_vals['n']
-        return {
-            'Mean': round(mean, 2),
-            'Variance': round(math.sqrt((i_vals['summation_of_squared_a'] - 2 * mean * i_vals['summation_a'] + i_vals['n'] * (mean ** 2)) / (i_vals['n'] - 1)), 2),
-            'Jains Index': round((i_vals['summation_a'] ** 2) / (i_vals['n'] * i_vals['summation_of_squared_a']), 3)
-        }
+        return high_level_metrics(i_vals)
     except exc.SQLAlchemyError as err:
         print(err)
         return {'error': f"High level metric calculation error: {err}"}
 
 
+def high_level_metrics(i_vals):
+    """
+    Calculate the high level metrics from the sum of a metric, the sum of its squares
+    and the number of trips, keyed 'summation_a', 'summation_of_squared_a' and 'n'
+    """
+    mean = i_vals['summation_a'] / i_vals['n']
+    return {
+        'Mean': round(mean, 2),
+        'Variance': round(math.sqrt((i_vals['summation_of_squared_a'] - 2 * mean * i_vals['summation_a'] + i_vals['n'] * (mean ** 2)) / (i_vals['n'] - 1)), 2),
+        'Jains Index': round((i_vals['summation_a'] ** 2) / (i_vals['n'] * i_vals['summation_of_squared_a']), 3)
+    }
+
+
 def calculate_demographic_level_metrics(access_metric, poi_types, time_strata):
     """
     Calculate a demographic level accessibility metrics (journey time, walking distance, fare, generalised access score)
@@ -319,8 +527,13 @@ def calculate_demographic_level_metrics(access_metric, poi_types, time_strata):
     dict: A dictionary keyed by demographic, with the value being a dictionary of metrics.
           Will return a dict with the key 'error' if an error occurs in the calculation
     """
-    where_clause = construct_access_metric_where_clause(poi_types, time_strata)
-    args = poi_types + time_strata
+    cube = get_summary_cube()
+    if cube is not None:
+        if not cube.has_metric(access_metric):
+            return {'error': f"High level metric calculation error: no column sum_{access_metric}"}
+        return demographic_level_metrics(cube.demographic_totals(access_metric, poi_types, time_strata))
+
+    (where_clause, args) = construct_access_metric_where_clause(poi_types, time_strata)
 
     try:
         query = f"SELECT populations.population, \
@@ -349,26 +562,33 @@ def calculate_demographic_level_metrics(access_metric, poi_types, time_strata):
             } 
             for fields in db_results
         }
-
-        for demographic in result:
-            i_vals = result[demographic]  # (i_vals = intermediate values)
-            result[demographic] = {
-                'WASS': round(i_vals['sum_a_d'] / i_vals['sum_d'], 2),
-                # TODO: This was giving too low values - is 'n' being counted correctly?
-                # 'JI': round((i_vals['sum_a_d'] ** 2) / (i_vals['n'] * i_vals['sum_of_squared_a_d']), 3)
-            }
-
-        mean = result['total']['WASS']
-        del result['total']
-        for demographic in result:
-            result[demographic]['ARM'] = round(result[demographic]['WASS'] - mean, 2)
-
-        return result
+        return demographic_level_metrics(result)
     except exc.SQLAlchemyError as err:
         print(err)
         return {'error': f"High level metric calculation error: {err}"}
 
 
+def demographic_level_metrics(result):
+    """
+    Calculate the metrics of each demographic from its total population and population-weighted
+    sum of the metric, keyed 'sum_d' and 'sum_a_d'. Requires the 'total' demographic.
+    """
+    for demographic in result:
+        i_vals = result[demographic]  # (i_vals = intermediate values)
+        result[demographic] = {
+            'WASS': round(i_vals['sum_a_d'] / i_vals['sum_d'], 2),
+            # TODO: This was giving too low values - is 'n' being counted correctly?
+            # 'JI': round((i_vals['sum_a_d'] ** 2) / (i_vals['n'] * i_vals['sum_of_squared_a_d']), 3)
+        }
+
+    mean = result['total']['WASS']
+    del result['total']
+    for demographic in result:
+        result[demographic]['ARM'] = round(result[demographic]['WASS'] - mean, 2)
+
+    return result
+
+
 def construct_in_clause_args(args):
     """
     Produce a string containing bind parameters ('?') to be used in a `WHERE column IN ()` clause.
@@ -452,6 +672,45 @@ def add_rank(metrics):
     return metrics
 
 
+def rank_columns(oa_ids, metrics):
+    """
+    Rank OA metrics by metric value, as add_rank does, but returning parallel arrays
+    rather than a dict per OA. OAs with equal metrics are ranked in input order and
+    OAs without a metric (NaN) are ranked last.
+
+    Parameters:
+    oa_ids (list): OA IDs
+    metrics (list): The metric of each OA, in the same order as oa_ids
+
+    Returns:
+    dict: A dictionary of the form {'oa_id': [...], 'metric': [...], 'rank': [...]}
+    """
+    metrics = np.asarray(metrics, dtype=np.float64)
+    ranks = np.empty(len(metrics), dtype=np.int64)
+    ranks[np.argsort(metrics, kind='stable')] = np.arange(1, len(metrics) + 1)
+    return {'oa_id': list(oa_ids), 'metric': metrics, 'rank': ranks}
+
+
+def dumps_columnar(obj):
+    """
+    Serialise a response which may contain NumPy arrays to JSON, using orjson if it is installed.
+    NaNs are serialised as null.
+
+    Returns:
+    bytes: The JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+
+    def default(value):
+        if isinstance(value, np.ndarray):
+            return [None if item != item else item for item in value.tolist()]
+        if isinstance(value, np.generic):
+            return value.item()
+        raise TypeError(f'{type(value)} is not JSON serializable')
+    return json.dumps(obj, default=default, separators=(',', ':')).encode('utf-8')
+
+
 def sort_by_value(input_dict, reverse=False):
     """
     Sort a dictionary by returning an iterator of
@@ -1,21 +1,135 @@
 import os
 import json
 import re
+import time
 from app import app
-from flask import abort, jsonify, request, make_response
+from flask import abort, jsonify, request, make_response, g
+from app.cache import ResponseCache
+from app.geometry import OutputAreaGeometry
+from app.instrumentation import (
+    PROMETHEUS_MIMETYPE,
+    query_seconds,
+    render_counter,
+    request_endpoint,
+    request_seconds,
+    serialisation_seconds
+)
 from app.utils import (
     execute_query, 
+    get_data_version, 
     get_key_value_pairs, 
     remove_common_prefix, 
     calculate_access_metric, 
+    calculate_access_metric_columns, 
     calculate_high_level_metrics, 
     calculate_demographic_level_metrics,
     population_density, 
     at_risk_scores, 
+    at_risk_scores_for_groups,
     get_json, 
-    add_rank
+    add_rank,
+    rank_columns,
+    dumps_columnar
 )
 
+# Media type of responses with OA-level metrics as parallel arrays rather than an object per OA
+COLUMNAR_MIMETYPE = 'application/vnd.tfwm.columnar+json'
+
+# Most queries accepted by one /batch request
+MAX_BATCH_QUERIES = 100
+# Query parameters of /batch queries taking a list of values
+BATCH_FILTERS = ('demographic-group', 'point-of-interest-types', 'time-strata')
+# Query parameters of /batch queries taking a single value
+BATCH_PARAMETERS = ('endpoint', 'accessibility-metric', 'population-metric', 'format')
+BATCH_NOT_FOUND = json.dumps({'error': 'Not found'}).encode('utf-8')
+
+# Using a relative path e.g ./geo_simp.json results in an empty file
+output_areas = OutputAreaGeometry(os.path.join(os.path.dirname(__file__), 'geo_simp.json'))
+# Built now rather than on the first request. Without the file, /output-areas fails as it always has.
+if os.path.isfile(output_areas.path):
+    output_areas.preload()
+
+# Metrics only change when new data is uploaded, so responses are reused until then
+response_cache = ResponseCache(
+    get_data_version,
+    max_entries=app.config['RESPONSE_CACHE_ENTRIES'],
+    max_bytes=app.config['RESPONSE_CACHE_MAX_BYTES']
+)
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_time(response):
+    if 'request_start' in g:
+        request_seconds.observe(
+            time.perf_counter() - g.request_start, request_endpoint(), request.method, str(response.status_code)
+        )
+    return response
+
+
+def json_response(body):
+    """Return a response with a body of already serialised JSON"""
+    return app.response_class(body, mimetype='application/json')
+
+
+def response_layout():
+    """
+    Get the layout of OA-level metrics asked for, either with the format query parameter
+    or by preferring the columnar media type in the Accept header
+
+    Returns:
+    str: 'columnar', 'json', or None if the format is unknown
+    """
+    layout = request.args.get('format')
+    if layout is None:
+        return 'columnar' if request.accept_mimetypes.best == COLUMNAR_MIMETYPE else 'json'
+    return layout if layout in ('json', 'columnar') else None
+
+
+def filter_args(name):
+    """Get the values of a filter query parameter in a canonical order, so equivalent requests share a cache entry"""
+    return sorted(set(request.args.getlist(name)))
+
+
+def filter_values(query, name):
+    """Get the values of a filter of a /batch query in the same canonical order as filter_args"""
+    values = query.get(name, [])
+    if isinstance(values, str):
+        values = [values]
+    return sorted(set(values))
+
+
+def valid_batch_query(query):
+    """
+    Check a /batch query is an object whose parameters are strings, and whose filters are each
+    a string or a list of strings
+    """
+    if not isinstance(query, dict):
+        return False
+    if not all(isinstance(query.get(name, ''), str) for name in BATCH_PARAMETERS):
+        return False
+    for name in BATCH_FILTERS:
+        values = query.get(name, [])
+        if not isinstance(values, str) and \
+                not (isinstance(values, list) and all(isinstance(value, str) for value in values)):
+            return False
+    return True
+
+
+def batch_endpoint(query):
+    """Get the endpoint a /batch query is for, without slashes"""
+    return query.get('endpoint', '').strip('/')
+
+
+def batch_layout(query):
+    """Get the layout of OA-level metrics asked for by a /batch query, or None if the format is unknown"""
+    layout = query.get('format', 'json')
+    return layout if layout in ('json', 'columnar') else None
+
 
 @app.route("/meta/accessibility-metric")
 def get_accessibility_metric():
@@ -30,6 +144,19 @@ def get_accessibility_metric():
         return make_response(jsonify({'error': 'Not found'}), 404)
 
 
+@app.route("/meta/metrics")
+def get_instrumentation():
+    """Latencies of requests, SQL queries and serialisation, and response cache statistics, for Prometheus"""
+    body = ''.join([
+        request_seconds.render(),
+        query_seconds.render(),
+        serialisation_seconds.render(),
+        render_counter('tfwm_response_cache_hits_total', 'Responses served from the response cache', response_cache.hits),
+        render_counter('tfwm_response_cache_misses_total', 'Responses not in the response cache', response_cache.misses)
+    ])
+    return app.response_class(body, mimetype=PROMETHEUS_MIMETYPE)
+
+
 @app.route("/meta/time-strata")
 def get_time_strata():
     results = execute_query("SELECT DISTINCT stratum FROM otp_results_summary")
@@ -56,43 +183,195 @@ def get_demographic():
 
 @app.route("/output-areas")
 def get_output_areas():
-    # Using a relative path e.g ./geo_simp.json results in an empty file
-    file_dir = os.path.dirname(__file__)
-    with open(os.path.join(file_dir, 'geo_simp.json'), 'r') as json_file:
-        return jsonify(json.load(json_file))
+    variant = request.args.get('format', 'geojson')
+    if variant not in OutputAreaGeometry.FORMATS:
+        return make_response(jsonify({'error': 'Not found'}), 404)
+    representation = output_areas.representation(variant)
+    encoding = representation.negotiate(request.accept_encodings)
+    etag = representation.etags[encoding]
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+    else:
+        response = make_response(representation.body(encoding))
+        response.mimetype = 'application/json'
+        if encoding != 'identity':
+            response.headers['Content-Encoding'] = encoding
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    # Clients may keep the payload, but must check it is current with If-None-Match
+    response.cache_control.no_cache = True
+    return response
 
 
 @app.route("/population-metrics", methods=['GET'])
 def population_metrics():
-    metric = request.args.get('population-metric', 'population_density')
-    demographic_groups = request.args.getlist('demographic-group')
-    if metric == 'population_density':
-        density = population_density(demographic_groups)
-        return jsonify(add_rank(density))
-    elif metric == 'at-risk_score':
-        poi_types = request.args.getlist('point-of-interest-types')
-        time_strata = request.args.getlist('time-strata')
-        at_risk_score = at_risk_scores(demographic_groups, poi_types, time_strata)
-        return jsonify(add_rank(at_risk_score))
-    else:
+    body = get_population_metrics(
+        request.args.get('population-metric', 'population_density'),
+        filter_args('demographic-group'),
+        filter_args('point-of-interest-types'),
+        filter_args('time-strata'),
+        response_layout()
+    )
+    if body is None:
         return make_response(jsonify({'error': 'Not found'}), 404)
+    return json_response(body)
+
+
+def get_population_metrics(metric, demographic_groups, poi_types, time_strata, layout, scores=at_risk_scores):
+    """
+    Get the serialised response of a population metric, from the response cache if it is there
+
+    Parameters:
+    metric (str): 'population_density' or 'at-risk_score'
+    demographic_groups (list): List of demographic groups as strings.
+    poi_types (list): List of POI types as strings. Only used by at-risk scores
+    time_strata (list): List of Time Strata as strings. Only used by at-risk scores
+    layout (str): 'json' or 'columnar'
+    scores (callable): Calculates at-risk scores, with the arguments of at_risk_scores
+
+    Returns:
+    bytes: The response, or None if the metric or layout is unknown
+    """
+    if metric == 'population_density' and layout:
+        key = (metric, layout, tuple(demographic_groups))
+        return response_cache.get_or_compute(
+            key, lambda: serialise_oa_metrics(population_density(demographic_groups), layout)
+        )
+    elif metric == 'at-risk_score' and layout:
+        key = (metric, layout, tuple(demographic_groups), tuple(poi_types), tuple(time_strata))
+        return response_cache.get_or_compute(
+            key, lambda: serialise_oa_metrics(scores(demographic_groups, poi_types, time_strata), layout)
+        )
+    return None
+
+
+def serialise_oa_metrics(metrics, layout):
+    """Serialise a dict of OA-level metrics with their ranks, in the given layout"""
+    with serialisation_seconds.time(request_endpoint(), layout):
+        if layout == 'columnar':
+            return dumps_columnar(rank_columns(list(metrics), list(metrics.values())))
+        return jsonify(add_rank(metrics)).get_data()
 
 
 @app.route("/accessibility-metrics", methods=['GET'])
 def accessibility_metrics():
     access_metric = request.args.get('accessibility-metric', 'generalised_cost')
-    poi_types = request.args.getlist('point-of-interest-types')
-    time_strata = request.args.getlist('time-strata')
+    poi_types = filter_args('point-of-interest-types')
+    time_strata = filter_args('time-strata')
+    layout = response_layout()
+    if layout is None:
+        return abort(404)
+    body = get_cached_accessibility_metrics(access_metric, poi_types, time_strata, layout)
+    if body is None:
+        return abort(404)
+    return json_response(body)
+
 
-    access_metrics = calculate_access_metric(access_metric, poi_types, time_strata)
+def get_cached_accessibility_metrics(access_metric, poi_types, time_strata, layout):
+    """Get the serialised response of an accessibility metric, from the response cache if it is there"""
+    key = ('accessibility-metrics', layout, access_metric, tuple(poi_types), tuple(time_strata))
+    return response_cache.get_or_compute(
+        key, lambda: get_accessibility_metrics(access_metric, poi_types, time_strata, layout)
+    )
+
+
+def get_accessibility_metrics(access_metric, poi_types, time_strata, layout='json'):
+    if layout == 'columnar':
+        access_metrics = calculate_access_metric_columns(access_metric, poi_types, time_strata)
+        metric_found = access_metrics is not None
+    else:
+        access_metrics = calculate_access_metric(access_metric, poi_types, time_strata)
+        metric_found = 'error' not in access_metrics
     high_level_metrics = calculate_high_level_metrics(access_metric, poi_types, time_strata)
     demographic_level_metrics = calculate_demographic_level_metrics(access_metric, poi_types, time_strata)
 
-    if 'error' in access_metrics or 'error' in high_level_metrics:
-        return abort(404)
+    if not metric_found or 'error' in high_level_metrics:
+        return None
+
+    with serialisation_seconds.time(request_endpoint(), layout):
+        if layout == 'columnar':
+            return dumps_columnar({
+                'high-level': high_level_metrics,
+                'oa-level': rank_columns(*access_metrics),
+                'demographic-level': demographic_level_metrics,
+            })
+
+        return jsonify({
+            'high-level': high_level_metrics,
+            'oa-level': add_rank(access_metrics),
+            'demographic-level': demographic_level_metrics,
+        }).get_data()
+
+
+@app.route("/batch", methods=['POST'])
+def batch():
+    """
+    Evaluate a list of /accessibility-metrics and /population-metrics queries in one request.
+    The body is a JSON list of queries, each an object of the endpoint and its query parameters, e.g.
+    [{"endpoint": "population-metrics", "population-metric": "at-risk_score", "demographic-group": ["white"]}].
+    Responds with {"results": [...]} holding the response to each query in order, or {"error": "Not found"}
+    for a query which would get a 404 on its own.
+    """
+    queries = request.get_json(silent=True)
+    if not isinstance(queries, list) or len(queries) > MAX_BATCH_QUERIES or \
+            not all(valid_batch_query(query) for query in queries):
+        return make_response(jsonify({'error': 'Bad request'}), 400)
+
+    scores = shared_at_risk_scores(queries)
+    bodies = []
+    for query in queries:
+        endpoint = batch_endpoint(query)
+        layout = batch_layout(query)
+        body = None
+        if endpoint == 'accessibility-metrics' and layout:
+            body = get_cached_accessibility_metrics(
+                query.get('accessibility-metric', 'generalised_cost'),
+                filter_values(query, 'point-of-interest-types'),
+                filter_values(query, 'time-strata'),
+                layout
+            )
+        elif endpoint == 'population-metrics':
+            body = get_population_metrics(
+                query.get('population-metric', 'population_density'),
+                filter_values(query, 'demographic-group'),
+                filter_values(query, 'point-of-interest-types'),
+                filter_values(query, 'time-strata'),
+                layout,
+                scores
+            )
+        bodies.append(BATCH_NOT_FOUND if body is None else body)
+    # The responses are already serialised, so are spliced into the result rather than parsed again
+    return json_response(b'{"results":[' + b','.join(bodies) + b']}')
+
+
+def shared_at_risk_scores(queries):
+    """
+    Get a replacement for at_risk_scores which, on its first call for some POI types and time strata,
+    calculates the at-risk scores of every demographic group asked for with them by the batch of queries at once
+
+    Parameters:
+    queries (list): /batch queries
+
+    Returns:
+    callable: Calculates at-risk scores, with the arguments of at_risk_scores
+    """
+    group_sets = {}
+    for query in queries:
+        # Only queries which will be answered with at-risk scores
+        if batch_endpoint(query) == 'population-metrics' and batch_layout(query) and \
+                query.get('population-metric') == 'at-risk_score':
+            filters = (tuple(filter_values(query, 'point-of-interest-types')), tuple(filter_values(query, 'time-strata')))
+            demographic_groups = tuple(filter_values(query, 'demographic-group'))
+            if demographic_groups not in group_sets.setdefault(filters, []):
+                group_sets[filters].append(demographic_groups)
+    calculated = {}
 
-    return jsonify({
-        'high-level': high_level_metrics,
-        'oa-level': add_rank(access_metrics),
-        'demographic-level': demographic_level_metrics,
-    })
+    def scores(demographic_groups, poi_types, time_strata):
+        filters = (tuple(poi_types), tuple(time_strata))
+        if filters not in calculated:
+            demographic_group_sets = group_sets[filters]
+            calculated[filters] = dict(zip(demographic_group_sets, at_risk_scores_for_groups(
+                [list(groups) for groups in demographic_group_sets], poi_types, time_strata
+            )))
+        return calculated[filters][tuple(demographic_groups)]
+    return scores
@@ -0,0 +1,317 @@
+'''
+Benchmark of the Flask API against a synthetic database at a configurable scale.
+
+Generate a SQLite database with the schema of sql/sqlite/schema.sql and random results,
+then drive every route through the Flask test client and report latency percentiles and
+throughput, optionally comparing them with an earlier run:
+
+    $ python -m benchmark.api generate /tmp/bench.db --oas 50000 --poi-types 20 --strata 20
+    $ python -m benchmark.api run /tmp/bench.db -n 50 --output results/api-baseline.json
+    $ python -m benchmark.api run /tmp/bench.db -n 50 --compare results/api-baseline.json
+
+By default the response cache is cleared before every request, so each one is calculated
+in full. The first requests of the run, which load the summary cube and the output area
+boundaries, are timed separately.
+'''
+import argparse
+import datetime
+import itertools
+import json
+import math
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'sql', 'sqlite', 'schema.sql')
+ACCESS_METRICS = ('journey_time', 'walking_distance', 'fare', 'generalised_cost')
+DEMOGRAPHIC_GROUPS = ('white', 'asian', 'black', 'elderly', 'disabled')
+DEFAULT_NUM_OAS = 10000
+DEFAULT_NUM_POI_TYPES = 20
+DEFAULT_NUM_STRATA = 20
+DEFAULT_NUM_REQUESTS = 20
+INSERT_CHUNK_SIZE = 100000
+# Change in latency reported as a regression or improvement when comparing runs
+COMPARISON_THRESHOLD = 0.1
+
+
+def parse_input_args() -> dict:
+    '''Parse the input arguments and return a dict keyed by arg names'''
+    parser = argparse.ArgumentParser(description='Benchmark the API against a synthetic database')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    generate = commands.add_parser('generate', help='Generate a synthetic SQLite database')
+    generate.add_argument('database', type=str, help='Path of the database to create. An existing file is replaced')
+    generate.add_argument('--oas', type=int, default=DEFAULT_NUM_OAS,
+                          help=f'Number of output areas. Default: {DEFAULT_NUM_OAS}')
+    generate.add_argument('--poi-types', metavar='poi_types', type=int, default=DEFAULT_NUM_POI_TYPES,
+                          help=f'Number of POI types. Default: {DEFAULT_NUM_POI_TYPES}')
+    generate.add_argument('--strata', type=int, default=DEFAULT_NUM_STRATA,
+                          help=f'Number of time strata. Default: {DEFAULT_NUM_STRATA}')
+    generate.add_argument('--seed', type=int, default=0, help='Seed of the random results. Default: 0')
+    run = commands.add_parser('run', help='Time every route of the API against a database')
+    run.add_argument('database', type=str, help='Path of a database made by the generate command')
+    run.add_argument('-n', '--requests', type=int, default=DEFAULT_NUM_REQUESTS,
+                     help=f'Number of requests timed per route. Default: {DEFAULT_NUM_REQUESTS}')
+    run.add_argument('-t', '--threads', type=int, default=1,
+                     help='Number of threads sending requests at once. Default: 1')
+    run.add_argument('--warm-cache', action='store_true',
+                     help='Keep the response cache between requests rather than clearing it before each')
+    run.add_argument('--seed', type=int, default=0, help='Seed of the random query parameters. Default: 0')
+    run.add_argument('-o', '--output', type=str, help='Path of a JSON file the results are saved to')
+    run.add_argument('-c', '--compare', type=str, help='Path of the saved results of an earlier run to compare with')
+    args = parser.parse_args()
+    return vars(args)
+
+
+def geometry_path(database: str) -> str:
+    '''Path of the synthetic output area boundaries generated alongside a database'''
+    return database + '.geojson'
+
+
+def generate_database(path: str, num_oas: int, num_poi_types: int, num_strata: int, seed: int) -> None:
+    rng = np.random.RandomState(seed)
+    oa_ids = [f'E{i:08d}' for i in range(num_oas)]
+    poi_types = [f'POI_Type_{i:02d}' for i in range(num_poi_types)]
+    strata = [f'Stratum_{i:02d}' for i in range(num_strata)]
+    if os.path.exists(path):
+        os.remove(path)
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        conn.execute("PRAGMA journal_mode=OFF")
+        conn.execute("PRAGMA synchronous=OFF")
+        with open(SCHEMA_FILE) as schema:
+            conn.executescript(schema.read())
+        # The API's high-level metrics also need the sums of squares, which schema.sql leaves out
+        for metric in ACCESS_METRICS:
+            conn.execute(f"ALTER TABLE otp_results_summary ADD COLUMN sum_of_squared_{metric}")
+        conn.execute("BEGIN")
+        conn.executemany("INSERT INTO poi (poi_id, type) VALUES (?, ?)", enumerate(poi_types))
+        populations = rng.randint(0, 200, size=(num_oas, len(DEMOGRAPHIC_GROUPS)))
+        conn.executemany("INSERT INTO populations (oa_id, population, count) VALUES (?, ?, ?)", itertools.chain(
+            ((oa_id, 'total', int(counts.sum())) for (oa_id, counts) in zip(oa_ids, populations)),
+            ((oa_id, group, int(count)) for (oa_id, counts) in zip(oa_ids, populations)
+             for (group, count) in zip(DEMOGRAPHIC_GROUPS, counts))
+        ))
+        keys = ((oa_id, poi_type, stratum) for oa_id in oa_ids for poi_type in poi_types for stratum in strata)
+        columns = ['oa_id', 'poi_type', 'stratum', 'num_trips']
+        columns += [f'sum_{metric}' for metric in ACCESS_METRICS]
+        columns += [f'sum_of_squared_{metric}' for metric in ACCESS_METRICS]
+        insert = f"INSERT INTO otp_results_summary ({', '.join(columns)}) VALUES ({', '.join('?' for _ in columns)})"
+        # Mean journey time (s), walking distance (m), fare (£) and generalised cost of the trips in each cell
+        scales = np.array([3000.0, 800.0, 2.5, 80.0])
+        for chunk in iter(lambda: list(itertools.islice(keys, INSERT_CHUNK_SIZE)), []):
+            num_trips = rng.randint(1, 6, size=len(chunk))
+            means = scales * rng.lognormal(0.0, 0.4, size=(len(chunk), len(scales)))
+            sums = means * num_trips[:, None]
+            squares = sums * means * 1.1
+            conn.executemany(insert, (
+                key + (int(trips),) + tuple(totals) + tuple(squared)
+                for (key, trips, totals, squared) in zip(chunk, num_trips, sums.tolist(), squares.tolist())
+            ))
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    write_geometry(geometry_path(path), oa_ids)
+    print(f'Generated {path} with {num_oas} OAs, {num_poi_types} POI types and {num_strata} time strata '
+          f'({num_oas * num_poi_types * num_strata} summary rows)')
+
+
+def write_geometry(path: str, oa_ids: list) -> None:
+    '''Write square output areas in a grid over the West Midlands as GeoJSON'''
+    columns = math.ceil(math.sqrt(len(oa_ids)))
+    size = 0.5 / columns
+    features = []
+    for (i, oa_id) in enumerate(oa_ids):
+        (x, y) = (-2.2 + (i % columns) * size, 52.3 + (i // columns) * size)
+        ring = [[x, y], [x + size, y], [x + size, y + size], [x, y + size], [x, y]]
+        features.append({'type': 'Feature', 'id': oa_id, 'properties': {},
+                         'geometry': {'type': 'Polygon', 'coordinates': [ring]}})
+    with open(path, 'w') as dst:
+        json.dump({'type': 'FeatureCollection', 'features': features}, dst)
+
+
+def load_app(database: str):
+    '''Import the Flask app configured to use the database. Must be called before anything else imports it'''
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.abspath(database)
+    os.environ.setdefault('POPULATION_METRICS', '["population_density", "at-risk_score"]')
+    from app import app, views
+    from app.geometry import OutputAreaGeometry
+    views.output_areas = OutputAreaGeometry(geometry_path(database))
+    return app, views
+
+
+def route_requests(database: str, seed: int) -> dict:
+    '''
+    Requests for each route, keyed by a name for the route. Each is a function which
+    sends a request with randomly chosen parameters using a Flask test client
+    '''
+    conn = sqlite3.connect(database)
+    poi_types = [poi_type for (poi_type,) in conn.execute("SELECT DISTINCT type FROM poi")]
+    strata = [stratum for (stratum,) in conn.execute("SELECT DISTINCT stratum FROM otp_results_summary")]
+    conn.close()
+    rng = np.random.RandomState(seed)
+
+    def some(values, most=3):
+        return [values[i] for i in rng.choice(len(values), size=rng.randint(1, most + 1), replace=False)]
+
+    def query(**params):
+        return '&'.join(f'{name}={value}' for (name, values) in params.items() for value in values)
+
+    def accessibility_metrics(layout):
+        return lambda client: client.get('/accessibility-metrics?' + query(**{
+            'accessibility-metric': [ACCESS_METRICS[rng.randint(len(ACCESS_METRICS))]],
+            'point-of-interest-types': some(poi_types),
+            'time-strata': some(strata),
+            'format': [layout]
+        }))
+
+    def batch(client):
+        groups = some(DEMOGRAPHIC_GROUPS, most=len(DEMOGRAPHIC_GROUPS))
+        (poi_type, stratum) = (some(poi_types), some(strata))
+        return client.post('/batch', json=[
+            {'endpoint': 'population-metrics', 'population-metric': 'at-risk_score', 'demographic-group': [group],
+             'point-of-interest-types': poi_type, 'time-strata': stratum}
+            for group in groups
+        ])
+
+    return {
+        '/meta/accessibility-metric': lambda client: client.get('/meta/accessibility-metric'),
+        '/meta/time-strata': lambda client: client.get('/meta/time-strata'),
+        '/meta/point-of-interest-type': lambda client: client.get('/meta/point-of-interest-type'),
+        '/meta/population-metric': lambda client: client.get('/meta/population-metric'),
+        '/meta/demographic': lambda client: client.get('/meta/demographic'),
+        '/meta/metrics': lambda client: client.get('/meta/metrics'),
+        '/output-areas': lambda client: client.get('/output-areas', headers={'Accept-Encoding': 'gzip'}),
+        '/output-areas?format=topojson': lambda client: client.get('/output-areas?format=topojson',
+                                                                   headers={'Accept-Encoding': 'gzip'}),
+        '/accessibility-metrics': accessibility_metrics('json'),
+        '/accessibility-metrics?format=columnar': accessibility_metrics('columnar'),
+        '/population-metrics?population-metric=population_density': lambda client: client.get(
+            '/population-metrics?' + query(**{'demographic-group': some(DEMOGRAPHIC_GROUPS)})
+        ),
+        '/population-metrics?population-metric=at-risk_score': lambda client: client.get(
+            '/population-metrics?population-metric=at-risk_score&' + query(**{
+                'demographic-group': some(DEMOGRAPHIC_GROUPS),
+                'point-of-interest-types': some(poi_types),
+                'time-strata': some(strata)
+            })
+        ),
+        '/batch': batch,
+    }
+
+
+def time_route(app, views, send, num_requests: int, num_threads: int, warm_cache: bool) -> dict:
+    '''Send requests to a route from several threads at once, returning latency percentiles in ms and throughput'''
+    latencies = []
+    statuses = set()
+    lock = threading.Lock()
+    counter = itertools.count()
+
+    def worker():
+        client = app.test_client()
+        while next(counter) < num_requests:
+            if not warm_cache:
+                views.response_cache.clear()
+            start = time.perf_counter()
+            response = send(client)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                statuses.add(response.status_code)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(num_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total = time.perf_counter() - start
+    (p50, p95, p99) = np.percentile(np.array(latencies) * 1000, [50, 95, 99]).tolist()
+    return {
+        'requests': len(latencies),
+        'p50_ms': p50,
+        'p95_ms': p95,
+        'p99_ms': p99,
+        'mean_ms': float(np.mean(latencies) * 1000),
+        'throughput_rps': len(latencies) / total,
+        'statuses': sorted(statuses)
+    }
+
+
+def describe_database(database: str) -> dict:
+    conn = sqlite3.connect(database)
+    (summary_rows, oas, poi_types, strata) = conn.execute(
+        "SELECT count(*), count(DISTINCT oa_id), count(DISTINCT poi_type), count(DISTINCT stratum) FROM otp_results_summary"
+    ).fetchone()
+    conn.close()
+    return {'oas': oas, 'poi_types': poi_types, 'strata': strata, 'summary_rows': summary_rows,
+            'size_bytes': os.path.getsize(database)}
+
+
+def run_benchmark(database: str, num_requests: int, num_threads: int, warm_cache: bool, seed: int) -> dict:
+    app, views = load_app(database)
+    requests = route_requests(database, seed)
+    client = app.test_client()
+    # The first requests load the summary cube and the output area boundaries, which later requests share
+    start = time.perf_counter()
+    client.get('/accessibility-metrics')
+    first_request = time.perf_counter() - start
+    start = time.perf_counter()
+    client.get('/output-areas')
+    first_output_areas = time.perf_counter() - start
+    results = {
+        'started': datetime.datetime.now().isoformat(timespec='seconds'),
+        'database': describe_database(database),
+        'settings': {'requests': num_requests, 'threads': num_threads, 'warm_cache': warm_cache, 'seed': seed,
+                     'summary_cube': app.config['SUMMARY_CUBE']},
+        'first_request_ms': first_request * 1000,
+        'first_output_areas_ms': first_output_areas * 1000,
+        'routes': {}
+    }
+    print(f"First request (loads the summary cube): {results['first_request_ms']:.1f}ms")
+    print(f"First /output-areas (loads the boundaries): {results['first_output_areas_ms']:.1f}ms")
+    print(f"{'route':<60}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}  status")
+    for (route, send) in requests.items():
+        timings = time_route(app, views, send, num_requests, num_threads, warm_cache)
+        results['routes'][route] = timings
+        print(f"{route:<60}{timings['p50_ms']:>10.2f}{timings['p95_ms']:>10.2f}{timings['p99_ms']:>10.2f}"
+              f"{timings['throughput_rps']:>10.1f}  {','.join(str(status) for status in timings['statuses'])}")
+    return results
+
+
+def compare_results(results: dict, baseline: dict) -> None:
+    '''Print the change in p50 and p95 latency of each route from the baseline run'''
+    print(f"\nCompared with the run of {baseline['started']} ({baseline['database']['summary_rows']} summary rows):")
+    print(f"{'route':<60}{'p50':>10}{'p95':>10}")
+    for (route, timings) in results['routes'].items():
+        if route not in baseline['routes']:
+            continue
+        changes = [timings[key] / baseline['routes'][route][key] - 1 for key in ('p50_ms', 'p95_ms')]
+        flag = ''
+        if changes[0] > COMPARISON_THRESHOLD:
+            flag = '  slower'
+        elif changes[0] < -COMPARISON_THRESHOLD:
+            flag = '  faster'
+        print(f"{route:<60}{changes[0]:>+10.0%}{changes[1]:>+10.0%}{flag}")
+
+
+if __name__ == '__main__':
+    args = parse_input_args()
+    if args['command'] == 'generate':
+        generate_database(args['database'], args['oas'], args['poi_types'], args['strata'], args['seed'])
+    else:
+        if not os.path.isfile(args['database']):
+            print(f"Database {args['database']} does not exist. Make one with the generate command")
+            exit(1)
+        results = run_benchmark(args['database'], args['requests'], args['threads'], args['warm_cache'], args['seed'])
+        if args['compare']:
+            with open(args['compare']) as src:
+                compare_results(results, json.load(src))
+        if args['output']:
+            os.makedirs(os.path.dirname(os.path.abspath(args['output'])), exist_ok=True)
+            with open(args['output'], 'w') as dst:
+                json.dump(results, dst, indent=2)
+            print(f"Saved results to {args['output']}")
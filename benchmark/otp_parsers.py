@@ -0,0 +1,108 @@
+'''
+Micro-benchmark of the OTP response parsers on captured responses.
+
+Capture responses from a running OTP instance for the first trips of a trips CSV file,
+in both XML and JSON, then time each parser over them:
+
+    $ python -m benchmark.otp_parsers capture data/otp_trips.csv responses/ --host http://localhost:8080 -n 500
+    $ python -m benchmark.otp_parsers run responses/
+
+Each parser is also checked to produce the same trips as the XML parser.
+'''
+import argparse
+import csv
+import glob
+import itertools
+import os
+import timeit
+
+from modelling import open_trip_planner as otp
+
+DEFAULT_NUM_TRIPS = 200
+DEFAULT_REPEAT = 5
+
+
+class CapturedResponse:
+    '''Stands in for a requests.Response, holding only what the parsers use'''
+
+    def __init__(self, content: bytes, content_type: str):
+        self.content = content
+        self.headers = {'Content-Type': content_type}
+
+
+def parse_input_args() -> dict:
+    '''Parse the input arguments and return a dict keyed by arg names'''
+    parser = argparse.ArgumentParser(description='Benchmark the OTP response parsers on captured responses')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    capture = commands.add_parser('capture', help='Capture XML and JSON responses for trips from an OTP instance')
+    capture.add_argument('file', type=str, help='Path to trips CSV file')
+    capture.add_argument('responses', type=str, help='Directory the responses are saved to')
+    capture.add_argument('--host', type=str, default='http://localhost:8080', help='URL of the OTP instance')
+    capture.add_argument('-n', '--num-trips', metavar='num_trips', type=int, default=DEFAULT_NUM_TRIPS,
+                         help=f'Number of trips to capture responses for. Default: {DEFAULT_NUM_TRIPS}')
+    run = commands.add_parser('run', help='Time the parsers on captured responses')
+    run.add_argument('responses', type=str, help='Directory of captured responses')
+    run.add_argument('--repeat', type=int, default=DEFAULT_REPEAT,
+                     help=f'Times to parse every response with each parser, keeping the fastest. Default: {DEFAULT_REPEAT}')
+    args = parser.parse_args()
+    return vars(args)
+
+
+def capture_responses(input_file: str, output_dir: str, host_url: str, num_trips: int) -> None:
+    os.makedirs(output_dir, exist_ok=True)
+    with open(input_file, newline='') as src:
+        trips = list(itertools.islice(csv.DictReader(src), num_trips))
+    for response_format in otp.RESPONSE_FORMATS:
+        with otp.OTPClient(response_format=response_format) as client:
+            for trip in trips:
+                response = client.request(host_url, trip)
+                response.raise_for_status()
+                with open(os.path.join(output_dir, f"{trip['trip_id']}.{response_format}"), 'wb') as dst:
+                    dst.write(response.content)
+    print(f'Captured {len(trips)} responses in each format to {output_dir}')
+
+
+def load_responses(response_dir: str, response_format: str) -> dict:
+    responses = {}
+    for path in sorted(glob.glob(os.path.join(response_dir, f'*.{response_format}'))):
+        trip_id = os.path.splitext(os.path.basename(path))[0]
+        with open(path, 'rb') as src:
+            responses[trip_id] = CapturedResponse(src.read(), otp.RESPONSE_FORMATS[response_format])
+    return responses
+
+
+def time_parser(parse, responses: list, repeat: int) -> float:
+    '''Fastest time taken to parse every response once, in seconds'''
+    return min(timeit.repeat(lambda: [parse(response) for response in responses], number=1, repeat=repeat))
+
+
+def run_benchmark(response_dir: str, repeat: int) -> None:
+    xml_responses = load_responses(response_dir, 'xml')
+    json_responses = load_responses(response_dir, 'json')
+    if not xml_responses:
+        print(f'No captured responses found in {response_dir}')
+        exit(1)
+    parsers = [
+        ('xml (ElementTree)', otp.parse_response, xml_responses),
+        (f'json ({otp.json_loads.__module__})', otp.parse_response, json_responses),
+    ]
+    expected = {trip_id: otp.parse_response(response) for trip_id, response in xml_responses.items()}
+    baseline = None
+    print(f"{'parser':<24}{'responses':>10}{'us/response':>14}{'speedup':>10}  matches xml")
+    for name, parse, responses in parsers:
+        if not responses:
+            continue
+        seconds = time_parser(parse, list(responses.values()), repeat)
+        per_response = seconds / len(responses) * 1e6
+        baseline = baseline or per_response
+        matches = all(parse(response) == expected.get(trip_id) for trip_id, response in responses.items())
+        print(f'{name:<24}{len(responses):>10}{per_response:>14.1f}{baseline / per_response:>9.2f}x  {matches}')
+
+
+if __name__ == '__main__':
+    args = parse_input_args()
+    if args['command'] == 'capture':
+        capture_responses(args['file'], args['responses'], args['host'], args['num_trips'])
+    else:
+        run_benchmark(args['responses'], args['repeat'])
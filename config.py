@@ -10,4 +10,26 @@ class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'tfwm.db')
     POPULATION_METRICS = os.environ.get('POPULATION_METRICS')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Calculate metrics from an in-memory copy of otp_results_summary rather than in SQL
+    SUMMARY_CUBE = os.environ.get('SUMMARY_CUBE', 'true').lower() not in ('0', 'false', 'no')
+    # Largest summary cube loaded, in bytes. Metrics are calculated in SQL if the cube would be larger
+    SUMMARY_CUBE_MAX_BYTES = int(os.environ.get('SUMMARY_CUBE_MAX_BYTES') or 1024 * 1024 * 1024)
+    # Bounds of the in-process cache of metric responses
+    RESPONSE_CACHE_ENTRIES = int(os.environ.get('RESPONSE_CACHE_ENTRIES') or 128)
+    RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES') or 64 * 1024 * 1024)
+    # Open a SQLite database read-only, keeping a pool of warm connections
+    SQLITE_READ_ONLY = os.environ.get('SQLITE_READ_ONLY', 'true').lower() not in ('0', 'false', 'no')
+    # Only safe if the database is never changed while the app is running
+    SQLITE_IMMUTABLE = os.environ.get('SQLITE_IMMUTABLE', 'false').lower() not in ('0', 'false', 'no')
+    SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE') or 1024 * 1024 * 1024)
+    # Negative values are in KiB rather than pages
+    SQLITE_CACHE_SIZE = int(os.environ.get('SQLITE_CACHE_SIZE') or -65536)
+    # Connections kept open, at least the number of threads serving requests
+    SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE') or 8)
+    # Connections opened beyond the pool size when every pooled one is in use, and closed after use
+    SQLITE_POOL_OVERFLOW = int(os.environ.get('SQLITE_POOL_OVERFLOW') or 8)
+    # Prepared statements kept per connection. Filters are bound as JSON arrays, so each endpoint needs only a few
+    SQLITE_CACHED_STATEMENTS = int(os.environ.get('SQLITE_CACHED_STATEMENTS') or 256)
+    # Log queries taking at least this many seconds with their parameters. A negative value turns the log off
+    SLOW_QUERY_SECONDS = float(os.environ.get('SLOW_QUERY_SECONDS') or 0.5)
     
@@ -1,12 +1,38 @@
 import logging
+import numpy as np
 import pandas as pd
 import os
-from utils.utils import date_range, time_range, datetime_range
+from concurrent.futures import ThreadPoolExecutor
+from modelling import spatial, trip_factors
+from utils.utils import date_range
 from utils.database import Database
-from random import seed, sample
 from datetime import datetime
 
 
+def minutes_in_stratum(time_of_day):
+    """
+    Minutes of the day within the given periods, e.g. ['8:00-9:00'], as offsets from midnight.
+    Both ends of each period are included
+
+    Parameters
+    ----------
+    time_of_day : list
+        Periods of the day as strings 'H:MM-H:MM'
+
+    Returns
+    ----------
+    minutes : numpy.ndarray
+        Minutes since midnight, in order of the periods
+    """
+    minutes = []
+    for hours in time_of_day:
+        start_time_str, end_time_str = hours.split('-')
+        start_time = datetime.strptime(start_time_str, '%H:%M')
+        end_time = datetime.strptime(end_time_str, '%H:%M')
+        minutes.append(np.arange(start_time.hour * 60 + start_time.minute, end_time.hour * 60 + end_time.minute + 1))
+    return np.concatenate(minutes) if minutes else np.array([], dtype=np.int64)
+
+
 def sample_timestamps(time_defs, time_strata, n_timepoints, rseed = 999):
     """
     Sample time points from strata (time segments) and write to MODEL.timestamps
@@ -42,7 +68,7 @@ def sample_timestamps(time_defs, time_strata, n_timepoints, rseed = 999):
     None
     """
     logger = logging.getLogger('root')
-    seed(rseed)
+    rng = np.random.default_rng(rseed)
 
     start_date_str = time_defs.get('term')['start_date']
     start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
@@ -67,22 +93,20 @@ def sample_timestamps(time_defs, time_strata, n_timepoints, rseed = 999):
         days_in_stratum = date_range(start_date, end_date, day_of_week)
 
         # All time (minutes) in the stratum
-        times_in_stratum = []
-        for hours in time_of_day:
-            start_time_str, end_time_str = hours.split('-')
-            start_time = datetime.strptime(start_time_str, '%H:%M').time()
-            end_time = datetime.strptime(end_time_str, '%H:%M').time()
-            times_in_stratum += time_range(start_time, end_time)
-
-        # Cartesian product of dates and times -> all time points in the stratum for sampling
-        timestamps_in_stratum = datetime_range(days_in_stratum, times_in_stratum)
-
-        # Sample specified number of timepoints
-        timestamps_sampled = sample(timestamps_in_stratum, n)
-
-        for ts in timestamps_sampled:
-            date = ts.strftime('%Y-%m-%d')
-            time = ts.strftime('%H:%M')
+        minutes_of_day = minutes_in_stratum(time_of_day)
+
+        # Time points in the stratum are the Cartesian product of dates and times. Rather than building it,
+        # sample indices into it: index i is date i // len(minutes_of_day) at minute i % len(minutes_of_day)
+        n_timestamps_in_stratum = len(days_in_stratum) * len(minutes_of_day)
+        if n > n_timestamps_in_stratum:
+            raise ValueError(f'Sample of {n} larger than the {n_timestamps_in_stratum} time points in "{stratum}"')
+        sampled = rng.choice(n_timestamps_in_stratum, size=n, replace=False)
+        (day_index, minute_index) = np.divmod(sampled, len(minutes_of_day))
+        dates = np.datetime_as_string(days_in_stratum[day_index], unit='D')
+        minutes = minutes_of_day[minute_index]
+
+        for (date, minute) in zip(dates.tolist(), minutes.tolist()):
+            time = f'{minute // 60:02d}:{minute % 60:02d}'
             ts_dict = {'stratum': stratum, 'date': date, 'time': time}
             timestamps.append(ts_dict)
 
@@ -97,7 +121,7 @@ def create_timestamps(time_defs, time_strata, n_timepoints, rseed = 999):
     logger.debug(f'Sampled timestamps saved to model.timestamps')
 
     
-def create_k_poi(sql_dir, k_poi, poi_dict):
+def create_k_poi(sql_dir, k_poi, poi_dict, method='python', n_workers=1):
     """
     For each OA and each type of point of interest (POI), select K nearest spots (by aerial distance) and write the
     results to MODEL.k_poi
@@ -105,7 +129,7 @@ def create_k_poi(sql_dir, k_poi, poi_dict):
     Parameters
     ----------
     sql_dir : string
-        Directory that stores create_model_k_poi.sql
+        Directory that stores create_model_k_poi_table.sql, create_model_k_poi_indexes.sql and create_model_k_poi.sql
 
     k_poi : int
         Default # of nearest POIs to compute
@@ -116,21 +140,98 @@ def create_k_poi(sql_dir, k_poi, poi_dict):
         Example:
             Hospital: 3
             Job Centre:
+
+    method : str
+        If 'python', find the nearest POIs with modelling.spatial and bulk copy them to MODEL.k_poi; if 'sql', find
+        them in the database with create_model_k_poi.sql, reading them in order of distance from the spatial index
+        of SEMANTIC.poi. Ties in distance are ranked arbitrarily either way
+
+    n_workers : int
+        With the 'sql' method, number of POI types whose nearest POIs are selected at once, each by its own
+        database connection; 1 selects every type in a single query
     Returns
     ----------
     None
     """
-    sql_file = os.path.join(sql_dir, 'create_model_k_poi.sql')
-
     poi_types = list(poi_dict.keys())
     poi_Ks = [poi_dict[poi] or k_poi for poi in poi_dict]
-
-    params = {'poi_types': str(poi_types), 'poi_Ks': str(poi_Ks)}
     db = Database.get_instance()
-    db.execute_sql(sql_file, read_file=True, params=params)
+    db.execute_sql(os.path.join(sql_dir, 'create_model_k_poi_table.sql'), read_file=True)
+
+    if method == 'python':
+        k_poi_df = k_nearest_pois(dict(zip(poi_types, poi_Ks)))
+        db.copy_df_to_db(k_poi_df, 'model.k_poi')
+    elif method == 'sql':
+        db.execute_sql(os.path.join(sql_dir, 'create_model_k_poi_indexes.sql'), read_file=True)
+        sql_file = os.path.join(sql_dir, 'create_model_k_poi.sql')
+        if n_workers > 1:
+            def insert_k_poi(poi_type, poi_K):
+                params = {'poi_types': str([poi_type]), 'poi_Ks': str([poi_K])}
+                db.execute_sql(sql_file, read_file=True, params=params)
+                logging.getLogger('root').debug(f'K nearest POIs of type {poi_type} saved to model.k_poi')
+
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                # Iterating over the results raises any error of the queries
+                list(executor.map(insert_k_poi, poi_types, poi_Ks))
+        else:
+            params = {'poi_types': str(poi_types), 'poi_Ks': str(poi_Ks)}
+            db.execute_sql(sql_file, read_file=True, params=params)
+    else:
+        raise ValueError(f'Unknown method "{method}" of selecting the K nearest POIs')
     logging.getLogger('root').debug(f'K nearest POIs saved to model.k_poi')
 
 
+def k_nearest_pois(poi_Ks):
+    """
+    Select the K nearest POIs of each type to each OA centroid from SEMANTIC.oa and SEMANTIC.poi,
+    in the columns of MODEL.k_poi
+
+    Parameters
+    ----------
+    poi_Ks : dict
+        Number of nearest POIs to select for each POI type
+
+    Returns
+    ----------
+    k_poi : pandas.DataFrame
+        Rows of MODEL.k_poi, with great-circle distances in metres
+    """
+    db = Database.get_instance()
+    # Geographies are read and copied back as hex-encoded EWKB
+    oas = db.execute_sql(
+        """
+        SELECT
+            oa11 AS oa_id,
+            centroid::geography AS oa_centroid,
+            ST_Y(centroid) AS latitude,
+            ST_X(centroid) AS longitude
+        FROM semantic.oa
+        """,
+        read_file=False, return_df=True
+    )
+    pois = db.execute_sql(
+        """
+        SELECT
+            id AS poi_id,
+            type,
+            snapped_latitude AS poi_latitude,
+            snapped_longitude AS poi_longitude,
+            snapped_location::geography AS poi_location,
+            ST_Y(snapped_location) AS latitude,
+            ST_X(snapped_location) AS longitude
+        FROM semantic.poi
+        """,
+        read_file=False, return_df=True
+    )
+    # POIs of other types are ignored
+    k_poi = spatial.k_nearest_by_type(oas, pois, poi_Ks)
+    k_poi = k_poi.rename(columns={'type': 'poi_type'})
+    return k_poi[[
+        'oa_id', 'oa_centroid', 'poi_id', 'poi_type', 'poi_latitude', 'poi_longitude', 'poi_location', 'rank',
+        'distance'
+    ]]
+
+
 def create_trips(sql_dir, mode='replace'):
     """
     Configure trip info for each OTP query and save to MODEL.trips
@@ -179,6 +280,47 @@ def create_otp_trips(sql_dir, mode='replace'):
     logging.getLogger('root').debug(f'Trips info saved to MODEL.otp_trips')
 
 
+def export_trip_factors(output_dir):
+    """
+    Write the factors of the trips for OTP input - MODEL.k_poi and MODEL.timestamps, with the locations of their OAs
+    and POIs - to a directory of CSV files, from which modelling.trip_factors generates the trips as they are routed.
+    Trip IDs are numbered from the factors, so are not those of MODEL.otp_trips
+
+    Parameters
+    ----------
+    output_dir : string
+        Directory to write the files to, created if it does not exist
+
+    Returns
+    ----------
+    None
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    # Trip IDs follow from the order of k_poi.csv and timestamps.csv, so both are sorted
+    queries = {
+        trip_factors.OAS_FILE: """
+            SELECT oa11 AS oa_id, snapped_latitude AS oa_lat, snapped_longitude AS oa_lon
+            FROM semantic.oa
+            WHERE oa11 IN (SELECT oa_id FROM model.k_poi)
+        """,
+        trip_factors.POIS_FILE: """
+            SELECT id AS poi_id, type AS poi_type, snapped_latitude AS poi_lat, snapped_longitude AS poi_lon
+            FROM semantic.poi
+            WHERE id IN (SELECT poi_id FROM model.k_poi)
+        """,
+        trip_factors.K_POI_FILE: """
+            SELECT oa_id, poi_id FROM model.k_poi ORDER BY oa_id, poi_type, rank, poi_id
+        """,
+        trip_factors.TIMESTAMPS_FILE: """
+            SELECT stratum, date, time FROM model.timestamps ORDER BY stratum, date, time
+        """
+    }
+    db = Database.get_instance()
+    for file_name, query in queries.items():
+        db.copy_table_to_csv(f'({query}) AS factor', os.path.join(output_dir, file_name), index=False)
+    logging.getLogger('root').debug(f'Trip factors saved to {output_dir}')
+
+
 def compute_populations(sql_dir, populations):
     """
     Compute population statistics, saved to RESULTS.populations
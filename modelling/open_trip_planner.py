@@ -1,14 +1,56 @@
-import requests
+import hashlib
+import threading
 import xml.etree.ElementTree as ET
 from datetime import datetime, timedelta
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # orjson decodes OTP responses several times faster than the standard library
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Attributes of a parsed trip, in the order they are written to the results CSV
+TRIP_ATTRIBUTES = (
+    'departure_time',
+    'arrival_time',
+    'total_time',
+    'walk_time',
+    'transfer_wait_time',
+    'transit_time',
+    'walk_dist',
+    'transit_dist',
+    'total_dist',
+    'num_transfers',
+    'initial_wait_time',
+    'fare'
+)
+
+
+DEFAULT_POOL_SIZE = 1       # Keep-alive connections held open per OTP host
+DEFAULT_RETRIES = 3         # Retries for connection errors and 502/503/504 responses
+DEFAULT_TIMEOUT = 60.0      # Seconds to wait for a single OTP response
+DEFAULT_RESPONSE_FORMAT = 'xml'
 
-def request_otp(host_url, input_row):
+# Accept header requesting each format OTP can respond in
+RESPONSE_FORMATS = {
+    'xml': 'application/xml',
+    'json': 'application/json'
+}
+
+
+def plan_url(host_url):
     # Strip a trailing backslash if there is one
     if host_url[-1] == "/":
         host_url = host_url[:-1]
-    url = host_url + '/otp/routers/default/plan?'
-    params = {
+    return host_url + '/otp/routers/default/plan'
+
+
+def plan_params(input_row):
+    return {
         "fromPlace": f"{input_row['oa_lat']},{input_row['oa_lon']}",
         "toPlace": f"{input_row['poi_lat']},{input_row['poi_lon']}",
         "date": f"{input_row['date']}",
@@ -19,23 +61,133 @@ def request_otp(host_url, input_row):
         #"maxWalkDistance": "1000"
         "walkReluctance": "20"
     }
-    resp = requests.get(url=url,
-                        params=params,
-                        headers={'accept': 'application/xml'})
+
+
+def request_otp(host_url, input_row, session=None, timeout=None):
+    # Reuse the connection pool of a requests.Session if one is given
+    http = session if session is not None else requests
+    resp = http.get(url=plan_url(host_url),
+                    params=plan_params(input_row),
+                    headers={'accept': 'application/xml'},
+                    timeout=timeout)
     return resp
 
 
+class OTPClient:
+    """
+    Reusable client for sending plan requests to one or more OTP instances.
+    A keep-alive session is kept per host, so consecutive trips reuse the same TCP
+    connections instead of opening (and leaving in TIME_WAIT) a new one per request.
+
+    Parameters
+    ----------
+    pool_size : int
+        Maximum number of connections kept open per host. Set this to the number of
+        threads sending requests through the client at once
+    retries : int
+        Number of times a request is retried on connection errors or 502/503/504 responses
+    backoff_factor : float
+        Retries wait backoff_factor * 2^(retry number - 1) seconds between attempts
+    timeout : float
+        Seconds to wait for a response before raising requests.exceptions.Timeout
+    response_format : str
+        Format OTP is asked to respond in, 'xml' or 'json'. JSON responses are smaller
+        and much cheaper to parse. parse_response handles either
+    """
+
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, retries=DEFAULT_RETRIES, backoff_factor=0.5,
+                 timeout=DEFAULT_TIMEOUT, response_format=DEFAULT_RESPONSE_FORMAT):
+        if response_format not in RESPONSE_FORMATS:
+            raise ValueError(f'Unknown response format "{response_format}", expected one of {list(RESPONSE_FORMATS)}')
+        self.response_format = response_format
+        self.pool_size = pool_size
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self._sessions = {}
+        self._plan_urls = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def session(self, host_url):
+        """Get the session for a host, creating it on first use"""
+        session = self._sessions.get(host_url)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host_url)
+                if session is None:
+                    session = self._create_session()
+                    self._plan_urls[host_url] = plan_url(host_url)
+                    self._sessions[host_url] = session
+        return session
+
+    def _create_session(self):
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(502, 503, 504)
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.headers.update({'accept': RESPONSE_FORMATS[self.response_format]})
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def request(self, host_url, input_row):
+        """Send a plan request for a trip to the OTP instance at host_url"""
+        session = self.session(host_url)
+        return session.get(
+            url=self._plan_urls[host_url],
+            params=plan_params(input_row),
+            timeout=self.timeout
+        )
+
+    def close(self):
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._plan_urls.clear()
+
+
+def graph_version(host_url, timeout=DEFAULT_TIMEOUT):
+    """
+    Identify the graph an OTP instance is routing on, by the time the graph was built.
+    Falls back to a hash of the router information if OTP does not report a build time.
+    """
+    if host_url[-1] == "/":
+        host_url = host_url[:-1]
+    resp = requests.get(url=host_url + '/otp/routers/default',
+                        headers={'accept': 'application/json'},
+                        timeout=timeout)
+    resp.raise_for_status()
+    build_time = json_loads(resp.content).get('buildTime')
+    if build_time is not None:
+        return str(build_time)
+    return hashlib.sha1(resp.content).hexdigest()
+
+
 def get_request_parameter(node: ET.Element, param: str) -> str:
     request_parameters = node.find('requestParameters')
     return request_parameters.find(param).text
 
 
-def get_time_from_itinerary(time: str, itinerary):
-    dt = datetime.fromtimestamp(float(itinerary.find(time).text) / 1000)
+def time_from_millis(millis: float) -> datetime:
+    dt = datetime.fromtimestamp(float(millis) / 1000)
     dt += timedelta(hours=1)
     return dt
 
 
+def get_time_from_itinerary(time: str, itinerary):
+    return time_from_millis(itinerary.find(time).text)
+
+
 def get_total_distance_from_itinerary(itinerary):
     total_dist = 0.0
     for legs in itinerary.findall('legs'):
@@ -68,22 +220,21 @@ def validate_trip(trip: dict) -> bool:
     return True
 
 
+def is_json_response(response) -> bool:
+    headers = getattr(response, 'headers', None) or {}
+    return 'json' in headers.get('Content-Type', '')
+
+
 def parse_response(response):
+    """
+    Parse an OTP plan response into a trip dict with the keys in TRIP_ATTRIBUTES,
+    or return False if no valid trip was found. JSON responses (see OTPClient's
+    response_format) are passed on to parse_json_response.
+    """
+    if is_json_response(response):
+        return parse_json_response(response.content)
     root = ET.fromstring(response.content)
-    trip = {
-        'departure_time': None,
-        'arrival_time': None,
-        'total_time': None,
-        'walk_time': None,
-        'transfer_wait_time': None,
-        'transit_time': None,
-        'walk_dist': None,
-        'transit_dist': None,
-        'total_dist': None,
-        'num_transfers': None,
-        'initial_wait_time': None,
-        'fare': None
-    }
+    trip = {attribute: None for attribute in TRIP_ATTRIBUTES}
     date = get_request_parameter(root, 'date')
     time = get_request_parameter(root, 'time')
     query_time = datetime.strptime(' '.join([date, time]), '%Y-%m-%d %H:%M')
@@ -149,6 +300,74 @@ def parse_response(response):
         return False
 
 
+def get_fare_from_json_itinerary(itinerary: dict):
+    details = (itinerary.get('fare') or {}).get('details')
+    if details:
+        regular = details['regular']
+        # A list of fare components, of which the XML path reads the first
+        if isinstance(regular, list):
+            regular = regular[0]
+        return float(regular['price']['cents']) / 100
+
+
+def parse_json_response(content: bytes):
+    """
+    Parse the body of a JSON OTP plan response. Returns the same trip dict as the
+    XML path of parse_response, or False if no valid trip was found.
+    """
+    data = json_loads(content)
+    trip = {attribute: None for attribute in TRIP_ATTRIBUTES}
+    request_parameters = data['requestParameters']
+    query_time = datetime.strptime(' '.join([request_parameters['date'], request_parameters['time']]),
+                                   '%Y-%m-%d %H:%M')
+    error = data.get('error')
+    if error and error.get('msg') is not None:
+        # The start and destination were too close, no trip could be found
+        message = error.get('message')
+        if message is not None and message in "TOO_CLOSE":
+            trip.update(
+                departure_time=query_time,
+                arrival_time=query_time,
+                total_time=0.0,
+                walk_time=0.0,
+                transfer_wait_time=0.0,
+                transit_time=0.0,
+                walk_dist=0.0,
+                transit_dist=0.0,
+                total_dist=0.0,
+                num_transfers=0,
+                initial_wait_time=0.0,
+                fare=0.0
+            )
+            return trip
+        return False
+    itineraries = (data.get('plan') or {}).get('itineraries')
+    if not itineraries:
+        return False
+    # Should only be 1 itinerary, as only 1 is requested
+    itinerary = itineraries[-1]
+    format_str = '%Y-%m-%d %H:%M:%S'
+    trip['arrival_time'] = time_from_millis(itinerary['endTime']).strftime(format_str)
+    trip['total_time'] = float(itinerary['duration'])
+    trip['walk_time'] = float(itinerary['walkTime'])
+    trip['transfer_wait_time'] = float(itinerary['waitingTime'])
+    trip['transit_time'] = float(itinerary['transitTime'])
+    trip['walk_dist'] = float(itinerary['walkDistance'])
+    trip['num_transfers'] = int(itinerary['transfers'])
+    trip['total_dist'] = sum((float(leg['distance']) for leg in itinerary.get('legs', ())), 0.0)
+    trip['fare'] = get_fare_from_json_itinerary(itinerary)
+    if trip['fare'] is None:
+        trip['fare'] = calculate_fare(trip['num_transfers'], trip['walk_time'], trip['total_time'])
+    # capture the wait time before the first bus arrives
+    departure_time = time_from_millis(itinerary['startTime'])
+    trip['initial_wait_time'] = (departure_time - query_time).total_seconds()
+    trip['departure_time'] = departure_time.strftime(format_str)
+    trip['transit_dist'] = trip['total_dist'] - trip['walk_dist']
+    if validate_trip(trip):
+        return trip
+    return False
+
+
 if __name__ == '__main__':
     host = "http://localhost:8080"
     test_trip = {
@@ -167,6 +386,7 @@ if __name__ == '__main__':
         'date': '2020-07-28',
         'time': '13:49'
     }
-    response = request_otp(host, test_trip)
-    print(response.content)
-    print(parse_response(response, ))
+    with OTPClient() as client:
+        response = client.request(host, test_trip)
+        print(response.content)
+        print(parse_response(response, ))
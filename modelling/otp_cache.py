@@ -0,0 +1,154 @@
+'''
+Persistent cache of parsed OTP trips, so that re-runs only route trips which are
+genuinely new. Trips are keyed on their normalised plan request parameters rather
+than their trip ID: the same origin, destination and departure minute recur across
+runs (e.g. after changing model_config.yaml) and between OAs snapping to the same point.
+
+The cache is a SQLite database which stores the version of the OTP graph its trips were
+routed on. Opening it with a different graph version, e.g. after a GTFS feed update,
+discards every cached trip.
+'''
+import json
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from modelling import open_trip_planner as otp
+
+COORDINATE_PRECISION = 6    # Decimal places kept of each coordinate, roughly 0.1m
+MAX_QUERY_PARAMETERS = 500  # Keys looked up per query, below SQLite's limit on parameters
+
+
+def normalise_place(place: str) -> str:
+    return ','.join(f'{float(coordinate):.{COORDINATE_PRECISION}f}' for coordinate in place.split(','))
+
+
+def normalise_time(time: str) -> str:
+    # Departures are requested to the minute, so H:MM, HH:MM and HH:MM:SS all name the same one
+    hours, minutes = time.split(':')[:2]
+    return f'{int(hours):02d}:{int(minutes):02d}'
+
+
+def cache_key(input_row: dict) -> str:
+    '''Key of a trip: its plan request parameters, normalised and in a fixed order'''
+    params = otp.plan_params(input_row)
+    params['fromPlace'] = normalise_place(params['fromPlace'])
+    params['toPlace'] = normalise_place(params['toPlace'])
+    params['time'] = normalise_time(params['time'])
+    return '&'.join(f'{name}={params[name]}' for name in sorted(params))
+
+
+def encode_trip(trip) -> str:
+    '''Encode a parsed trip, or None for a request which found no trip'''
+    if not trip:
+        return None
+    trip = {attribute: trip[attribute] for attribute in otp.TRIP_ATTRIBUTES}
+    # Only trips whose origin and destination are too close hold datetimes. They are
+    # stored as the string they would be written to CSV as.
+    return json.dumps(trip, default=str)
+
+
+def decode_trip(value: str):
+    if value is None:
+        return False
+    return json.loads(value)
+
+
+class OTPResponseCache:
+    """
+    Cache of parsed OTP trips held in a SQLite database. Each process opens its own
+    cache; new trips are buffered by add() and written in a single transaction by flush().
+
+    Parameters
+    ----------
+    path : str
+        Path to the cache database. It is created if it does not exist
+    graph_version : str
+        Version of the OTP graph trips are being routed on, see open_trip_planner.graph_version.
+        If it differs from the version the cache was built with, the cache is emptied
+    """
+
+    def __init__(self, path: str, graph_version: str):
+        self.path = path
+        self.graph_version = str(graph_version)
+        self.hits = 0
+        self._pending = []
+        self._lock = threading.Lock()
+        # Lookups and flushes happen on the thread routing batches, but add() may be
+        # called by request threads
+        self._conn = sqlite3.connect(path, timeout=60, isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction():
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS trips (key TEXT PRIMARY KEY, trip TEXT) WITHOUT ROWID")
+            cached_version = self._conn.execute("SELECT value FROM meta WHERE name = 'graph_version'").fetchone()
+            if cached_version is None or cached_version[0] != self.graph_version:
+                # Trips routed on another graph are no longer valid
+                self._conn.execute("DELETE FROM trips")
+                self._conn.execute("INSERT OR REPLACE INTO meta VALUES ('graph_version', ?)", (self.graph_version,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._conn.execute("SELECT count(*) FROM trips").fetchone()[0]
+
+    def get_many(self, rows: list) -> dict:
+        """
+        Look up the cached trips of input rows
+
+        Returns
+        -------
+        dict
+            Trip ID -> parsed trip, or False if OTP found no trip, of the rows which are cached
+        """
+        keys = {}
+        for row in rows:
+            keys.setdefault(cache_key(row), []).append(row['trip_id'])
+        unique_keys = list(keys)
+        cached = {}
+        for start in range(0, len(unique_keys), MAX_QUERY_PARAMETERS):
+            chunk = unique_keys[start:start + MAX_QUERY_PARAMETERS]
+            query = f"SELECT key, trip FROM trips WHERE key IN ({', '.join('?' for _ in chunk)})"
+            for key, value in self._conn.execute(query, chunk):
+                for trip_id in keys[key]:
+                    trip = decode_trip(value)
+                    if trip:
+                        trip['trip_id'] = trip_id
+                    cached[trip_id] = trip
+        self.hits += len(cached)
+        return cached
+
+    def add(self, input_row: dict, trip) -> None:
+        '''Add the parsed response for an input row, to be written on the next flush'''
+        with self._lock:
+            self._pending.append((cache_key(input_row), encode_trip(trip)))
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if pending:
+            with self._transaction():
+                self._conn.executemany("INSERT OR REPLACE INTO trips VALUES (?, ?)", pending)
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so processes queue for it (up to the
+        # connection timeout) instead of failing when upgrading a read lock
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            self._conn.close()
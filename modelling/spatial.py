@@ -0,0 +1,168 @@
+'''
+K nearest neighbour search over points on the Earth's surface.
+
+Points are placed on the unit sphere so that the straight-line (chord) distance
+between them increases with the great-circle distance, and the K nearest by one
+are the K nearest by the other. A KD-tree over the 3D points then answers K
+nearest queries exactly, in O(log n) per query rather than comparing every
+origin with every destination.
+'''
+import numpy as np
+import pandas as pd
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+# Mean radius of the Earth in metres, as used by the haversine formula
+EARTH_RADIUS = 6371008.8
+
+# Number of origins compared with every destination at once when scipy is not installed
+BRUTE_FORCE_CHUNK_SIZE = 1024
+
+
+def to_unit_sphere(lat, lon):
+    '''
+    Cartesian coordinates on the unit sphere of points given in degrees
+
+    Parameters
+    ----------
+    lat : array_like
+        Latitudes in degrees
+    lon : array_like
+        Longitudes in degrees
+
+    Returns
+    ----------
+    points : numpy.ndarray
+        Array of shape (n, 3)
+    '''
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lon = np.radians(np.asarray(lon, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lon), cos_lat * np.sin(lon), np.sin(lat)))
+
+
+def chord_to_metres(chord):
+    '''Great-circle distance in metres of a chord of the unit sphere'''
+    return 2 * EARTH_RADIUS * np.arcsin(np.clip(chord / 2, 0, 1))
+
+
+class NearestNeighbours:
+    '''
+    Index of destinations answering K nearest queries for many origins at once.
+    Uses scipy's cKDTree if scipy is installed, otherwise compares each chunk of
+    origins with every destination using NumPy.
+
+    Parameters
+    ----------
+    lat : array_like
+        Latitudes of the destinations in degrees
+    lon : array_like
+        Longitudes of the destinations in degrees
+    '''
+
+    def __init__(self, lat, lon):
+        self.points = to_unit_sphere(lat, lon)
+        self.tree = cKDTree(self.points) if cKDTree is not None and len(self.points) else None
+
+    def __len__(self):
+        return len(self.points)
+
+    def query(self, lat, lon, k):
+        '''
+        K nearest destinations of each origin, nearest first. If there are fewer than
+        K destinations, every destination is returned for each origin.
+
+        Parameters
+        ----------
+        lat : array_like
+            Latitudes of the origins in degrees
+        lon : array_like
+            Longitudes of the origins in degrees
+        k : int
+            Number of destinations to find for each origin
+
+        Returns
+        ----------
+        distances : numpy.ndarray
+            Great-circle distances in metres, of shape (origins, min(k, destinations))
+        indexes : numpy.ndarray
+            Indexes of the destinations, of the same shape
+        '''
+        origins = to_unit_sphere(lat, lon)
+        k = min(k, len(self.points))
+        if k <= 0 or not len(origins):
+            return np.empty((len(origins), 0)), np.empty((len(origins), 0), dtype=np.intp)
+        if self.tree is not None:
+            chords, indexes = self.tree.query(origins, k=k)
+            # cKDTree drops the last axis when k is 1
+            chords, indexes = chords.reshape(len(origins), k), indexes.reshape(len(origins), k)
+        else:
+            chords, indexes = self._brute_force(origins, k)
+        return chord_to_metres(chords), indexes.astype(np.intp)
+
+    def _brute_force(self, origins, k):
+        chords = np.empty((len(origins), k))
+        indexes = np.empty((len(origins), k), dtype=np.intp)
+        for start in range(0, len(origins), BRUTE_FORCE_CHUNK_SIZE):
+            chunk = slice(start, start + BRUTE_FORCE_CHUNK_SIZE)
+            # |a - b|^2 = 2 - 2 a.b for points on the unit sphere, which is quick to compute for
+            # every destination but loses precision at short distances, so only picks the candidates
+            squared = np.maximum(2 - 2 * origins[chunk] @ self.points.T, 0)
+            if k < squared.shape[1]:
+                nearest = np.argpartition(squared, k - 1, axis=1)[:, :k]
+            else:
+                nearest = np.broadcast_to(np.arange(squared.shape[1]), squared.shape)
+            # Chords of the candidates measured directly as |a - b|
+            nearest_chords = np.linalg.norm(origins[chunk][:, np.newaxis, :] - self.points[nearest], axis=2)
+            order = np.argsort(nearest_chords, axis=1, kind='stable')
+            indexes[chunk] = np.take_along_axis(nearest, order, axis=1)
+            chords[chunk] = np.take_along_axis(nearest_chords, order, axis=1)
+        return chords, indexes
+
+
+def k_nearest_by_type(origins, destinations, ks):
+    '''
+    K nearest destinations of each type for every origin, e.g. the K nearest POIs of each type to each OA
+
+    Parameters
+    ----------
+    origins : pandas.DataFrame
+        Origins with 'latitude' and 'longitude' columns in degrees, and any other columns to include in the result
+    destinations : pandas.DataFrame
+        Destinations with 'type', 'latitude' and 'longitude' columns, and any other columns to include in the result
+    ks : dict
+        Number of nearest destinations to find for each type of destination. Other types are ignored
+
+    Returns
+    ----------
+    nearest : pandas.DataFrame
+        One row for each origin and each of its nearest destinations of each type, ordered by type, origin and rank.
+        Has every column of origins and destinations, which must not share names other than the coordinates,
+        with the coordinates of destinations prefixed by 'destination_', and 'rank' (1 for the nearest) and
+        'distance' (great-circle distance in metres) columns
+    '''
+    origins = origins.reset_index(drop=True)
+    destination_columns = {'latitude': 'destination_latitude', 'longitude': 'destination_longitude'}
+    nearest = []
+    for destination_type, k in ks.items():
+        of_type = destinations[destinations['type'] == destination_type].reset_index(drop=True)
+        distances, indexes = NearestNeighbours(of_type['latitude'], of_type['longitude']).query(
+            origins['latitude'], origins['longitude'], k
+        )
+        if not indexes.size:
+            continue
+        (n_origins, n_nearest) = indexes.shape
+        rows = pd.concat([
+            origins.iloc[np.repeat(np.arange(n_origins), n_nearest)].reset_index(drop=True),
+            of_type.iloc[indexes.ravel()].reset_index(drop=True).rename(columns=destination_columns)
+        ], axis=1)
+        rows['rank'] = np.tile(np.arange(1, n_nearest + 1), n_origins)
+        rows['distance'] = distances.ravel()
+        nearest.append(rows)
+    if not nearest:
+        columns = list(origins.columns) + [destination_columns.get(c, c) for c in destinations.columns]
+        return pd.DataFrame(columns=columns + ['rank', 'distance'])
+    return pd.concat(nearest, ignore_index=True)
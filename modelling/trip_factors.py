@@ -0,0 +1,139 @@
+'''
+Trips to be routed by OTP as the product of their factors: every pair of an OA and one of its
+K nearest POIs (model.k_poi) at every sampled timestamp (model.timestamps). Rather than
+materialising the product, which is K x OAs x POI types x timestamps rows, only the factors
+are stored, and trips are generated as they are needed.
+
+Trip IDs are computed arithmetically from the position of the factors: trip
+k_poi_index * number of timestamps + timestamp_index + 1 is the k_poi_index'th OA and POI
+at the timestamp_index'th timestamp. IDs are therefore stable for as long as the factor
+files are, and any range of trips can be generated without generating those before it.
+
+The factors are stored in a directory of CSV files with headers:
+    oas.csv         oa_id, oa_lat, oa_lon
+    pois.csv        poi_id, poi_type, poi_lat, poi_lon
+    k_poi.csv       oa_id, poi_id, in the order trips are numbered in
+    timestamps.csv  stratum, date, time, in the order trips are numbered in
+'''
+import argparse
+import csv
+import os
+
+import numpy as np
+
+OAS_FILE = 'oas.csv'
+POIS_FILE = 'pois.csv'
+K_POI_FILE = 'k_poi.csv'
+TIMESTAMPS_FILE = 'timestamps.csv'
+
+# Columns of trips, as in model.otp_trips
+OTP_TRIPS_COLUMNS = ('oa_id', 'poi_id', 'date', 'time', 'trip_id', 'oa_lat', 'oa_lon', 'poi_lat', 'poi_lon')
+TRIP_STRATA_COLUMNS = ('trip_id', 'stratum', 'date', 'time')
+
+
+def read_csv(file_name: str) -> list:
+    with open(file_name, 'r', newline='') as csv_file:
+        return list(csv.DictReader(csv_file))
+
+
+class TripFactors:
+    '''
+    Generates trips from their factors. Has the read and close methods of
+    run_otp_processing.TripReader, so it can be routed in the same way as a file of trips.
+    Values are kept as the strings they were read as, as they are in a file of trips.
+
+    Parameters
+    ----------
+    oas : list
+        Dicts with keys oa_id, oa_lat and oa_lon
+    pois : list
+        Dicts with keys poi_id, poi_type, poi_lat and poi_lon
+    k_poi : list
+        Dicts with keys oa_id and poi_id
+    timestamps : list
+        Dicts with keys stratum, date and time
+    '''
+
+    def __init__(self, oas: list, pois: list, k_poi: list, timestamps: list):
+        self.oas = [(oa['oa_id'], oa['oa_lat'], oa['oa_lon']) for oa in oas]
+        self.pois = [(poi['poi_id'], poi['poi_type'], poi['poi_lat'], poi['poi_lon']) for poi in pois]
+        self.timestamps = [(timestamp['stratum'], timestamp['date'], timestamp['time']) for timestamp in timestamps]
+        # Pairs of OA and POI are held as indexes into oas and pois, as there are many more of them
+        oa_index = {oa[0]: i for i, oa in enumerate(self.oas)}
+        poi_index = {poi[0]: i for i, poi in enumerate(self.pois)}
+        self.k_poi_oas = np.fromiter((oa_index[pair['oa_id']] for pair in k_poi), dtype=np.int32, count=len(k_poi))
+        self.k_poi_pois = np.fromiter((poi_index[pair['poi_id']] for pair in k_poi), dtype=np.int32, count=len(k_poi))
+
+    @classmethod
+    def from_dir(cls, factors_dir: str):
+        '''Load the factors written to a directory by modelling.model_functions.export_trip_factors'''
+        return cls(*(read_csv(os.path.join(factors_dir, file_name))
+                     for file_name in (OAS_FILE, POIS_FILE, K_POI_FILE, TIMESTAMPS_FILE)))
+
+    def __len__(self) -> int:
+        return len(self.k_poi_oas) * len(self.timestamps)
+
+    def trip_id(self, k_poi_index: int, timestamp_index: int) -> int:
+        return k_poi_index * len(self.timestamps) + timestamp_index + 1
+
+    def factor_indexes(self, trip_id: int) -> tuple:
+        '''Positions of the OA and POI pair, and of the timestamp, of a trip'''
+        if not 1 <= trip_id <= len(self):
+            raise IndexError(f'No trip {trip_id}: trip IDs are from 1 to {len(self)}')
+        return divmod(trip_id - 1, len(self.timestamps))
+
+    def trip(self, trip_id: int) -> dict:
+        '''A trip with the columns of model.otp_trips, and its stratum'''
+        k_poi_index, timestamp_index = self.factor_indexes(trip_id)
+        oa_id, oa_lat, oa_lon = self.oas[self.k_poi_oas[k_poi_index]]
+        poi_id, poi_type, poi_lat, poi_lon = self.pois[self.k_poi_pois[k_poi_index]]
+        stratum, date, time = self.timestamps[timestamp_index]
+        return {
+            'oa_id': oa_id, 'poi_id': poi_id, 'date': date, 'time': time, 'trip_id': str(trip_id),
+            'oa_lat': oa_lat, 'oa_lon': oa_lon, 'poi_lat': poi_lat, 'poi_lon': poi_lon,
+            'poi_type': poi_type, 'stratum': stratum
+        }
+
+    def summary_keys(self, trip_id: int) -> tuple:
+        '''The oa_id, poi_type and stratum of a trip, which its result is summarised by'''
+        k_poi_index, timestamp_index = self.factor_indexes(trip_id)
+        return (self.oas[self.k_poi_oas[k_poi_index]][0], self.pois[self.k_poi_pois[k_poi_index]][1],
+                self.timestamps[timestamp_index][0])
+
+    def read(self, offset: int, limit: int) -> list:
+        '''Generate the trips in the range [offset, limit), i.e. trip IDs offset + 1 to limit'''
+        return [self.trip(trip_id) for trip_id in range(offset + 1, min(limit, len(self)) + 1)]
+
+    def __iter__(self):
+        for trip_id in range(1, len(self) + 1):
+            yield self.trip(trip_id)
+
+    def close(self):
+        pass
+
+    def write_trips(self, otp_trips_file: str, trip_strata_file: str) -> None:
+        '''
+        Write every trip to files of the otp_trips and trip_strata tables, for loading into SQLite
+        with upload_csv_to_sqlite.py: the results summary joins them to the results by trip ID
+        '''
+        with open(otp_trips_file, 'w', newline='') as otp_trips_csv, \
+                open(trip_strata_file, 'w', newline='') as trip_strata_csv:
+            otp_trips = csv.DictWriter(otp_trips_csv, fieldnames=OTP_TRIPS_COLUMNS, extrasaction='ignore')
+            trip_strata = csv.DictWriter(trip_strata_csv, fieldnames=TRIP_STRATA_COLUMNS, extrasaction='ignore')
+            otp_trips.writeheader()
+            trip_strata.writeheader()
+            for trip in self:
+                otp_trips.writerow(trip)
+                trip_strata.writerow(trip)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Write the trips generated from a directory of trip factors as otp_trips and trip_strata CSV files')
+    parser.add_argument('factors_dir', type=str, help='Directory of trip factors written by run_etl_and_model.py')
+    parser.add_argument('output_dir', type=str, help='Directory to write otp_trips.csv and trip_strata.csv to')
+    args = parser.parse_args()
+    TripFactors.from_dir(args.factors_dir).write_trips(
+        os.path.join(args.output_dir, 'otp_trips.csv'),
+        os.path.join(args.output_dir, 'trip_strata.csv')
+    )
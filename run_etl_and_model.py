@@ -87,6 +87,8 @@ with pb.ProgressBar(max_value=13) as bar:
         SQL_FOLDER, 
         k_poi=hyper_params['k_POI'],
         poi_dict=params['points_of_interest'],
+        method=hyper_params.get('k_POI_method', 'python'),
+        n_workers=hyper_params.get('k_POI_workers', 1),
     )
     bar.update(next(steps_iter))
 
@@ -104,3 +106,11 @@ with pb.ProgressBar(max_value=13) as bar:
         f'model.{file_name}',
         os.path.join(RESULTS_FOLDER, f'{file_name}.csv'),
     )
+
+    if hyper_params.get('export_trip_factors', False):
+        # Trips are the product of OAs and their K nearest POIs with timestamps, so
+        # run_otp_processing.py --factors can generate them from these few files
+        # rather than reading otp_trips.csv (see modelling/trip_factors.py)
+        factors_dir = os.path.join(RESULTS_FOLDER, 'trip_factors')
+        logger.info(f'Storing the factors of trips for OTP input to {factors_dir}')
+        model_functions.export_trip_factors(factors_dir)
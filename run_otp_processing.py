@@ -1,213 +1,816 @@
-import argparse
-import csv
-import itertools
-import logging
-import multiprocessing
-import os
-import time
-from typing import Tuple
-
-import numpy as np
-
-import settings
-from modelling import open_trip_planner as otp
-
-
-def parse_input_args() -> dict:
-    '''Parse the input arguments and return a dict keyed by arg names'''
-    parser = argparse.ArgumentParser(description='Run OTP to compute routes of each trip in the input file')
-    parser.add_argument('file', type=str, help='Path to pre-computed trips CSV file. The first row is used for column headers')
-    args = parser.parse_args()
-    return vars(args)
-
-
-def check_input_file_exists(file_name: str) -> None:
-    if not os.path.isfile(file_name):
-        logging.error(f'File "{file_name}" not found.')
-        exit(1)
-
-
-def get_csv_reader(input_file: str) -> csv.reader:
-    '''Get the CSV reader object for a file'''
-    with open(input_file, 'r') as csv_file:
-        return csv.reader(csv_file)
-
-
-def num_rows(file_name: str) -> int:
-    '''Count the number of rows in the (CSV) file'''
-    with open(file_name, 'r') as otp_trips:
-        otp_trips_reader = csv.reader(otp_trips)
-        rows = sum(1 for row in otp_trips_reader)
-    rows -= 1 # Account for the header
-    logging.debug(f'{rows} in {file_name}')
-    return rows
-
-
-def get_step_size(num_trips: int, processes: int) -> int:
-    '''Calculate how many rows each process will have'''
-    return int(np.ceil(num_trips / processes))
-
-
-def get_csv_section(reader, offset, limit) -> object:
-    '''Get a 'slice' or section of the CSV file for a process'''
-    return itertools.islice(reader, offset, limit)
-
-
-def get_otp_response(host_url, input_row) -> tuple:
-    '''Parse the response from OTP into tuple of values represnting trip attributes'''
-    response = otp.request_otp(host_url, input_row)
-    trip = otp.parse_response(response)
-    if trip:
-        trip['trip_id'] = input_row['trip_id']
-    return trip
-
-
-def print_progress_message(process_id:int, row_counter: int):
-    rows_complete.value += row_counter
-    logging.info((
-        f'Process {process_id} has completed {row_counter} rows. '
-        f'{(rows_complete.value/num_trips * 100):.2f}% complete'
-    ))
-
-
-def compute_trips(host_url: str, offset: int, limit: int, input_file: str, output_dir: str) -> Tuple[str, int]:
-    """
-    Send a request to OTP, parse the response and write a line to the output file.
-    Note: Parallel processing begins and ends here - each Python process will run this
-    function until it has completed its 'chunk' of data, then it will return the name
-    of the file it wrote its data to.
-    Recall that individual processes do not share global variables and other data - each 
-    process holds a copy of the parent's (process it was created from) data independently 
-    of any other process.
-    """
-    process_id = os.getpid()
-    output_file = os.path.join(output_dir, f'temp_{process_id}.csv')
-    logging.debug(f"PID {process_id} on {host_url} for range [{offset}, {limit}]\nSaving to: {output_file}")
-    bad_rows = 0
-    with open(input_file, 'r') as csv_file:
-        # Usage of DictReader saves having to unpack rows manually, but
-        # requires that the first row of the file has valid, standard headers
-        reader = csv.DictReader(csv_file)
-        csv_section = get_csv_section(reader, offset, limit)
-        # Treat the first row differently because we want to extract
-        # CSV headers from the file, allowing us to use DictReader.
-        firstRow = next(csv_section)
-        first_response = get_otp_response(host_url, firstRow)
-        headers = first_response.keys()
-        with open(output_file, 'a', newline='') as output_csv:
-            writer = csv.DictWriter(output_csv, fieldnames=headers, delimiter=',')
-            writer.writeheader()
-            writer.writerow(first_response)
-            row_counter = 1
-            for row in csv_section:
-                response = get_otp_response(host_url, row)
-                # Some trips have None for all attributes due to OTP error or inability to find a trip
-                # These trips return 'False' instead of a dict so empty rows are not written to CSV.
-                row_counter += 1
-                if response:
-                    writer.writerow(response)
-                else:
-                    logging.warning(f'Failed to get OTP response for trip ID: {row["trip_id"]}')
-                    bad_rows += 1
-                if row_counter % 1000 == 0:
-                    print_progress_message(process_id, row_counter)
-                    row_counter = 0
-    print_progress_message(process_id, row_counter)
-    logging.info(f'Process {process_id} has completed its chunk.')
-    return output_file, bad_rows
-
-
-def split_trips(input_file: str, output_dir: str) -> None:
-
-    def init(trips, complete):
-        # Make num_trips global in each process.
-        # This grants read-only access in compute_trips
-        global num_trips
-        global rows_complete
-        num_trips = trips
-        rows_complete = complete
-
-    host, port, processes, otps = settings.get_otp_settings()
-    num_trips = num_rows(input_file)
-    step_size = get_step_size(num_trips, processes)
-
-    # Distribute processes between OTP addresses in a circular manner.
-    # E.g for 4 processes and 2 OTPs, OTP 1 with port 8080 will have 
-    # processes 0, 2 while OTP 2 with port 8081 will have processes 1, 3.
-    args = []
-    for i in range(processes):
-        host_url = f"http://{host}:{str(port + (i % otps))}"
-        offset =i * step_size
-        arg = (
-            host_url, 
-            offset, 
-            min(offset+step_size, num_trips), 
-            input_file, 
-            output_dir
-        )
-        args.append(arg)
-    # Shared memory int variable to keep track of total rows done
-    rows_complete = multiprocessing.Value('i', 0)
-    logging.info(f'Using a pool of {processes} workers')
-    # Distribute the OTP processing between processes. Each process returns
-    # the path to the file it wrote its results to.
-    start = time.time()
-    with multiprocessing.Pool(int(processes), initializer=init, initargs=(num_trips, rows_complete)) as pool:
-        results = pool.starmap(compute_trips, args)
-    end = time.time()
-    elapsed = end - start
-    logging.info(f"{(elapsed / 60.0):.2f} min elapsed.")
-    files = []
-    bad_rows = 0
-    for f, rows in results:
-        files.append(f)
-        bad_rows += rows
-    if bad_rows > 0:
-        logging.warning(f"{bad_rows} trips were lost during OTP processing ({(bad_rows/num_trips * 100):.2f}%).")
-    return files
-
-
-def extract_headers(csv_file):
-    with open(csv_file, 'r') as f:
-        reader = csv.reader(f)
-        return next(reader)
-
-
-def combine_complete_files(output_dir, files):
-    '''Combine the individual files produced by each process into a single main file'''
-    output_file_name = os.path.join(output_dir, 'results_full.csv')
-    logging.info("Combining results to: " + output_file_name)
-    files_iterator = iter(files)
-    # Treat the first file differently, so we can extract headers
-    first_file = files[0]
-    headers = extract_headers(first_file)
-    with open(output_file_name, 'w') as output_file:
-        output_csv = csv.writer(output_file)
-        output_csv.writerow(headers)
-        for csv_file in files:
-            with open(csv_file, newline='') as f:
-                reader = csv.DictReader(f)
-                for line in reader:
-                    output_csv.writerow(line.values())
-    return output_file_name
-
-
-def cleanup(complete_files):
-    '''Delete the temp files produced by each process'''
-    logging.info("Cleaning up...")
-    for f in complete_files:
-        os.remove(f)
-
-
-if __name__ == '__main__':
-    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
-    args = parse_input_args()
-    # Input CSV MUST HAVE HEADERS - these are included by default by the ETL process
-    input_csv = args['file']
-    check_input_file_exists(input_csv)
-    ROOT_FOLDER = settings.get_root_dir()
-    output_dir = os.path.join(ROOT_FOLDER, 'results/')
-    complete_files = split_trips(input_csv, output_dir)
-    combine_complete_files(output_dir, complete_files)
-    cleanup(complete_files)
-    logging.info("Done!")
+import argparse
+import asyncio
+import csv
+import functools
+import glob
+import heapq
+import io
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty
+from typing import Tuple
+
+import requests
+
+import settings
+from modelling import open_trip_planner as otp
+from modelling.otp_cache import OTPResponseCache
+from modelling.trip_factors import TripFactors
+from upload_csv_to_sqlite import SQLiteResultsWriter
+from utils.csv_index import CsvIndex, open_csv_index
+
+DEFAULT_CONCURRENCY = 8   # Requests kept in flight per process in async mode
+DEFAULT_BATCH_SIZE = 200  # Trips handed to a process at a time
+DEFAULT_CHECKPOINT_INTERVAL = 1000  # Trips completed by a process between checkpoints
+MERGE_BUFFER_SIZE = 16 * 1024 * 1024  # Bytes buffered when combining the files of each process
+SORT_RUN_SIZE = 1000000   # Lines sorted in memory at a time when combining files in order
+QUEUE_BATCH_SIZE = 500    # Trips sent to the SQLite writer at a time by each process
+
+
+def parse_input_args() -> dict:
+    '''Parse the input arguments and return a dict keyed by arg names'''
+    parser = argparse.ArgumentParser(description='Run OTP to compute routes of each trip in the input file')
+    parser.add_argument('file', type=str, help='Path to pre-computed trips CSV file. The first row is used for column headers')
+    parser.add_argument('--factors', action='store_true',
+                        help=('file is a directory of trip factors written by run_etl_and_model.py, from which trips are '
+                              'generated as they are routed rather than read from a file of every trip'))
+    parser.add_argument('-m', '--mode', type=str, choices=['sync', 'async'], default='sync', required=False,
+                        help='sync sends one request at a time per process, async keeps several in flight. Default: sync')
+    parser.add_argument('-c', '--concurrency', metavar='concurrency', type=int, default=DEFAULT_CONCURRENCY, required=False,
+                        help=f'Number of requests each process keeps in flight in async mode. Default: {DEFAULT_CONCURRENCY}')
+    parser.add_argument('-t', '--timeout', metavar='timeout', type=float, default=otp.DEFAULT_TIMEOUT, required=False,
+                        help=f'Seconds to wait for each OTP response. Default: {otp.DEFAULT_TIMEOUT}')
+    parser.add_argument('-b', '--batch-size', metavar='batch_size', type=int, default=DEFAULT_BATCH_SIZE, required=False,
+                        help=f'Number of trips a process takes from the shared queue at a time. Default: {DEFAULT_BATCH_SIZE}')
+    start = parser.add_mutually_exclusive_group()
+    start.add_argument('--resume', action='store_true',
+                       help='Resume an interrupted run, skipping trips recorded in its checkpoint journals and keeping their results')
+    start.add_argument('--overwrite', action='store_true',
+                       help=('With --sink sqlite, delete the existing results and summary before the run. Without this '
+                             'or --resume, a run refuses to start if otp_results already holds results'))
+    parser.add_argument('--checkpoint-interval', metavar='checkpoint_interval', type=int, default=DEFAULT_CHECKPOINT_INTERVAL,
+                        required=False, help=f'Number of trips each process completes between checkpoints. Default: {DEFAULT_CHECKPOINT_INTERVAL}')
+    parser.add_argument('-s', '--sink', type=str, choices=['csv', 'sqlite'], default='csv', required=False,
+                        help=('csv writes results to results/results_full.csv, sqlite inserts them straight into the '
+                              'otp_results table of the database at SQLITE_PATH and updates otp_results_summary. Default: csv'))
+    parser.add_argument('--sort', action='store_true',
+                        help='Sort the combined results by trip ID. By default results are in the order they were completed')
+    parser.add_argument('-r', '--retries', metavar='retries', type=int, default=otp.DEFAULT_RETRIES, required=False,
+                        help=f'Times to retry a request after a connection error or 502/503/504. Default: {otp.DEFAULT_RETRIES}')
+    parser.add_argument('--cache', metavar='cache_file', type=str, default=None, required=False,
+                        help=('SQLite file caching parsed trips by origin, destination and departure minute. Cached trips '
+                              'are not routed again, so re-runs only route new trips. Default: no cache'))
+    parser.add_argument('--graph-version', metavar='graph_version', type=str, default=None, required=False,
+                        help=('Version of the OTP graph, which the cache is emptied on a change of. '
+                              'Default: the build time of the graph reported by the first OTP instance'))
+    parser.add_argument('-f', '--format', type=str, choices=list(otp.RESPONSE_FORMATS), default=otp.DEFAULT_RESPONSE_FORMAT,
+                        required=False, help=('Format OTP is asked to respond in. json is much cheaper to parse, which matters '
+                                              f'when processes are limited by CPU rather than OTP. Default: {otp.DEFAULT_RESPONSE_FORMAT}'))
+    args = parser.parse_args()
+    return vars(args)
+
+
+def check_input_file_exists(file_name: str, factors: bool = False) -> None:
+    if factors and not os.path.isdir(file_name):
+        logging.error(f'Directory "{file_name}" not found.')
+        exit(1)
+    if not factors and not os.path.isfile(file_name):
+        logging.error(f'File "{file_name}" not found.')
+        exit(1)
+
+
+def num_rows(file_name: str) -> int:
+    '''
+    Count the number of rows in the (CSV) file using its index.
+    The index is written when the file is exported, but is built here if it is missing.
+    '''
+    rows = open_csv_index(file_name).num_rows
+    logging.debug(f'{rows} in {file_name}')
+    return rows
+
+
+class TripReader:
+    '''
+    Reads batches of trips from the input CSV file. Rows are located through the byte-offset
+    index of the file (see utils.csv_index), so a batch is read by seeking straight to it
+    rather than parsing every row before it.
+    '''
+
+    def __init__(self, input_file: str):
+        self._index = CsvIndex(input_file)
+        self._file = open(input_file, 'rb')
+        # The first row of the file must have valid, standard headers for use as dict keys
+        self._headers = next(csv.reader([self._file.readline().decode('utf-8')]))
+
+    def read(self, offset: int, limit: int) -> list:
+        '''Read the rows in the range [offset, limit) of the file'''
+        start, end = self._index.byte_range(offset, limit)
+        self._file.seek(start)
+        section = self._file.read(end - start).decode('utf-8')
+        return list(csv.DictReader(io.StringIO(section, newline=''), fieldnames=self._headers))
+
+    def close(self):
+        self._file.close()
+
+
+class OTPBalancer:
+    '''
+    Shares the OTP instances between processes according to how quickly they respond.
+    Each batch of trips goes to the instance with the lowest expected wait: its average
+    response time multiplied by the number of batches it is already serving. A slow or
+    struggling instance is therefore given less of the work instead of an equal share.
+    Response times and batch counts are kept in shared memory, visible to all processes.
+    '''
+
+    def __init__(self, host_urls: list, smoothing: float = 0.2):
+        self.host_urls = host_urls
+        # Weight given to the newest batch in the moving average of response times
+        self.smoothing = smoothing
+        self._lock = multiprocessing.Lock()
+        self._latency = multiprocessing.Array('d', len(host_urls), lock=False)
+        self._active = multiprocessing.Array('i', len(host_urls), lock=False)
+
+    def acquire(self) -> int:
+        '''Choose the OTP instance for the next batch, returning its index in host_urls'''
+        with self._lock:
+            observed = [latency for latency in self._latency if latency > 0]
+            # Instances without a measurement yet are assumed to be average
+            default = sum(observed) / len(observed) if observed else 1.0
+            expected_waits = [
+                (self._active[i] + 1) * (self._latency[i] or default)
+                for i in range(len(self.host_urls))
+            ]
+            index = expected_waits.index(min(expected_waits))
+            self._active[index] += 1
+        return index
+
+    def release(self, index: int, mean_latency: float = None) -> None:
+        '''
+        Record that a batch on an OTP instance has finished, with its mean response time.
+        A batch which sent no requests has no response time, and leaves the average as it is.
+        '''
+        with self._lock:
+            self._active[index] -= 1
+            if mean_latency is None:
+                return
+            if self._latency[index] == 0:
+                self._latency[index] = mean_latency
+            else:
+                self._latency[index] += self.smoothing * (mean_latency - self._latency[index])
+
+
+def next_batch():
+    '''Take the next batch of trips from the shared counter, or None if all trips have been taken'''
+    with next_trip.get_lock():
+        offset = next_trip.value
+        if offset >= num_trips:
+            return None
+        limit = min(offset + batch_size, num_trips)
+        next_trip.value = limit
+    return offset, limit
+
+
+def iter_batches():
+    batch = next_batch()
+    while batch is not None:
+        yield batch
+        batch = next_batch()
+
+
+def get_otp_response(host_url, input_row) -> tuple:
+    '''Parse the response from OTP into tuple of values represnting trip attributes'''
+    # otp_client is created per process by the pool initializer in split_trips
+    response = otp_client.request(host_url, input_row)
+    trip = otp.parse_response(response)
+    if trip:
+        trip['trip_id'] = input_row['trip_id']
+    return trip
+
+
+def print_progress_message(process_id:int, row_counter: int):
+    with rows_complete.get_lock():
+        rows_complete.value += row_counter
+    logging.info((
+        f'Process {process_id} has completed {row_counter} rows. '
+        f'{(rows_complete.value/num_trips * 100):.2f}% complete'
+    ))
+
+
+def temp_file_path(output_dir: str, worker_id: int) -> str:
+    return os.path.join(output_dir, f'temp_{worker_id}.csv')
+
+
+def journal_file_path(output_dir: str, worker_id: int) -> str:
+    return os.path.join(output_dir, f'journal_{worker_id}.txt')
+
+
+def run_files(output_dir: str, prefix: str) -> list:
+    '''Get the temp or journal files left in output_dir by each process, in order of worker ID'''
+    files = glob.glob(os.path.join(output_dir, f'{prefix}_*'))
+    return sorted(files, key=lambda f: int(os.path.splitext(os.path.basename(f))[0].split('_')[-1]))
+
+
+class CheckpointJournal:
+    '''
+    Journal of the trips a process has completed, kept next to its temp output file so that
+    an interrupted run can be resumed. Every `interval` trips the output file is flushed to
+    disk, then a line holding the size of the output file and the IDs of the trips completed
+    since the last checkpoint is appended to the journal and flushed to disk as well.
+    A trip only appears in the journal once its result is safely in the output file, and
+    anything written to the output file after the last checkpoint can be discarded on resume.
+    '''
+
+    def __init__(self, journal_file: str, output_csv, interval: int):
+        self._journal = open(journal_file, 'a')
+        self._output_csv = output_csv
+        self._interval = interval
+        self._trip_ids = []
+
+    def add(self, trip_id: str) -> None:
+        self._trip_ids.append(trip_id)
+        if len(self._trip_ids) >= self._interval:
+            self.checkpoint()
+
+    def checkpoint(self) -> None:
+        if not self._trip_ids:
+            return
+        self._output_csv.flush()
+        os.fsync(self._output_csv.fileno())
+        output_size = os.fstat(self._output_csv.fileno()).st_size
+        self._journal.write(f"{output_size}\t{','.join(self._trip_ids)}\n")
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._trip_ids = []
+
+    def close(self) -> None:
+        self.checkpoint()
+        self._journal.close()
+
+
+def load_checkpoints(output_dir: str) -> set:
+    """
+    Prepare the files of an interrupted run for resuming, returning the IDs of all trips
+    completed in previous runs. Each temp output file is truncated to its size at the last
+    checkpoint, dropping results that were written after it, and any partially written
+    journal line is removed.
+    """
+    completed = set()
+    for journal_file in run_files(output_dir, 'journal'):
+        worker_id = int(os.path.splitext(os.path.basename(journal_file))[0].split('_')[-1])
+        output_size = 0
+        valid_size = 0
+        with open(journal_file, 'r') as journal:
+            for line in journal:
+                # A line without a newline was cut off mid-write and is ignored
+                if not line.endswith('\n'):
+                    break
+                size, trip_ids = line.rstrip('\n').split('\t')
+                output_size = int(size)
+                completed.update(trip_ids.split(','))
+                valid_size += len(line.encode('utf-8'))
+        os.truncate(journal_file, valid_size)
+        temp_file = temp_file_path(output_dir, worker_id)
+        if os.path.isfile(temp_file):
+            os.truncate(temp_file, output_size)
+    logging.info(f'Resuming run: {len(completed)} trips were completed previously.')
+    return completed
+
+
+class QueueWriter:
+    '''
+    Stands in for both the CSV writer and the checkpoint journal of a process when results are
+    written to SQLite, sending trips to the writer in the main process through a queue,
+    `QUEUE_BATCH_SIZE` at a time. The queue is bounded, so a process blocks if the writer falls behind.
+    A trip is added to the journal straight after it is written, if OTP found a route for it,
+    so a trip added without having just been written is one OTP found no route for. Their IDs
+    are sent to the writer too, so a resumed run does not route them again.
+    '''
+
+    def __init__(self, results_queue):
+        self._queue = results_queue
+        self._trips = []
+        self._unrouted = []
+        self._last_written = None
+
+    def writerow(self, trip: dict) -> None:
+        self._trips.append(trip)
+        self._last_written = trip['trip_id']
+
+    def add(self, trip_id: str) -> None:
+        if trip_id != self._last_written:
+            self._unrouted.append(trip_id)
+        self._last_written = None
+        if len(self._trips) + len(self._unrouted) >= QUEUE_BATCH_SIZE:
+            self._send()
+
+    def _send(self) -> None:
+        self._queue.put((self._trips, self._unrouted))
+        self._trips = []
+        self._unrouted = []
+
+    def close(self) -> None:
+        if self._trips or self._unrouted:
+            self._send()
+        # Tells the writer this process has finished. The queue is FIFO per process,
+        # so everything the process sent arrives before this.
+        self._queue.put(None)
+
+
+def compute_trips(worker_id: int, input_file: str, output_dir: str, mode: str, concurrency: int) -> Tuple[str, int]:
+    """
+    Take batches of trips until there are none left. For each trip, send a request to OTP,
+    parse the response and write a line to the output file, or send the trip to the
+    SQLite writer in the main process.
+    Note: Parallel processing begins and ends here - each Python process will run this
+    function until all trips have been handed out, then it will return the name
+    of the file it wrote its data to.
+    Recall that individual processes do not share global variables and other data - each 
+    process holds a copy of the parent's (process it was created from) data independently 
+    of any other process. The batch counter and OTP balancer live in shared memory.
+    """
+    process_id = os.getpid()
+    route = functools.partial(route_batches_async, concurrency=concurrency) if mode == 'async' else route_batches
+    # Trips generated from their factors are shared by every process
+    reader = generated_trips if generated_trips is not None else TripReader(input_file)
+    try:
+        if results_queue is not None:
+            logging.debug(f"PID {process_id} taking batches of {batch_size} trips\nSaving to SQLite")
+            writer = QueueWriter(results_queue)
+            try:
+                bad_rows = route(reader, writer, writer)
+            finally:
+                writer.close()
+            output_file = None
+        else:
+            output_file = temp_file_path(output_dir, worker_id)
+            logging.debug(f"PID {process_id} taking batches of {batch_size} trips\nSaving to: {output_file}")
+            bad_rows = route_batches_to_csv(route, reader, output_dir, worker_id)
+    finally:
+        reader.close()
+        if response_cache is not None:
+            response_cache.flush()
+    logging.info(f'Process {process_id} has completed its batches.')
+    if response_cache is not None:
+        logging.info(f'Process {process_id} took {response_cache.hits} trips from the cache.')
+    return output_file, bad_rows
+
+
+def route_batches_to_csv(route, reader: TripReader, output_dir: str, worker_id: int) -> int:
+    output_file = temp_file_path(output_dir, worker_id)
+    # Headers come from the known trip attributes rather than the first response,
+    # which may be a failed trip
+    headers = otp.TRIP_ATTRIBUTES + ('trip_id',)
+    # When resuming, results are appended to those of the previous run
+    new_file = not os.path.isfile(output_file) or os.path.getsize(output_file) == 0
+    with open(output_file, 'a', newline='') as output_csv:
+        writer = csv.DictWriter(output_csv, fieldnames=headers, delimiter=',')
+        if new_file:
+            writer.writeheader()
+        journal = CheckpointJournal(journal_file_path(output_dir, worker_id), output_csv, checkpoint_interval)
+        try:
+            return route(reader, writer, journal)
+        finally:
+            # Keep whatever was completed, even if the process is failing
+            journal.close()
+
+
+def read_batch(reader: TripReader, offset: int, limit: int) -> list:
+    '''Read a batch of trips, leaving out any completed by a previous run'''
+    rows = reader.read(offset, limit)
+    if completed_trips:
+        rows = [row for row in rows if row['trip_id'] not in completed_trips]
+    return rows
+
+
+def write_cached_trips(rows: list, writer: csv.DictWriter, journal: CheckpointJournal) -> Tuple[list, int]:
+    '''
+    Write the trips of a batch found in the response cache, returning the rows still to be
+    routed and the number of cached trips OTP found no route for
+    '''
+    if response_cache is None or not rows:
+        return rows, 0
+    cached = response_cache.get_many(rows)
+    if not cached:
+        return rows, 0
+    bad_rows = 0
+    for trip_id, trip in cached.items():
+        if trip:
+            writer.writerow(trip)
+        else:
+            bad_rows += 1
+        journal.add(trip_id)
+    with rows_complete.get_lock():
+        rows_complete.value += len(cached)
+    return [row for row in rows if row['trip_id'] not in cached], bad_rows
+
+
+def route_batches(reader: TripReader, writer: csv.DictWriter, journal: CheckpointJournal) -> int:
+    '''Route batches of trips one request at a time, returning the number of failed trips'''
+    process_id = os.getpid()
+    bad_rows = 0
+    row_counter = 0
+    for offset, limit in iter_batches():
+        host_index = otp_balancer.acquire()
+        host_url = otp_balancer.host_urls[host_index]
+        request_time = 0.0
+        rows, cached_bad_rows = write_cached_trips(read_batch(reader, offset, limit), writer, journal)
+        bad_rows += cached_bad_rows
+        try:
+            for row in rows:
+                start = time.time()
+                try:
+                    response = get_otp_response(host_url, row)
+                except requests.exceptions.RequestException as err:
+                    # Trips lost to a failed request are left out of the journal and cache to be retried
+                    logging.warning(f'OTP request failed for trip ID {row["trip_id"]}: {err}')
+                    request_time += time.time() - start
+                    row_counter += 1
+                    bad_rows += 1
+                    continue
+                request_time += time.time() - start
+                if response_cache is not None:
+                    response_cache.add(row, response)
+                # Some trips have None for all attributes due to OTP error or inability to find a trip
+                # These trips return 'False' instead of a dict so empty rows are not written to CSV.
+                row_counter += 1
+                if response:
+                    writer.writerow(response)
+                else:
+                    logging.warning(f'Failed to get OTP response for trip ID: {row["trip_id"]}')
+                    bad_rows += 1
+                journal.add(row['trip_id'])
+        finally:
+            otp_balancer.release(host_index, request_time / len(rows) if rows else None)
+            if response_cache is not None:
+                response_cache.flush()
+        if row_counter >= 1000:
+            print_progress_message(process_id, row_counter)
+            row_counter = 0
+    print_progress_message(process_id, row_counter)
+    return bad_rows
+
+
+def route_batches_async(reader: TripReader, writer: csv.DictWriter, journal: CheckpointJournal, concurrency: int) -> int:
+    """
+    Asynchronous counterpart of route_batches. Rather than waiting for each OTP round-trip,
+    up to `concurrency` requests are kept in flight. Requests are sent from a thread pool
+    sharing the process' OTPClient connection pool, and rows are only read from the input
+    once a request slot is free, so memory use stays bounded however many trips there are.
+    """
+    # asyncio.run is not available on Python 3.6
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    try:
+        return loop.run_until_complete(_route_batches_async(loop, executor, reader, writer, journal, concurrency))
+    finally:
+        executor.shutdown(wait=True)
+        loop.close()
+
+
+async def _route_batches_async(loop, executor, reader, writer, journal, concurrency):
+    process_id = os.getpid()
+    request_slots = asyncio.Semaphore(concurrency)
+    counters = {'rows': 0, 'bad_rows': 0}
+
+    async def route_trip(row, batch):
+        host_url = otp_balancer.host_urls[batch['host']]
+        start = time.time()
+        request_failed = False
+        try:
+            response = await loop.run_in_executor(executor, get_otp_response, host_url, row)
+        except requests.exceptions.RequestException as err:
+            logging.warning(f'OTP request failed for trip ID {row["trip_id"]}: {err}')
+            response = False
+            request_failed = True
+        finally:
+            request_slots.release()
+            batch['request_time'] += time.time() - start
+            batch['remaining'] -= 1
+            # Batches overlap, so a batch is released by whichever of its trips finishes last
+            if batch['remaining'] == 0:
+                otp_balancer.release(batch['host'], batch['request_time'] / batch['size'])
+        # Callbacks all run on the event loop thread, so writes never interleave
+        counters['rows'] += 1
+        if response:
+            writer.writerow(response)
+        else:
+            logging.warning(f'Failed to get OTP response for trip ID: {row["trip_id"]}')
+            counters['bad_rows'] += 1
+        # Trips lost to a failed request are left out of the journal and cache to be retried
+        if not request_failed:
+            journal.add(row['trip_id'])
+            if response_cache is not None:
+                response_cache.add(row, response)
+        if counters['rows'] % 1000 == 0:
+            print_progress_message(process_id, 1000)
+
+    pending = set()
+    for offset, limit in iter_batches():
+        if response_cache is not None:
+            response_cache.flush()
+        rows, cached_bad_rows = write_cached_trips(read_batch(reader, offset, limit), writer, journal)
+        counters['bad_rows'] += cached_bad_rows
+        batch = {'host': otp_balancer.acquire(), 'size': len(rows), 'remaining': len(rows), 'request_time': 0.0}
+        if not rows:
+            otp_balancer.release(batch['host'])
+        for row in rows:
+            # Backpressure: wait for a free slot before reading the next row
+            await request_slots.acquire()
+            pending.add(loop.create_task(route_trip(row, batch)))
+            done = {task for task in pending if task.done()}
+            for task in done:
+                # Re-raise anything other than a request failure
+                task.result()
+            pending -= done
+    if pending:
+        await asyncio.gather(*pending)
+    print_progress_message(process_id, counters['rows'] % 1000)
+    return counters['bad_rows']
+
+
+def write_results_to_sqlite(async_result, queue: multiprocessing.Queue, writer, tasks: int) -> None:
+    '''Write the trips sent by the processes to SQLite until every task has finished'''
+    finished = 0
+    while finished < tasks:
+        try:
+            message = queue.get(timeout=1)
+        except Empty:
+            # Surface a failed task straight away
+            if async_result.ready() and not async_result.successful():
+                async_result.get()
+            continue
+        if message is None:
+            finished += 1
+        else:
+            trips, unrouted = message
+            writer.write(trips, unrouted)
+    writer.flush()
+
+
+def prepare_sqlite_sink(path: str, resume: bool = False, overwrite: bool = False) -> set:
+    '''
+    Get the database ready for a run writing to it, returning the IDs of the trips completed by
+    previous runs. Existing results are only deleted with `overwrite`, and kept with `resume`.
+    With neither, the run is refused if there are any.
+    '''
+    with SQLiteResultsWriter(path) as results:
+        if resume:
+            completed = results.completed_trip_ids()
+            logging.info(f'Resuming run: {len(completed)} trips are already in SQLite.')
+            return completed
+        if overwrite:
+            logging.info('Deleting existing results from SQLite')
+            results.clear()
+        elif results.has_results():
+            logging.error('The database already holds OTP results. Pass --resume to add to them or --overwrite to replace them.')
+            exit(1)
+    return set()
+
+
+def split_trips(input_file: str, output_dir: str, mode: str = 'sync', concurrency: int = DEFAULT_CONCURRENCY,
+                timeout: float = otp.DEFAULT_TIMEOUT, retries: int = otp.DEFAULT_RETRIES,
+                trips_per_batch: int = DEFAULT_BATCH_SIZE, resume: bool = False,
+                trips_per_checkpoint: int = DEFAULT_CHECKPOINT_INTERVAL, sink: str = 'csv',
+                response_format: str = otp.DEFAULT_RESPONSE_FORMAT, cache_file: str = None,
+                graph_version: str = None, factors: bool = False, overwrite: bool = False) -> None:
+
+    def init(trips, complete, next_trip_counter, balancer, completed, queue):
+        # Make num_trips global in each process.
+        # This grants read-only access in compute_trips
+        global num_trips
+        global rows_complete
+        global next_trip
+        global batch_size
+        global checkpoint_interval
+        global completed_trips
+        global results_queue
+        global otp_balancer
+        global otp_client
+        global response_cache
+        global generated_trips
+        num_trips = trips
+        rows_complete = complete
+        next_trip = next_trip_counter
+        batch_size = trips_per_batch
+        checkpoint_interval = trips_per_checkpoint
+        completed_trips = completed
+        results_queue = queue
+        otp_balancer = balancer
+        # One client per process, so connections to the OTP hosts are kept alive
+        # between trips. In async mode every in-flight request needs a connection.
+        otp_client = otp.OTPClient(pool_size=pool_size, retries=retries, timeout=timeout,
+                                   response_format=response_format)
+        # Each process needs its own connection to the cache
+        response_cache = OTPResponseCache(cache_file, graph_version) if cache_file else None
+        # Loaded once here rather than in every process, which inherit it when they are forked
+        generated_trips = trip_factors
+
+    host, port, processes, otps = settings.get_otp_settings()
+    if factors:
+        trip_factors = TripFactors.from_dir(input_file)
+        num_trips = len(trip_factors)
+        logging.info(f'Generating {num_trips} trips from the factors in {input_file}')
+    else:
+        trip_factors = None
+        num_trips = num_rows(input_file)
+
+    if sink == 'sqlite':
+        # Processes send their trips through a bounded queue to a single writer
+        queue = multiprocessing.Queue(maxsize=4 * processes)
+        completed = prepare_sqlite_sink(settings.get_sqlite_settings(), resume, overwrite)
+    else:
+        queue = None
+        if resume:
+            completed = load_checkpoints(output_dir)
+        else:
+            # Start from scratch, discarding anything left by an interrupted run
+            cleanup(run_files(output_dir, 'temp') + run_files(output_dir, 'journal'))
+            completed = set()
+
+    # Rather than each process being given a fixed slice of the file, processes take
+    # small batches of trips from a shared counter until none are left, so faster
+    # processes take on more of the work. Each batch is sent to whichever OTP
+    # instance the balancer expects to respond soonest.
+    host_urls = [f"http://{host}:{str(port + i)}" for i in range(otps)]
+    balancer = OTPBalancer(host_urls)
+    if cache_file:
+        if graph_version is None:
+            graph_version = otp.graph_version(host_urls[0], timeout=timeout)
+        # Opening the cache once up front empties it if the graph has changed, before
+        # any process starts using it
+        with OTPResponseCache(cache_file, graph_version) as cache:
+            logging.info(f'Using cache {cache_file} of {len(cache)} trips routed on graph version {graph_version}')
+    next_trip_counter = multiprocessing.Value('l', 0)
+    args = [(i, input_file, output_dir, mode, concurrency) for i in range(processes)]
+    # Shared memory int variable to keep track of total rows done
+    rows_complete = multiprocessing.Value('i', len(completed))
+    logging.info(f'Using a pool of {processes} workers in {mode} mode')
+    pool_size = concurrency if mode == 'async' else 1
+    # Distribute the OTP processing between processes. Each process returns
+    # the path to the file it wrote its results to.
+    start = time.time()
+    initargs = (num_trips, rows_complete, next_trip_counter, balancer, completed, queue)
+    with multiprocessing.Pool(int(processes), initializer=init, initargs=initargs) as pool:
+        if sink == 'sqlite':
+            async_result = pool.starmap_async(compute_trips, args, chunksize=1)
+            # Opened once the processes have been forked, so none of them inherit the connection.
+            # Trips generated from their factors are summarised by the factors' keys,
+            # so otp_trips and trip_strata are not needed
+            with SQLiteResultsWriter(settings.get_sqlite_settings(), trip_factors=trip_factors) as sqlite_writer:
+                write_results_to_sqlite(async_result, queue, sqlite_writer, len(args))
+            results = async_result.get()
+            logging.info((
+                f'{sqlite_writer.rows_written} trips written to SQLite, '
+                f'and {sqlite_writer.unrouted_written} trips OTP found no route for.'
+            ))
+        else:
+            results = pool.starmap(compute_trips, args, chunksize=1)
+    end = time.time()
+    elapsed = end - start
+    logging.info(f"{(elapsed / 60.0):.2f} min elapsed.")
+    bad_rows = 0
+    for f, rows in results:
+        bad_rows += rows
+    if bad_rows > 0:
+        logging.warning(f"{bad_rows} trips were lost during OTP processing ({(bad_rows/num_trips * 100):.2f}%).")
+    if sink == 'sqlite':
+        return []
+    # Includes the files of processes from a previous run, if there were more of them
+    return run_files(output_dir, 'temp')
+
+
+def copy_remaining_bytes(src, dst) -> None:
+    '''Copy the rest of the src file to dst, within the kernel where the OS allows it'''
+    dst.flush()
+    offset = src.tell()
+    remaining = os.fstat(src.fileno()).st_size - offset
+    if hasattr(os, 'sendfile'):
+        try:
+            while remaining > 0:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset, remaining)
+                if sent == 0:
+                    break
+                offset += sent
+                remaining -= sent
+            return
+        except OSError:
+            # Some platforms can only sendfile to a socket. Fall back unless
+            # part of the file has already been copied.
+            if offset != src.tell():
+                raise
+    shutil.copyfileobj(src, dst, MERGE_BUFFER_SIZE)
+
+
+def combine_complete_files(output_dir, files, sort=False):
+    '''
+    Combine the individual files produced by each process into a single main file.
+    The files are concatenated as bytes, keeping only the header of the first file,
+    or merged in order of trip ID if `sort` is set.
+    '''
+    output_file_name = os.path.join(output_dir, 'results_full.csv')
+    logging.info("Combining results to: " + output_file_name)
+    if sort:
+        merge_sorted_files(files, output_file_name, 'trip_id')
+        return output_file_name
+    header_written = False
+    with open(output_file_name, 'wb') as output_file:
+        for csv_file in files:
+            with open(csv_file, 'rb') as f:
+                header = f.readline()
+                # Files of processes which never got a batch may be empty
+                if not header:
+                    continue
+                if not header_written:
+                    output_file.write(header)
+                    header_written = True
+                copy_remaining_bytes(f, output_file)
+    return output_file_name
+
+
+def merge_sorted_files(files, output_file_name, key_column):
+    """
+    Merge CSV files into a single file sorted by an integer column. This is an external
+    sort: the files are split into runs of at most SORT_RUN_SIZE lines which are sorted in
+    memory and written to disk, then the runs are combined with a k-way merge. Lines are
+    split on commas without parsing, which is safe for the results of OTP processing as
+    none of their values are quoted.
+    """
+    run_dir = tempfile.mkdtemp(dir=os.path.dirname(output_file_name))
+    header = None
+    runs = []
+    try:
+        for csv_file in files:
+            with open(csv_file, 'rb') as f:
+                file_header = f.readline()
+                if not file_header:
+                    continue
+                if header is None:
+                    header = file_header
+                    key_index = header.rstrip(b'\r\n').split(b',').index(key_column.encode('utf-8'))
+
+                    def key(line):
+                        return int(line.split(b',', key_index + 1)[key_index].rstrip(b'\r\n'))
+
+                for lines in iter(lambda: list(itertools.islice(f, SORT_RUN_SIZE)), []):
+                    lines.sort(key=key)
+                    run_file = os.path.join(run_dir, f'run_{len(runs)}.csv')
+                    with open(run_file, 'wb') as run:
+                        run.writelines(lines)
+                    runs.append(run_file)
+        with open(output_file_name, 'wb') as output_file:
+            if header is None:
+                return
+            output_file.write(header)
+            sorted_runs = [open(run_file, 'rb', buffering=MERGE_BUFFER_SIZE // max(len(runs), 1)) for run_file in runs]
+            try:
+                output_file.writelines(heapq.merge(*sorted_runs, key=key))
+            finally:
+                for run in sorted_runs:
+                    run.close()
+    finally:
+        shutil.rmtree(run_dir)
+
+
+def cleanup(complete_files):
+    '''Delete the temp files produced by each process'''
+    logging.info("Cleaning up...")
+    for f in complete_files:
+        os.remove(f)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO, datefmt='%Y-%m-%d %H:%M:%S')
+    args = parse_input_args()
+    # Input CSV MUST HAVE HEADERS - these are included by default by the ETL process
+    input_csv = args['file']
+    check_input_file_exists(input_csv, args['factors'])
+    ROOT_FOLDER = settings.get_root_dir()
+    output_dir = os.path.join(ROOT_FOLDER, 'results/')
+    complete_files = split_trips(
+        input_csv,
+        output_dir,
+        mode=args['mode'],
+        concurrency=args['concurrency'],
+        timeout=args['timeout'],
+        retries=args['retries'],
+        trips_per_batch=args['batch_size'],
+        resume=args['resume'],
+        trips_per_checkpoint=args['checkpoint_interval'],
+        sink=args['sink'],
+        response_format=args['format'],
+        cache_file=args['cache'],
+        graph_version=args['graph_version'],
+        factors=args['factors'],
+        overwrite=args['overwrite']
+    )
+    if args['sink'] == 'csv':
+        combine_complete_files(output_dir, complete_files, sort=args['sort'])
+        # The journals are only needed until the results have been combined
+        cleanup(complete_files + run_files(output_dir, 'journal'))
+    logging.info("Done!")
@@ -1,17 +1,6 @@
-DROP TABLE IF EXISTS model.k_poi;
+INSERT INTO model.k_poi
 
-CREATE TABLE IF NOT EXISTS model.k_poi AS (
-
-    WITH poi AS (
-        SELECT
-            id as poi_id,
-            type as poi_type,
-            snapped_latitude as poi_latitude,
-            snapped_longitude as poi_longitude,
-            snapped_location::geography AS poi_location
-        FROM semantic.poi),
-
-    oa_ptype AS (
+    WITH oa_ptype AS (
         SELECT
             oa11 AS oa_id,
             centroid::geography AS oa_centroid,
@@ -26,15 +15,26 @@ CREATE TABLE IF NOT EXISTS model.k_poi AS (
 
     SELECT
         oa_ptype.oa_id, oa_ptype.oa_centroid,
-        p.*,
+        p.poi_id, p.poi_type, p.poi_latitude, p.poi_longitude, p.poi_location, p.rank,
         ST_Distance(oa_ptype.oa_centroid, p.poi_location) AS distance
     FROM oa_ptype
     CROSS JOIN LATERAL (
+        -- Ranked after the LIMIT, so that the nearest POIs are read in order from
+        -- poi_location_geography_idx rather than every POI of the type being ranked
         SELECT
-            poi.*,
-            RANK() OVER (ORDER BY poi.poi_location <-> oa_ptype.oa_centroid) AS rank
-        FROM poi
-        WHERE oa_ptype.poi_type=poi.poi_type
-    ) AS p
-    WHERE rank <= poi_K
-);
+            nearest.*,
+            ROW_NUMBER() OVER (ORDER BY nearest.knn_distance) AS rank
+        FROM (
+            SELECT
+                id AS poi_id,
+                type AS poi_type,
+                snapped_latitude AS poi_latitude,
+                snapped_longitude AS poi_longitude,
+                snapped_location::geography AS poi_location,
+                snapped_location::geography <-> oa_ptype.oa_centroid AS knn_distance
+            FROM semantic.poi
+            WHERE type = oa_ptype.poi_type
+            ORDER BY snapped_location::geography <-> oa_ptype.oa_centroid
+            LIMIT oa_ptype.poi_K
+        ) AS nearest
+    ) AS p;
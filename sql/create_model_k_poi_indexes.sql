@@ -0,0 +1,6 @@
+CREATE INDEX IF NOT EXISTS poi_type_idx ON semantic.poi (type);
+
+-- The K nearest query orders by distance between geographies, so the index must be on the same expression
+CREATE INDEX IF NOT EXISTS poi_location_geography_idx ON semantic.poi USING GIST ((snapped_location::geography));
+
+ANALYZE semantic.poi;
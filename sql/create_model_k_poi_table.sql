@@ -0,0 +1,14 @@
+DROP TABLE IF EXISTS model.k_poi;
+
+-- Same columns as the table built by create_model_k_poi.sql, for rows computed outside the database
+CREATE TABLE model.k_poi (
+    oa_id varchar,
+    oa_centroid geography,
+    poi_id integer,
+    poi_type varchar,
+    poi_latitude float,
+    poi_longitude float,
+    poi_location geography,
+    rank bigint,
+    distance float
+);
@@ -225,6 +225,7 @@ CREATE TABLE `otp_results`
  `fare`               text NULL ,
 CONSTRAINT `otp_results_ibfk_1` FOREIGN KEY (`trip_id`) REFERENCES `trip_strata` (`trip_id`)
 );
+CREATE TABLE otp_unrouted(trip_id bigint(20) PRIMARY KEY);
 CREATE TABLE populations(oa_id varchar(10), population text, count integer);
 CREATE TABLE otp_results_summary(
   oa_id TEXT,
@@ -236,3 +237,7 @@ CREATE TABLE otp_results_summary(
   sum_fare,
   sum_generalised_cost
 );
+CREATE INDEX otp_results_summary_poi_type_stratum_oa_id ON otp_results_summary(poi_type, stratum, oa_id);
+CREATE UNIQUE INDEX otp_results_summary_key ON otp_results_summary(oa_id, poi_type, stratum);
+CREATE INDEX populations_population_oa_id ON populations(population, oa_id, count);
+CREATE INDEX populations_oa_id ON populations(oa_id, population, count);
@@ -87,6 +87,33 @@ def test_accessibility_metrics(client):
                     pytest.fail()
 
 
+def test_batch(client):
+    demographics = fetch_expected("SELECT DISTINCT population FROM populations WHERE population <> 'total'")
+    queries = [
+        {'endpoint': 'population-metrics', 'population-metric': 'at-risk_score', 'demographic-group': [demographic]}
+        for demographic in demographics
+    ]
+    queries.append({'endpoint': 'accessibility-metrics', 'accessibility-metric': 'fare'})
+    queries.append({'endpoint': 'accessibility-metrics', 'accessibility-metric': 'unknown'})
+    response = json.loads(client.post('/batch', json=queries).data)
+    assert expected_number_of_results(queries, response['results'])
+
+    for (demographic, result) in zip(demographics, response['results']):
+        single = client.get(f'/population-metrics?population-metric=at-risk_score&demographic-group={demographic}')
+        assert result == json.loads(single.data)
+    assert response['results'][-2] == json.loads(client.get('/accessibility-metrics?accessibility-metric=fare').data)
+    assert response['results'][-1] == {'error': 'Not found'}
+    assert client.post('/batch', json={'endpoint': 'population-metrics'}).status_code == 400
+    for bad_filter in (['a', 1], [['a']], 1, {'a': 'b'}):
+        query = {'endpoint': 'population-metrics', 'population-metric': 'at-risk_score', 'time-strata': bad_filter}
+        assert client.post('/batch', json=[query]).status_code == 400
+    for bad_parameter in ({'endpoint': ['population-metrics']},
+                          {'endpoint': 'accessibility-metrics', 'accessibility-metric': ['fare']},
+                          {'endpoint': 'population-metrics', 'population-metric': 1},
+                          {'endpoint': 'accessibility-metrics', 'format': {'json': True}}):
+        assert client.post('/batch', json=[bad_parameter]).status_code == 400
+
+
 def verify_response_against_query(response, sql_query):
     query_results = fetch_expected(sql_query)
 
@@ -1,5 +1,29 @@
+import datetime
+import json
+import os
+import queue
+import sqlite3
+import numpy as np
+import pandas as pd
 import pytest
+import sqlalchemy
+from app.cache import ResponseCache
+from app.cube import SummaryCube, SummaryCubeTooLarge, cube_nbytes
+from app.instrumentation import Histogram
+from app.geometry import OutputAreaGeometry, Representation, to_topojson
 from app.utils import *
+from benchmark.otp_parsers import CapturedResponse
+from modelling import open_trip_planner as otp
+from modelling import spatial
+from modelling.model_functions import sample_timestamps
+from modelling.otp_cache import OTPResponseCache, cache_key
+from modelling.trip_factors import TripFactors
+import run_otp_processing
+from run_otp_processing import (CheckpointJournal, QueueWriter, journal_file_path, load_checkpoints,
+                                merge_sorted_files, prepare_sqlite_sink, temp_file_path)
+from upload_csv_to_sqlite import SQLiteResultsWriter, copy_text_to_sqlite
+from utils.utils import date_range, day_calendar, uk_holidays
+from utils.csv_index import CsvIndex, CsvIndexWriter, build_csv_index, index_path, open_csv_index
 
 
 def test_get_key_value_pairs():
@@ -90,6 +114,21 @@ def test_add_rank():
         add_rank([])
 
 
+def test_rank_columns():
+    columns = rank_columns(['E001', 'E003', 'E002', 'E004'], [0, 10, 5, 5])
+    assert columns['oa_id'] == ['E001', 'E003', 'E002', 'E004']
+    assert list(columns['metric']) == [0, 10, 5, 5]
+    # Equal metrics are ranked in input order, as in add_rank
+    assert list(columns['rank']) == [1, 4, 2, 3]
+    assert list(rank_columns([], [])['rank']) == []
+    assert list(rank_columns(['E001', 'E002'], [None, 1.0])['rank']) == [2, 1]
+
+
+def test_dumps_columnar():
+    columns = rank_columns(['E001', 'E002'], [None, 1.5])
+    assert json.loads(dumps_columnar(columns)) == {'oa_id': ['E001', 'E002'], 'metric': [None, 1.5], 'rank': [2, 1]}
+
+
 def test_sort_by_value():
     example_metrics = {
         'E001' : 0,
@@ -98,3 +137,620 @@ def test_sort_by_value():
     }
     expected_order = [('E001', 0), ('E002', 5), ('E003', 10)]
     assert list(sort_by_value(example_metrics)) == expected_order
+
+
+def test_response_cache():
+    version = [0]
+    cache = ResponseCache(lambda: version[0], max_entries=2, max_bytes=10)
+    assert cache.get_or_compute('a', lambda: b'aaa') == b'aaa'
+    assert cache.get_or_compute('a', lambda: b'new') == b'aaa'
+    cache.get_or_compute('b', lambda: b'bbb')
+    cache.get_or_compute('a', lambda: b'new')
+    # 'b' is the least recently used, so is evicted by 'c'
+    cache.get_or_compute('c', lambda: b'ccc')
+    assert cache.get_or_compute('b', lambda: b'new') == b'new'
+    assert cache.get_or_compute('c', lambda: b'new') == b'ccc'
+    # Responses larger than the cache and None are never cached
+    assert cache.get_or_compute('d', lambda: b'd' * 11) == b'd' * 11
+    assert cache.get_or_compute('d', lambda: None) is None
+    assert cache.get_or_compute('d', lambda: b'ddd') == b'ddd'
+    # Entries are dropped when the data version changes
+    version[0] += 1
+    assert cache.get_or_compute('d', lambda: b'new') == b'new'
+    assert len(cache) == 1
+
+
+def test_histogram():
+    histogram = Histogram('latency_seconds', 'Latency', ('endpoint',), buckets=(0.1, 1.0))
+    histogram.observe(0.05, '/a')
+    histogram.observe(0.1, '/a')
+    histogram.observe(5.0, '/a')
+    histogram.observe(0.5, 'say "hi"')
+    assert histogram.render().splitlines() == [
+        '# HELP latency_seconds Latency',
+        '# TYPE latency_seconds histogram',
+        'latency_seconds_bucket{endpoint="/a",le="0.1"} 2',
+        'latency_seconds_bucket{endpoint="/a",le="1.0"} 2',
+        'latency_seconds_bucket{endpoint="/a",le="+Inf"} 3',
+        'latency_seconds_sum{endpoint="/a"} 5.15',
+        'latency_seconds_count{endpoint="/a"} 3',
+        'latency_seconds_bucket{endpoint="say \\"hi\\"",le="0.1"} 0',
+        'latency_seconds_bucket{endpoint="say \\"hi\\"",le="1.0"} 1',
+        'latency_seconds_bucket{endpoint="say \\"hi\\"",le="+Inf"} 1',
+        'latency_seconds_sum{endpoint="say \\"hi\\""} 0.5',
+        'latency_seconds_count{endpoint="say \\"hi\\""} 1',
+    ]
+
+
+def test_summary_cube():
+    columns = ['oa_id', 'poi_type', 'stratum', 'num_trips', 'sum_fare', 'sum_of_squared_fare']
+    rows = [
+        ('E001', 'School', 'AM', 2, 4.0, 10.0),
+        ('E001', 'Hospital', 'PM', 1, 3.0, 9.0),
+        ('E002', 'School', 'PM', 4, 2.0, 1.0),
+    ]
+    populations = [('E001', 'total', 10), ('E002', 'total', 30), ('E001', 'white', 5), ('E002', 'white', 10)]
+    cube = SummaryCube(columns, rows, populations)
+    assert cube.has_metric('fare') and not cube.has_metric('journey_time')
+
+    oa_ids, metrics = cube.access_metric('fare', [], [])
+    assert dict(zip(oa_ids, metrics)) == {'E001': 7.0 / 3, 'E002': 0.5}
+    oa_ids, metrics = cube.access_metric('fare', ['School'], ['AM'])
+    assert dict(zip(oa_ids, metrics)) == {'E001': 2.0}
+    assert len(cube.access_metric('fare', ['Unknown'], [])[0]) == 0
+
+    assert cube.high_level_totals('fare', ['School'], []) == (6.0, 11.0, 6.0)
+    assert cube.demographic_totals('fare', ['School'], ['PM']) == {
+        'total': {'sum_d': 30.0, 'sum_a_d': 15.0},
+        'white': {'sum_d': 10.0, 'sum_a_d': 5.0},
+    }
+    assert list(cube.population_density(['white'])) == [5.0, 10.0]
+    assert cube.oas_by_total_population == [('E002', 30), ('E001', 10)]
+
+
+def test_summary_cube_max_bytes():
+    engine = sqlalchemy.create_engine('sqlite://')
+    engine.execute("""CREATE TABLE otp_results_summary(oa_id TEXT, poi_type TEXT, stratum TEXT, num_trips INTEGER,
+                                                       sum_fare REAL, sum_of_squared_fare REAL)""")
+    engine.execute("CREATE TABLE populations(oa_id TEXT, population TEXT, count INTEGER)")
+    for row in [('E001', 'School', 'AM', 2, 4.0, 10.0), ('E001', 'Hospital', 'PM', 1, 3.0, 9.0),
+                ('E002', 'School', 'PM', 4, 2.0, 1.0)]:
+        engine.execute("INSERT INTO otp_results_summary VALUES (?, ?, ?, ?, ?, ?)", row)
+    # 2 OAs, 2 POI types and 2 strata, with a row count and 3 sum columns
+    nbytes = cube_nbytes(2, 2, 2, 6)
+    assert nbytes == 8 * 4 * 8
+
+    cube = SummaryCube.from_database(engine.execute, max_bytes=nbytes)
+    assert cube.high_level_totals('fare', [], []) == (9.0, 20.0, 7.0)
+    assert SummaryCube.from_database(engine.execute).high_level_totals('fare', [], []) == (9.0, 20.0, 7.0)
+    with pytest.raises(SummaryCubeTooLarge):
+        SummaryCube.from_database(engine.execute, max_bytes=nbytes - 1)
+
+
+def test_summary_cube_at_risk_scores():
+    columns = ['oa_id', 'poi_type', 'stratum', 'num_trips', 'sum_generalised_cost']
+    rows = [
+        ('E001', 'School', 'AM', 2, 8.0),
+        ('E002', 'School', 'AM', 4, 4.0),
+        ('E003', 'School', 'AM', 1, 100.0),
+    ]
+    populations = [
+        ('E001', 'total', 10), ('E002', 'total', 30), ('E003', 'total', 5),
+        ('E001', 'white', 4), ('E002', 'white', 0), ('E001', 'asian', 6), ('E002', 'asian', 30),
+    ]
+    cube = SummaryCube(columns, rows, populations)
+    # Only the most populated half of the OAs, plus one, are scored
+    [white, both, everyone] = cube.at_risk_scores([['white'], ['white', 'asian'], []], [], [])
+    assert dict(zip(*white)) == {'E001': 1.0}
+    assert dict(zip(*both)) == {'E002': 1.0 / 30, 'E001': 0.4}
+    assert dict(zip(*everyone)) == {'E002': 1.0 / 60, 'E001': 0.2}
+    assert len(cube.at_risk_scores([['white']], ['Unknown'], [])[0][0]) == 0
+
+
+def test_to_topojson():
+    ring = [[0.0, 0.0], [1.0, 0.0], [1.0, 1.0], [1.0, 1.0], [0.0, 0.0]]
+    geo_json = {'type': 'FeatureCollection', 'features': [
+        {'type': 'Feature', 'id': 'E001', 'properties': {}, 'geometry': {'type': 'Polygon', 'coordinates': [ring]}},
+        {'type': 'Feature', 'id': 'E002', 'properties': {'name': 'two'},
+         'geometry': {'type': 'MultiPolygon', 'coordinates': [[ring], [ring]]}},
+    ]}
+    topology = to_topojson(geo_json, quantization=11)
+    assert topology['transform'] == {'scale': [0.1, 0.1], 'translate': [0.0, 0.0]}
+    # Delta-encoded, with the repeated point dropped
+    assert topology['arcs'][0] == [[0, 0], [10, 0], [0, 10], [-10, -10]]
+    assert len(topology['arcs']) == 3
+    geometries = topology['objects']['output_areas']['geometries']
+    assert geometries[0] == {'type': 'Polygon', 'arcs': [[0]], 'id': 'E001'}
+    assert geometries[1] == {'type': 'MultiPolygon', 'arcs': [[[1]], [[2]]], 'id': 'E002', 'properties': {'name': 'two'}}
+
+
+def test_output_area_geometry_preload(tmp_path):
+    path = str(tmp_path / 'geo_simp.json')
+    with open(path, 'w') as json_file:
+        json.dump({'type': 'FeatureCollection', 'features': [
+            {'type': 'Feature', 'id': 'E001', 'properties': {},
+             'geometry': {'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]}}
+        ]}, json_file)
+    geometry = OutputAreaGeometry(path)
+    geometry.preload()
+    # Every encoding of the default variant is ready, and other variants are left until asked for
+    assert set(geometry._representations) == {'geojson'}
+    assert set(geometry.representation('geojson')._bodies) == set(Representation.ENCODINGS)
+    assert json.loads(geometry.representation('geojson').body('identity'))['features'][0]['id'] == 'E001'
+
+
+def test_k_nearest_by_type():
+    oas = pd.DataFrame({'oa_id': ['E001', 'E002'], 'latitude': [52.0, 53.0], 'longitude': [-2.0, -2.0]})
+    pois = pd.DataFrame({
+        'poi_id': [1, 2, 3, 4],
+        'type': ['Hospital', 'Hospital', 'School', 'Other'],
+        'latitude': [52.1, 53.1, 52.5, 52.0],
+        'longitude': [-2.0, -2.0, -2.0, -2.0]
+    })
+    nearest = spatial.k_nearest_by_type(oas, pois, {'Hospital': 2, 'School': 3})
+    assert list(zip(nearest.oa_id, nearest.poi_id, nearest['rank'])) == [
+        ('E001', 1, 1), ('E001', 2, 2), ('E002', 2, 1), ('E002', 1, 2), ('E001', 3, 1), ('E002', 3, 1)
+    ]
+    # 0.1 degrees of latitude
+    assert nearest.distance[0] == pytest.approx(11119.5, abs=0.1)
+    distances, indexes = spatial.NearestNeighbours(pois.latitude, pois.longitude).query(oas.latitude, oas.longitude, 3)
+    assert indexes.tolist() == [[3, 0, 2], [1, 2, 0]]
+    assert distances[0].tolist() == pytest.approx([0.0, 11119.5, 55597.5], abs=0.1)
+
+
+def test_nearest_neighbours_brute_force(monkeypatch):
+    # The fallback used when scipy is not installed
+    monkeypatch.setattr(spatial, 'cKDTree', None)
+    index = spatial.NearestNeighbours([52.1, 53.1, 52.5, 52.0], [-2.0, -2.0, -2.0, -2.0])
+    assert index.tree is None
+    distances, indexes = index.query([52.0, 53.0], [-2.0, -2.0], 3)
+    assert indexes.tolist() == [[3, 0, 2], [1, 2, 0]]
+    assert distances[0].tolist() == pytest.approx([0.0, 11119.5, 55597.5], abs=0.1)
+    distances, indexes = index.query([52.0], [-2.0], 10)
+    assert indexes.tolist() == [[3, 0, 2, 1]]
+
+
+def test_nearest_neighbours_kd_tree_matches_brute_force():
+    pytest.importorskip('scipy')
+    rng = np.random.RandomState(0)
+    lat, lon = rng.uniform(52.3, 52.7, 500), rng.uniform(-2.2, -1.7, 500)
+    origin_lat, origin_lon = rng.uniform(52.3, 52.7, 200), rng.uniform(-2.2, -1.7, 200)
+    index = spatial.NearestNeighbours(lat, lon)
+    assert index.tree is not None
+    distances, indexes = index.query(origin_lat, origin_lon, 5)
+    chords, brute_force = index._brute_force(spatial.to_unit_sphere(origin_lat, origin_lon), 5)
+    assert brute_force.tolist() == indexes.tolist()
+    assert spatial.chord_to_metres(chords) == pytest.approx(distances)
+
+
+def test_trip_factors():
+    factors = TripFactors(
+        oas=[{'oa_id': 'E001', 'oa_lat': '52.0', 'oa_lon': '-2.0'}, {'oa_id': 'E002', 'oa_lat': '53.0', 'oa_lon': '-2.0'}],
+        pois=[{'poi_id': '7', 'poi_type': 'Hospital', 'poi_lat': '52.1', 'poi_lon': '-2.1'}],
+        k_poi=[{'oa_id': 'E002', 'poi_id': '7'}, {'oa_id': 'E001', 'poi_id': '7'}],
+        timestamps=[{'stratum': 'AM', 'date': '2021-01-05', 'time': '08:00'},
+                    {'stratum': 'PM', 'date': '2021-01-05', 'time': '17:00'},
+                    {'stratum': 'PM', 'date': '2021-01-06', 'time': '18:30'}]
+    )
+    assert len(factors) == 6
+    assert [trip['trip_id'] for trip in factors] == ['1', '2', '3', '4', '5', '6']
+    trip = factors.trip(factors.trip_id(1, 2))
+    assert trip == {'oa_id': 'E001', 'poi_id': '7', 'date': '2021-01-06', 'time': '18:30', 'trip_id': '6',
+                    'oa_lat': '52.0', 'oa_lon': '-2.0', 'poi_lat': '52.1', 'poi_lon': '-2.1',
+                    'poi_type': 'Hospital', 'stratum': 'PM'}
+    assert factors.read(2, 10) == list(factors)[2:]
+    with pytest.raises(IndexError):
+        factors.trip(7)
+
+
+def test_copy_text_to_sqlite(tmp_path):
+    path = str(tmp_path / 'test.db')
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE results(trip_id bigint(20), name text, fare double, total)")
+    conn.execute("CREATE INDEX results_name ON results(name)")
+    conn.execute("INSERT INTO results VALUES (0, 'existing', 0.5, 1)")
+    conn.commit()
+    csv_file = tmp_path / 'results.csv'
+    csv_file.write_text('trip_id,name,fare,total\n1,a,1.5,10\n2,,,2.5\n3.0,c,3,\n4,d,4,x\n5,e,5,7\n')
+
+    assert copy_text_to_sqlite(str(csv_file), 'results', path, chunksize=2) == 5
+    rows = conn.execute(
+        "SELECT trip_id, typeof(trip_id), name, fare, typeof(fare), total, typeof(total) FROM results ORDER BY trip_id"
+    ).fetchall()
+    assert rows == [
+        (0, 'integer', 'existing', 0.5, 'real', 1, 'integer'),
+        (1, 'integer', 'a', 1.5, 'real', 10, 'integer'),
+        (2, 'integer', None, None, 'null', 2.5, 'real'),
+        (3, 'integer', 'c', 3.0, 'real', None, 'null'),
+        (4, 'integer', 'd', 4.0, 'real', 'x', 'text'),
+        (5, 'integer', 'e', 5.0, 'real', 7, 'integer'),
+    ]
+    # Untyped columns hold numbers, so are summed and sorted as numbers
+    assert conn.execute("SELECT sum(total) FROM results").fetchone() == (20.5,)
+    # Indexes are rebuilt after the load
+    assert conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'").fetchall() == [('results_name',)]
+    assert conn.execute("PRAGMA user_version").fetchone() == (1,)
+
+    assert copy_text_to_sqlite(str(csv_file), 'results', path, chunksize=3, replace=True) == 5
+    assert conn.execute("SELECT count(*) FROM results").fetchone() == (5,)
+    conn.close()
+
+
+def results_database(tmp_path):
+    """A SQLite database with the schema of the app, and two OAs' trips to a school in two strata"""
+    path = str(tmp_path / 'results.db')
+    conn = sqlite3.connect(path)
+    with open(os.path.join(os.path.dirname(__file__), '..', 'sql', 'sqlite', 'schema.sql')) as schema:
+        conn.executescript(schema.read())
+    conn.execute("INSERT INTO poi (poi_id, type) VALUES (1, 'School')")
+    for trip_id in range(1, 5):
+        conn.execute("INSERT INTO otp_trips (oa_id, poi_id, trip_id) VALUES (?, 1, ?)", (f'E00{(trip_id + 1) // 2}', trip_id))
+        conn.execute("INSERT INTO trip_strata (trip_id, stratum) VALUES (?, ?)", (trip_id, 'AM' if trip_id % 2 else 'PM'))
+    conn.commit()
+    conn.close()
+    return path
+
+
+def otp_trip(trip_id, total_time):
+    return {'trip_id': str(trip_id), 'total_time': total_time, 'walk_dist': 100.0, 'fare': 0,
+            'initial_wait_time': 3600, 'transit_time': 0, 'num_transfers': 0}
+
+
+def test_sqlite_results_writer(tmp_path):
+    path = results_database(tmp_path)
+    with SQLiteResultsWriter(path, batch_size=2) as writer:
+        assert not writer.has_results()
+        writer.write([otp_trip(1, 60)])
+        writer.write([otp_trip(2, 120)], unrouted=['4'])
+        writer.write([otp_trip(3, 180)])
+    conn = sqlite3.connect(path)
+    # The batches of trips 1, 2 and 3 are added to the summary in two flushes
+    assert conn.execute(
+        "SELECT oa_id, stratum, num_trips, sum_journey_time FROM otp_results_summary ORDER BY oa_id, stratum"
+    ).fetchall() == [('E001', 'AM', 1, 60), ('E001', 'PM', 1, 120), ('E002', 'AM', 1, 180)]
+    assert conn.execute("SELECT trip_id FROM otp_unrouted").fetchall() == [(4,)]
+    # Bumped once, when the writer was closed
+    assert conn.execute("PRAGMA user_version").fetchone() == (1,)
+
+    with SQLiteResultsWriter(path) as writer:
+        assert writer.has_results()
+        assert writer.completed_trip_ids() == {'1', '2', '3', '4'}
+        # Trips already written are not counted again, but new trips add to the summary
+        writer.write([otp_trip(1, 60), otp_trip(3, 180)])
+        conn.execute("INSERT INTO otp_trips (oa_id, poi_id, trip_id) VALUES ('E002', 1, 5)")
+        conn.execute("INSERT INTO trip_strata (trip_id, stratum) VALUES (5, 'AM')")
+        conn.commit()
+        writer.write([otp_trip(5, 240)])
+    assert conn.execute(
+        "SELECT num_trips, sum_journey_time FROM otp_results_summary WHERE oa_id = 'E002' AND stratum = 'AM'"
+    ).fetchall() == [(2, 420)]
+    assert conn.execute("SELECT count(*) FROM otp_results_summary").fetchone() == (3,)
+
+    with SQLiteResultsWriter(path) as writer:
+        writer.clear()
+        assert not writer.has_results()
+        assert writer.completed_trip_ids() == set()
+    assert conn.execute("SELECT count(*) FROM otp_results_summary").fetchone() == (0,)
+    conn.close()
+
+
+def test_sqlite_results_writer_trip_factors(tmp_path):
+    path = results_database(tmp_path)
+    factors = TripFactors(
+        oas=[{'oa_id': 'E009', 'oa_lat': '52.0', 'oa_lon': '-2.0'}],
+        pois=[{'poi_id': '7', 'poi_type': 'Hospital', 'poi_lat': '52.1', 'poi_lon': '-2.1'}],
+        k_poi=[{'oa_id': 'E009', 'poi_id': '7'}],
+        timestamps=[{'stratum': 'AM', 'date': '2021-01-05', 'time': '08:00'},
+                    {'stratum': 'PM', 'date': '2021-01-05', 'time': '17:00'}]
+    )
+    # The summary keys come from the factors rather than otp_trips and trip_strata
+    with SQLiteResultsWriter(path, trip_factors=factors) as writer:
+        writer.write([otp_trip(1, 60), otp_trip(2, 120)])
+    conn = sqlite3.connect(path)
+    assert conn.execute(
+        "SELECT oa_id, poi_type, stratum, num_trips, sum_journey_time FROM otp_results_summary ORDER BY stratum"
+    ).fetchall() == [('E009', 'Hospital', 'AM', 1, 60), ('E009', 'Hospital', 'PM', 1, 120)]
+    conn.close()
+
+
+def test_prepare_sqlite_sink(tmp_path):
+    path = results_database(tmp_path)
+    assert prepare_sqlite_sink(path) == set()
+    with SQLiteResultsWriter(path) as writer:
+        writer.write([otp_trip(1, 60)], unrouted=['2'])
+    # Existing results are neither kept nor deleted without being asked to
+    with pytest.raises(SystemExit):
+        prepare_sqlite_sink(path)
+    assert prepare_sqlite_sink(path, resume=True) == {'1', '2'}
+    assert prepare_sqlite_sink(path, overwrite=True) == set()
+    assert prepare_sqlite_sink(path, resume=True) == set()
+
+
+def test_queue_writer():
+    results = queue.Queue()
+    writer = QueueWriter(results)
+    writer.writerow(otp_trip(1, 60))
+    writer.add('1')
+    # Added to the journal without having been written: OTP found no route
+    writer.add('2')
+    writer.writerow(otp_trip(3, 60))
+    writer.add('3')
+    writer.close()
+    trips, unrouted = results.get()
+    assert [trip['trip_id'] for trip in trips] == ['1', '3']
+    assert unrouted == ['2']
+    assert results.get() is None
+
+
+def test_csv_index(tmp_path):
+    csv_file = str(tmp_path / 'trips.csv')
+    rows = ['trip_id,oa_id\n', '1,E00045000\n', '2,E00045001\n', '3,E00045002']
+    with open(csv_file, 'wb') as output, open(index_path(csv_file), 'wb') as index_file:
+        writer = CsvIndexWriter(output, index_file)
+        # Rows split across writes, as they are by a database export
+        for chunk in ('trip_id,oa', '_id\n1,E00045000\n2,E0004', '5001\n3,E00045002'):
+            writer.write(chunk)
+        writer.close()
+
+    index = CsvIndex(csv_file)
+    assert index.num_rows == 3
+    with open(csv_file, 'rb') as src:
+        start, end = index.byte_range(1, 3)
+        src.seek(start)
+        assert src.read(end - start).decode() == rows[2] + rows[3]
+    with open(index_path(csv_file), 'rb') as index_file:
+        written = index_file.read()
+    assert build_csv_index(csv_file) == 3
+    with open(index_path(csv_file), 'rb') as index_file:
+        assert index_file.read() == written
+
+    # An edit which changes the size of the file
+    with open(csv_file, 'a') as output:
+        output.write('\n4,E00045003\n')
+    with pytest.raises(ValueError):
+        CsvIndex(csv_file)
+    assert open_csv_index(csv_file).num_rows == 4
+
+    # An edit which keeps the size of the file, made after the index was written
+    with open(csv_file, 'r+') as output:
+        output.write('oa_id,trip_id')
+    index_stat = os.stat(index_path(csv_file))
+    os.utime(csv_file, ns=(index_stat.st_atime_ns, index_stat.st_mtime_ns + 1))
+    with pytest.raises(ValueError):
+        CsvIndex(csv_file)
+    assert open_csv_index(csv_file).num_rows == 4
+
+    with pytest.raises(FileNotFoundError):
+        CsvIndex(str(tmp_path / 'missing.csv'))
+
+
+def test_checkpoint_journal(tmp_path):
+    output_dir = str(tmp_path)
+    with open(temp_file_path(output_dir, 0), 'a') as output:
+        journal = CheckpointJournal(journal_file_path(output_dir, 0), output, 2)
+        output.write('header\n')
+        for trip_id in ('1', '2', '3'):
+            output.write(f'trip {trip_id}\n')
+            journal.add(trip_id)
+        # Trip 3 is in the output file but was not checkpointed when the process was killed
+        journal._journal.close()
+    with open(journal_file_path(output_dir, 0), 'a') as journal_file:
+        journal_file.write('30\t4,5')
+    # A second process which was killed before its first checkpoint
+    with open(temp_file_path(output_dir, 1), 'a') as output:
+        journal = CheckpointJournal(journal_file_path(output_dir, 1), output, 2)
+        output.write('header\ntrip 6\n')
+        journal.add('6')
+        journal._journal.close()
+
+    checkpointed = 'header\ntrip 1\ntrip 2\n'
+    assert load_checkpoints(output_dir) == {'1', '2'}
+    with open(temp_file_path(output_dir, 0)) as output:
+        assert output.read() == checkpointed
+    with open(journal_file_path(output_dir, 0)) as journal_file:
+        assert journal_file.read() == f'{len(checkpointed)}\t1,2\n'
+    assert os.path.getsize(temp_file_path(output_dir, 1)) == 0
+
+    # Resuming appends to the truncated files, and the journal stays readable
+    with open(temp_file_path(output_dir, 0), 'a') as output:
+        journal = CheckpointJournal(journal_file_path(output_dir, 0), output, 2)
+        output.write('trip 3\n')
+        journal.add('3')
+        journal.close()
+    assert load_checkpoints(output_dir) == {'1', '2', '3'}
+    with open(temp_file_path(output_dir, 0)) as output:
+        assert output.read() == checkpointed + 'trip 3\n'
+
+
+def test_merge_sorted_files(tmp_path, monkeypatch):
+    # Split each file into several runs
+    monkeypatch.setattr(run_otp_processing, 'SORT_RUN_SIZE', 2)
+    contents = {
+        'temp_0.csv': 'total_time,trip_id\n60,10\n61,2\n62,7\n63,2\n64,1\n',
+        # A process which never got a batch
+        'temp_1.csv': '',
+        # A process which got a batch but found no routes
+        'temp_2.csv': 'total_time,trip_id\n',
+        'temp_3.csv': 'total_time,trip_id\n65,9\n66,7\n67,11\n',
+    }
+    files = []
+    for (name, content) in contents.items():
+        files.append(str(tmp_path / name))
+        with open(files[-1], 'w') as f:
+            f.write(content)
+    output_file = str(tmp_path / 'results_full.csv')
+
+    merge_sorted_files(files, output_file, 'trip_id')
+    with open(output_file) as f:
+        lines = f.read().splitlines()
+    assert lines[0] == 'total_time,trip_id'
+    assert [int(line.split(',')[1]) for line in lines[1:]] == [1, 2, 2, 7, 7, 9, 10, 11]
+    assert sorted(lines[1:]) == sorted(line for content in contents.values() for line in content.splitlines()[1:])
+    # Only the output is left behind
+    assert sorted(os.listdir(tmp_path)) == sorted(list(contents) + ['results_full.csv'])
+
+    merge_sorted_files([files[1]], output_file, 'trip_id')
+    assert os.path.getsize(output_file) == 0
+
+
+OTP_REQUEST_PARAMETERS = {'date': '2020-07-28', 'time': '07:00'}
+OTP_ITINERARY = {
+    'duration': 1800, 'startTime': 1595916600000, 'endTime': 1595918400000, 'walkTime': 420,
+    'transitTime': 1200, 'waitingTime': 180, 'walkDistance': 510.5, 'transfers': 1,
+    'legs': [{'distance': 300.25}, {'distance': 4000.0}, {'distance': 210.25}]
+}
+
+
+def otp_xml_response(itinerary=None, error=None, fare_cents=None):
+    parameters = ''.join(f'<{key}>{value}</{key}>' for (key, value) in OTP_REQUEST_PARAMETERS.items())
+    error_xml = ''
+    if error is not None:
+        error_xml = f'<id>{error[0]}</id><msg>{error[1]}</msg><message>{error[1]}</message>'
+    plan = ''
+    if itinerary is not None:
+        fields = ''.join(f'<{key}>{value}</{key}>' for (key, value) in itinerary.items() if key != 'legs')
+        legs = ''.join(f'<legs><distance>{leg["distance"]}</distance></legs>' for leg in itinerary['legs'])
+        fare = ''
+        if fare_cents is not None:
+            fare = f'<fare><details><regular><price><cents>{fare_cents}</cents></price></regular></details></fare>'
+        plan = f'<itineraries><itineraries>{fields}<legs>{legs}</legs>{fare}</itineraries></itineraries>'
+    xml = (f'<response><requestParameters>{parameters}</requestParameters><plan>{plan}</plan>'
+           f'<error>{error_xml}</error></response>')
+    return CapturedResponse(xml.encode(), 'application/xml')
+
+
+def otp_json_response(itinerary=None, error=None, fare_cents=None):
+    response = {'requestParameters': OTP_REQUEST_PARAMETERS}
+    if error is not None:
+        response['error'] = {'id': error[0], 'msg': error[1], 'message': error[1]}
+    else:
+        response['plan'] = {'itineraries': [] if itinerary is None else [dict(itinerary)]}
+        if fare_cents is not None:
+            response['plan']['itineraries'][0]['fare'] = {
+                'details': {'regular': [{'fareId': 'tfwm:1', 'price': {'cents': fare_cents}}]}
+            }
+    return CapturedResponse(json.dumps(response).encode(), 'application/json')
+
+
+def test_parsers_agree():
+    cases = {
+        'itinerary': {'itinerary': OTP_ITINERARY},
+        'fare': {'itinerary': OTP_ITINERARY, 'fare_cents': 450},
+        'too close': {'error': (409, 'TOO_CLOSE')},
+        'no route': {'error': (404, 'PATH_NOT_FOUND')},
+        'no itinerary': {},
+    }
+    parsed = {}
+    for (case, fixture) in cases.items():
+        xml_trip = otp.parse_response(otp_xml_response(**fixture))
+        json_response = otp_json_response(**fixture)
+        assert otp.parse_json_response(json_response.content) == xml_trip, case
+        assert otp.parse_response(json_response) == xml_trip, case
+        parsed[case] = xml_trip
+
+    trip = parsed['itinerary']
+    assert trip['total_dist'] == 4510.5
+    assert trip['transit_dist'] == 4000.0
+    # Without fare details, the fare is calculated from the number of transfers
+    assert trip['fare'] == 4.80
+    assert parsed['fare']['fare'] == 4.50
+    assert parsed['too close']['total_time'] == 0.0
+    assert parsed['too close']['fare'] == 0.0
+    assert parsed['no route'] is False
+    assert parsed['no itinerary'] is False
+
+
+def trip_row(trip_id, oa_lat='52.454359', time='07:07:00'):
+    return {'trip_id': trip_id, 'oa_lat': oa_lat, 'oa_lon': '-1.811858',
+            'poi_lat': '52.438339', 'poi_lon': '-1.808047', 'date': '2020-07-28', 'time': time}
+
+
+def test_cache_key():
+    key = cache_key(trip_row('1'))
+    assert cache_key(trip_row('2')) == key
+    # Coordinates agree to 6 decimal places
+    assert cache_key(trip_row('1', oa_lat='52.45435900000004')) == key
+    assert cache_key(trip_row('1', oa_lat='52.4543590421403')) == key
+    assert cache_key(trip_row('1', oa_lat='52.454360')) != key
+    # Departures are to the minute
+    assert cache_key(trip_row('1', time='7:07')) == key
+    assert cache_key(trip_row('1', time='07:07')) == key
+    assert cache_key(trip_row('1', time='07:07:59')) == key
+    assert cache_key(trip_row('1', time='07:08:00')) != key
+
+
+def test_otp_response_cache(tmp_path):
+    path = str(tmp_path / 'otp_cache.db')
+    with OTPResponseCache(path, 'graph-1') as cache:
+        trip = {attribute: 0.0 for attribute in otp.TRIP_ATTRIBUTES}
+        trip.update(total_time=60.0, trip_id='1')
+        cache.add(trip_row('1'), trip)
+        cache.add(trip_row('2', oa_lat='52.5'), False)
+        assert cache.get_many([trip_row('1')]) == {}
+    with OTPResponseCache(path, 'graph-1') as cache:
+        assert len(cache) == 2
+        # Trips with the same request parameters share a cached trip
+        rows = [trip_row('1'), trip_row('3', time='7:07'), trip_row('4', oa_lat='52.5'), trip_row('5', oa_lat='53')]
+        cached = cache.get_many(rows)
+        assert set(cached) == {'1', '3', '4'}
+        assert cached['1']['trip_id'] == '1'
+        assert cached['3']['trip_id'] == '3'
+        assert cached['3']['total_time'] == 60
+        assert cached['4'] is False
+        assert cache.hits == 3
+    with OTPResponseCache(path, 'graph-2') as cache:
+        # Trips routed on another graph are discarded
+        assert len(cache) == 0
+        assert cache.get_many([trip_row('1')]) == {}
+
+
+def test_date_range():
+    (start, end) = (datetime.date(2020, 5, 1), datetime.date(2020, 5, 31))
+    # Early May and Spring bank holidays
+    holidays_2020 = uk_holidays(2020, 2020)
+    assert np.datetime64('2020-05-08') in holidays_2020 and np.datetime64('2020-05-25') in holidays_2020
+    assert (np.diff(holidays_2020) > np.timedelta64(0, 'D')).all()
+    (days, weekdays, is_holiday) = day_calendar(start, end)
+    assert len(days) == 31
+    assert weekdays[0] == start.weekday()
+    assert list(days[is_holiday]) == [np.datetime64('2020-05-08'), np.datetime64('2020-05-25')]
+
+    assert len(date_range(start, end, exclude_holidays=False)) == 31
+    assert len(date_range(start, end)) == 29
+    assert date_range(start, end, ['Tuesday', 'Friday']).astype(str).tolist() == [
+        '2020-05-01', '2020-05-05', '2020-05-12', '2020-05-15', '2020-05-19', '2020-05-22', '2020-05-26', '2020-05-29'
+    ]
+    assert np.datetime64('2020-05-08') in date_range(start, end, ['Friday'], exclude_holidays=False)
+    assert len(date_range(start, end, ['Someday'])) == 0
+    assert len(date_range(end, start)) == 0
+
+
+def test_sample_timestamps():
+    time_defs = {
+        'term': {'start_date': '2020-05-01', 'end_date': '2020-05-31'},
+        'time_of_day': {'peak': ['8:00-8:29'], 'evening': ['18:00-18:59', '20:00-20:59']},
+        'day_of_week': {'weekday': ['Tuesday', 'Friday'], 'sunday': ['Sunday']}
+    }
+    time_strata = {
+        'Weekday (AM peak)': {'time_of_day': 'peak', 'day_of_week': 'weekday', 'n_sample': 30},
+        'Sunday (Evening)': {'time_of_day': 'evening', 'day_of_week': 'sunday'}
+    }
+    timestamps = sample_timestamps(time_defs, time_strata, 20, rseed=1)
+    assert timestamps == sample_timestamps(time_defs, time_strata, 20, rseed=1)
+    assert timestamps != sample_timestamps(time_defs, time_strata, 20, rseed=2)
+
+    peak = [timestamp for timestamp in timestamps if timestamp['stratum'] == 'Weekday (AM peak)']
+    evening = [timestamp for timestamp in timestamps if timestamp['stratum'] == 'Sunday (Evening)']
+    assert (len(peak), len(evening)) == (30, 20)
+    # Time points are sampled without replacement
+    assert len({(timestamp['date'], timestamp['time']) for timestamp in timestamps}) == 50
+    weekdays = set(date_range(datetime.date(2020, 5, 1), datetime.date(2020, 5, 31), ['Tuesday', 'Friday']).astype(str))
+    assert all(timestamp['date'] in weekdays and '08:00' <= timestamp['time'] <= '08:29' for timestamp in peak)
+    for timestamp in evening:
+        assert datetime.date.fromisoformat(timestamp['date']).weekday() == 6
+        assert timestamp['time'][:2] in ('18', '20')
+
+    # 8 days of 30 minutes in the stratum
+    time_strata['Weekday (AM peak)']['n_sample'] = 241
+    with pytest.raises(ValueError):
+        sample_timestamps(time_defs, time_strata, 20)
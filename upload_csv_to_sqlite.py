@@ -1,13 +1,36 @@
 import argparse
+import csv
+import itertools
 import os
+import sqlite3
+from contextlib import contextmanager
 
-import pandas as pd
 import sqlalchemy as db
 
 from settings import get_sqlite_settings, load_dotenv
 
 DEFAULT_CHUNK_SIZE = 10000                  # How many rows to load per df chunk
 SUMMARY_TABLE_NAME = 'otp_results_summary'  # Name of table where OTP results are summarised
+RESULTS_TABLE_NAME = 'otp_results'          # Name of table where OTP results are stored
+UNROUTED_TABLE_NAME = 'otp_unrouted'        # Name of table of trips OTP found no route for
+# PRAGMAs set while bulk loading. Trading durability for speed is safe here: if the load
+# is interrupted the CSV file can simply be loaded again.
+DEFAULT_LOAD_PRAGMAS = {
+    'synchronous': 'OFF',
+    'journal_mode': 'MEMORY',
+    'cache_size': '-262144',    # 256MB
+    'temp_store': 'MEMORY'
+}
+# Indexes covering the API's filters, so its queries read the index rather than the table.
+# copy_text_to_sqlite drops and rebuilds them around each load like any other index.
+API_INDEXES = {
+    'otp_results_summary_poi_type_stratum_oa_id': (SUMMARY_TABLE_NAME, 'poi_type, stratum, oa_id'),
+    'populations_population_oa_id': ('populations', 'population, oa_id, count'),
+    # Joining populations to per-OA metrics otherwise scans the table for every OA
+    'populations_oa_id': ('populations', 'oa_id, population, count')
+}
+# Unique key of the summary table, which SQLiteResultsWriter adds the totals of each batch to
+SUMMARY_KEY_INDEX = 'otp_results_summary_key'
 
 
 def parse_input_args() -> dict:
@@ -17,6 +40,11 @@ def parse_input_args() -> dict:
     parser.add_argument('table', type=str, help='Destination table')
     parser.add_argument('-c', '--chunksize', metavar='chunksize', type=int, default=DEFAULT_CHUNK_SIZE, required=False, 
                         help=f'Number of rows to read per chunk of CSV file to conserve memory. Default: {DEFAULT_CHUNK_SIZE}')
+    parser.add_argument('-p', '--pragma', metavar='NAME=VALUE', action='append', default=[], required=False,
+                        help=('PRAGMA to set during the load, overriding the defaults. May be given more than once. Default: '
+                              + ' '.join(f'{name}={value}' for name, value in DEFAULT_LOAD_PRAGMAS.items())))
+    parser.add_argument('-r', '--replace', action='store_true', required=False,
+                        help='Delete the existing rows of the table before loading')
     args = parser.parse_args()
     return vars(args)
 
@@ -39,17 +67,166 @@ def check_table_exists(engine: db.engine.Engine, table: str) -> None:
         exit(1)
 
 
-def copy_text_to_sqlite(input_file: str, table_name: str, engine: db.engine.Engine, chunksize: int = DEFAULT_CHUNK_SIZE) -> None:
-    # Read in the input csv chunks at a time to avoid loading large files into memory
-    for chunk in pd.read_csv(input_file, chunksize=chunksize):
-        chunk.to_sql(table_name, engine, if_exists='replace', index=False)
+def column_converter(declared_type: str):
+    '''
+    Get the function converting a CSV field to the Python type of a column, following
+    SQLite's rules for deriving a column's type affinity from its declared type.
+    Empty fields become NULL.
+    '''
+    declared_type = declared_type.upper()
+    if 'INT' in declared_type:
+        def convert(value):
+            if value == '':
+                return None
+            try:
+                return int(value)
+            except ValueError:
+                # e.g. integers written as 1.0 by pandas
+                return float(value)
+    elif any(name in declared_type for name in ('CHAR', 'CLOB', 'TEXT')):
+        def convert(value):
+            return value if value != '' else None
+    elif any(name in declared_type for name in ('REAL', 'FLOA', 'DOUB')):
+        def convert(value):
+            return float(value) if value != '' else None
+    else:
+        # BLOB affinity (no declared type, as the totals of otp_results_summary) stores values
+        # as they are given, and NUMERIC affinity only converts text when it can be stored exactly,
+        # so anything which looks like a number is converted here
+        def convert(value):
+            if value == '':
+                return None
+            try:
+                return int(value)
+            except ValueError:
+                pass
+            try:
+                return float(value)
+            except ValueError:
+                return value
+    return convert
 
 
-def create_otp_results_summary(engine: db.engine.Engine, table: str) -> int:
-    with engine.connect() as conn:
-        conn.execute(f"DELETE FROM {SUMMARY_TABLE_NAME}")
-        otp_results_summary = """
-        INSERT INTO {summary}
+def parse_pragmas(pragmas: list) -> dict:
+    '''Parse NAME=VALUE pairs given on the command line, overriding the defaults'''
+    parsed = dict(DEFAULT_LOAD_PRAGMAS)
+    for pragma in pragmas or []:
+        name, sep, value = pragma.partition('=')
+        if not sep or not name.strip().isidentifier():
+            raise ValueError(f'Invalid PRAGMA "{pragma}", expected NAME=VALUE')
+        parsed[name.strip()] = value.strip()
+    return parsed
+
+
+def bump_data_version(conn) -> None:
+    '''
+    Increment the data version stamp of the database (its user_version), telling the API
+    to drop the responses it has cached. Call within the transaction changing the data.
+    '''
+    (version,) = conn.execute("PRAGMA user_version").fetchone()
+    conn.execute(f"PRAGMA user_version = {version + 1}")
+
+
+def create_api_indexes(conn) -> None:
+    '''
+    Create the indexes used by the API if they do not exist, and refresh the statistics
+    the query planner chooses between indexes with
+    '''
+    for (name, (table, columns)) in API_INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})")
+        conn.execute(f"ANALYZE {table}")
+
+
+def copy_text_to_sqlite(input_file: str, table_name: str, path: str, chunksize: int = DEFAULT_CHUNK_SIZE,
+                        pragmas: dict = None, replace: bool = False) -> int:
+    """
+    Bulk load a CSV file into an existing table. Rows are appended in a single transaction,
+    `chunksize` rows per executemany, with each field converted to the type of its column.
+    The table's indexes are dropped for the load and rebuilt once all rows are in, which
+    is much faster than updating them row by row.
+
+    Parameters:
+    input_file (str): Path to the CSV file. The first row must hold column names of the table
+    table_name (str): Destination table
+    path (str): Path to the SQLite database
+    chunksize (int): Number of rows read and inserted at a time
+    pragmas (dict): PRAGMAs set for the load. Default: DEFAULT_LOAD_PRAGMAS
+    replace (bool): Delete the existing rows of the table first
+
+    Returns:
+    int: Number of rows loaded
+    """
+    pragmas = DEFAULT_LOAD_PRAGMAS if pragmas is None else pragmas
+    conn = sqlite3.connect(path, isolation_level=None)
+    try:
+        # PRAGMAs like journal_mode cannot be changed inside a transaction
+        for name, value in pragmas.items():
+            conn.execute(f"PRAGMA {name}={value}")
+        table_info = {column: declared_type for (_, column, declared_type, *_) in conn.execute(f"PRAGMA table_info({table_name})")}
+        indexes = conn.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+            (table_name,)
+        ).fetchall()
+        with open(input_file, newline='') as src:
+            reader = csv.reader(src)
+            headers = next(reader)
+            unknown = [column for column in headers if column not in table_info]
+            if unknown:
+                raise ValueError(f'Columns {unknown} of {input_file} are not in table {table_name}')
+            converters = [column_converter(table_info[column]) for column in headers]
+            insert = "INSERT INTO {table} ({columns}) VALUES ({placeholders})".format(
+                table=table_name,
+                columns=', '.join(headers),
+                placeholders=', '.join('?' for _ in headers)
+            )
+            rows_loaded = 0
+            conn.execute("BEGIN")
+            try:
+                if replace:
+                    conn.execute(f"DELETE FROM {table_name}")
+                for (name, _) in indexes:
+                    conn.execute(f"DROP INDEX {name}")
+                # Read in the input csv chunks at a time to avoid loading large files into memory
+                for chunk in iter(lambda: list(itertools.islice(reader, chunksize)), []):
+                    conn.executemany(insert, [
+                        [convert(value) for (convert, value) in zip(converters, row)] for row in chunk
+                    ])
+                    rows_loaded += len(chunk)
+                for (_, sql) in indexes:
+                    conn.execute(sql)
+                bump_data_version(conn)
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+    finally:
+        conn.close()
+    return rows_loaded
+
+
+def summary_query(results: str, keyed: bool = False) -> str:
+    """
+    SELECT statement aggregating OTP results into rows of the summary table,
+    one per combination of OA, POI type and time stratum.
+
+    Parameters:
+    results (str): Name of the table holding the OTP results to summarise
+    keyed (bool): The results table already has the oa_id, poi_type and stratum of each trip.
+        Otherwise they are joined from otp_trips, poi and trip_strata
+    """
+    if keyed:
+        keys = ""
+        joins = ""
+    else:
+        keys = """,
+                        b.oa_id, 
+                        c.type AS poi_type, 
+                        d.stratum"""
+        joins = """
+                        LEFT JOIN otp_trips AS b ON a.trip_id = b.trip_id 
+                        LEFT JOIN poi AS c ON b.poi_id = c.poi_id
+                        LEFT JOIN trip_strata AS d ON a.trip_id = d.trip_id"""
+    return """
             SELECT
                 oa_id,
                 poi_type,
@@ -62,26 +239,175 @@ def create_otp_results_summary(engine: db.engine.Engine, table: str) -> int:
             FROM 
                 (
                     SELECT 
-                        a.*, 
-                        b.oa_id, 
-                        c.type AS poi_type, 
-                        d.stratum,
+                        a.*{keys},
                         (1.5*(total_time + initial_wait_corrected)
                             - (0.5 * transit_time) 
                             + ((fare * 3600) / 6.7) 
                             + (10 * num_transfers)) / 60 AS generalised_cost
                     FROM 
-                        (SELECT *, initial_wait_time - 3600 AS initial_wait_corrected from {results}) AS a 
-                        LEFT JOIN otp_trips AS b ON a.trip_id = b.trip_id 
-                        LEFT JOIN poi AS c ON b.poi_id = c.poi_id
-                        LEFT JOIN trip_strata AS d ON a.trip_id = d.trip_id
+                        (SELECT *, initial_wait_time - 3600 AS initial_wait_corrected from {results}) AS a {joins}
                 ) AS results_full
-            GROUP BY 1,2,3;
-        """.format(summary=SUMMARY_TABLE_NAME, results=table)
+            GROUP BY 1,2,3
+    """.format(results=results, keys=keys, joins=joins)
+
+
+def create_otp_results_summary(engine: db.engine.Engine, table: str) -> int:
+    with engine.connect() as conn:
+        conn.execute(f"DELETE FROM {SUMMARY_TABLE_NAME}")
+        otp_results_summary = "INSERT INTO {summary} {select};".format(
+            summary=SUMMARY_TABLE_NAME,
+            select=summary_query(table)
+        )
         result = conn.execute(otp_results_summary)
+        create_api_indexes(conn)
+        bump_data_version(conn)
     return result.rowcount
 
 
+class SQLiteResultsWriter:
+    """
+    Writes parsed OTP trips straight into the otp_results table, keeping otp_results_summary
+    up to date as it goes, so results never pass through an intermediate CSV file.
+    Trips are buffered and written `batch_size` at a time, each batch in a single transaction
+    which also adds the batch's totals to the summary. The database is put in WAL mode so
+    that the API can keep reading while a run is writing. The data version is only bumped
+    when the writer is closed, so the API keeps its caches until the run has finished.
+    The summary keys of each trip are looked up in `trip_factors` when the trips are generated
+    from their factors. Otherwise otp_trips, poi and trip_strata must already be loaded, as the
+    keys are joined from them.
+    Trips which are already in otp_results are skipped, so they are never counted twice.
+    The IDs of trips OTP found no route for are kept in otp_unrouted, so a resumed run does
+    not route them again.
+
+    Parameters:
+    path (str): Path to the SQLite database
+    batch_size (int): Number of trips written per transaction
+    trip_factors (modelling.trip_factors.TripFactors): Factors the trips were generated from, if any
+    """
+
+    SUMMARY_KEYS = ('oa_id', 'poi_type', 'stratum')
+    SUMMARY_TOTALS = ('num_trips', 'sum_journey_time', 'sum_walking_distance', 'sum_fare', 'sum_generalised_cost')
+
+    def __init__(self, path: str, batch_size: int = DEFAULT_CHUNK_SIZE, trip_factors=None):
+        self.batch_size = batch_size
+        self.trip_factors = trip_factors
+        self.rows_written = 0
+        self.unrouted_written = 0
+        self._conn = sqlite3.connect(path, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._columns = [column for (_, column, *_) in self._conn.execute(f"PRAGMA table_info({RESULTS_TABLE_NAME})")]
+        create_api_indexes(self._conn)
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {UNROUTED_TABLE_NAME}(trip_id bigint(20) PRIMARY KEY)")
+        self._conn.execute(
+            f"CREATE UNIQUE INDEX IF NOT EXISTS {SUMMARY_KEY_INDEX} ON {SUMMARY_TABLE_NAME}({', '.join(self.SUMMARY_KEYS)})"
+        )
+        # With trip factors, each trip is buffered with its summary keys
+        keys = ''.join(f", NULL AS {key}" for key in self.SUMMARY_KEYS) if trip_factors is not None else ''
+        self._conn.execute(f"CREATE TEMP TABLE batch_results AS SELECT *{keys} FROM {RESULTS_TABLE_NAME} WHERE 0")
+        self._buffer = []
+        self._unrouted = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def completed_trip_ids(self) -> set:
+        '''IDs of the trips already in otp_results or otp_unrouted, as strings to match rows read from CSV'''
+        return {str(trip_id) for (trip_id,) in self._conn.execute(
+            f"SELECT trip_id FROM {RESULTS_TABLE_NAME} UNION ALL SELECT trip_id FROM {UNROUTED_TABLE_NAME}"
+        )}
+
+    def has_results(self) -> bool:
+        '''Whether otp_results or otp_unrouted holds any trips'''
+        return self._conn.execute(
+            f"SELECT EXISTS (SELECT 1 FROM {RESULTS_TABLE_NAME}) OR EXISTS (SELECT 1 FROM {UNROUTED_TABLE_NAME})"
+        ).fetchone()[0] == 1
+
+    def clear(self) -> None:
+        '''Delete all existing results and their summary'''
+        with self._transaction():
+            self._conn.execute(f"DELETE FROM {RESULTS_TABLE_NAME}")
+            self._conn.execute(f"DELETE FROM {UNROUTED_TABLE_NAME}")
+            self._conn.execute(f"DELETE FROM {SUMMARY_TABLE_NAME}")
+            bump_data_version(self._conn)
+
+    def write(self, trips: list, unrouted: list = ()) -> None:
+        '''Write parsed trips, and the IDs of trips OTP found no route for'''
+        self._buffer.extend(trips)
+        self._unrouted.extend(unrouted)
+        if len(self._buffer) + len(self._unrouted) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self._buffer and not self._unrouted:
+            return
+        with self._transaction():
+            if self._buffer:
+                self._write_results()
+            if self._unrouted:
+                self.unrouted_written += self._conn.executemany(
+                    f"INSERT OR IGNORE INTO {UNROUTED_TABLE_NAME} (trip_id) VALUES (?)",
+                    [(int(trip_id),) for trip_id in self._unrouted]
+                ).rowcount
+        self._buffer = []
+        self._unrouted = []
+
+    def _write_results(self) -> None:
+        '''Insert the buffered trips into otp_results, adding them to otp_results_summary'''
+        columns = ', '.join(self._columns)
+        rows = [tuple(trip.get(column) for column in self._columns) for trip in self._buffer]
+        batch_columns = columns
+        if self.trip_factors is not None:
+            batch_columns += ', ' + ', '.join(self.SUMMARY_KEYS)
+            rows = [row + self.trip_factors.summary_keys(int(trip['trip_id'])) for row, trip in zip(rows, self._buffer)]
+        placeholders = ', '.join('?' for _ in rows[0])
+        self._conn.execute("DELETE FROM batch_results")
+        self._conn.executemany(f"INSERT INTO batch_results ({batch_columns}) VALUES ({placeholders})", rows)
+        self._conn.execute(f"DELETE FROM batch_results WHERE trip_id IN (SELECT trip_id FROM {RESULTS_TABLE_NAME})")
+        self._conn.execute(f"INSERT INTO {RESULTS_TABLE_NAME} ({columns}) SELECT {columns} FROM batch_results")
+        self.rows_written += self._conn.execute("SELECT count(*) FROM batch_results").fetchone()[0]
+        self._update_summary()
+
+    def _update_summary(self) -> None:
+        '''Add the totals of the current batch to otp_results_summary'''
+        self._conn.execute(f"CREATE TEMP TABLE batch_summary AS {summary_query('batch_results', keyed=self.trip_factors is not None)}")
+        # Each row of the batch is looked up through the unique key of the summary table.
+        # Rows with a NULL key (trips missing from otp_trips or trip_strata) never conflict,
+        # so they are inserted as rows of their own, which the API never selects.
+        columns = ', '.join(self.SUMMARY_KEYS + self.SUMMARY_TOTALS)
+        increments = ', '.join(f"{total} = {total} + excluded.{total}" for total in self.SUMMARY_TOTALS)
+        # WHERE true resolves the ambiguity between the ON of a join and the ON CONFLICT clause
+        self._conn.execute(f"""
+            INSERT INTO {SUMMARY_TABLE_NAME} ({columns})
+            SELECT {columns} FROM batch_summary WHERE true
+            ON CONFLICT({', '.join(self.SUMMARY_KEYS)}) DO UPDATE SET {increments}
+        """)
+        self._conn.execute("DROP TABLE batch_summary")
+
+    @contextmanager
+    def _transaction(self):
+        self._conn.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+        self._conn.execute("COMMIT")
+
+    def close(self) -> None:
+        '''Write the remaining trips, then tell the API the results have changed'''
+        try:
+            self.flush()
+            if self.rows_written or self.unrouted_written:
+                with self._transaction():
+                    bump_data_version(self._conn)
+        finally:
+            self._conn.close()
+
+
 if __name__ == '__main__':
     args = parse_input_args()
     input_file = args['file']
@@ -89,10 +415,11 @@ if __name__ == '__main__':
     check_input_file_exists(input_file)
     engine = create_db_connection()
     check_table_exists(engine, table_name)
-    copy_text_to_sqlite(input_file, table_name, engine, chunksize=args['chunksize'])
+    rows_loaded = copy_text_to_sqlite(input_file, table_name, get_sqlite_settings(), chunksize=args['chunksize'],
+                                      pragmas=parse_pragmas(args['pragma']), replace=args['replace'])
     rows_created = create_otp_results_summary(engine, table_name)
     print((
         f'Done!.\n'
-        f'File "{input_file}" uploaded to "{table_name}".\n'
+        f'{rows_loaded} rows of "{input_file}" uploaded to "{table_name}".\n'
         f'{rows_created} rows inserted into {SUMMARY_TABLE_NAME}.'
     ))
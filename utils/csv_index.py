@@ -0,0 +1,135 @@
+'''
+Byte-offset indexes for large CSV files. An index holds the position of the start
+of every row, so a range of rows can be read by seeking straight to it rather than
+parsing every row before it. The index assumes one row per line, i.e. no quoted
+fields containing newlines, which holds for the tables exported by the ETL.
+
+The index is stored next to the CSV file as a flat array of little-endian int64
+offsets: one per data row followed by the size of the file, so that the last
+offset doubles as a check that the index still matches the file. An index is also
+out of date if the CSV file was modified after it, which catches changes that
+leave the size of the file as it was.
+'''
+import os
+
+import numpy as np
+
+INDEX_SUFFIX = '.idx'
+READ_CHUNK_SIZE = 16 * 1024 * 1024
+OFFSET_DTYPE = np.dtype('<i8')
+
+
+def index_path(csv_file: str) -> str:
+    return csv_file + INDEX_SUFFIX
+
+
+class CsvIndexWriter:
+    """
+    File-like wrapper which builds the index of a CSV file while it is being written,
+    avoiding a second pass over the file. Usable anywhere a writable binary file is
+    expected, e.g. as the destination of psycopg2's copy_expert.
+
+    Parameters
+    ----------
+    csv_file : file object
+        The CSV file being written, opened in binary mode. If None, data is only indexed
+    index_file : file object
+        The file the offsets are written to, opened in binary mode
+    """
+
+    def __init__(self, csv_file, index_file):
+        self._csv_file = csv_file
+        self._index_file = index_file
+        self._position = 0
+        self._last_byte = b''
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        if self._csv_file is not None:
+            self._csv_file.write(data)
+        # Every newline marks the start of the next row. The newline ending the
+        # header gives the start of the first data row, and the final newline the
+        # end of the file.
+        newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord('\n'))
+        (newlines + self._position + 1).astype(OFFSET_DTYPE).tofile(self._index_file)
+        self._position += len(data)
+        if data:
+            self._last_byte = data[-1:]
+        return len(data)
+
+    def close(self) -> None:
+        # A final row without a trailing newline still needs its end offset
+        if self._position and self._last_byte != b'\n':
+            np.array([self._position], dtype=OFFSET_DTYPE).tofile(self._index_file)
+        # The index is only trusted if it is at least as new as the CSV file
+        if self._csv_file is not None:
+            self._csv_file.flush()
+        self._index_file.flush()
+        os.utime(self._index_file.name)
+
+
+def build_csv_index(csv_file: str) -> int:
+    """
+    Build the index of an existing CSV file in a single pass
+
+    Parameters
+    ----------
+    csv_file : str
+        Path of the CSV file. The first row is treated as a header
+
+    Returns
+    -------
+    int
+        Number of data rows in the file
+    """
+    with open(csv_file, 'rb') as src, open(index_path(csv_file), 'wb') as index_file:
+        writer = CsvIndexWriter(None, index_file)
+        for chunk in iter(lambda: src.read(READ_CHUNK_SIZE), b''):
+            writer.write(chunk)
+        writer.close()
+    return CsvIndex(csv_file).num_rows
+
+
+class CsvIndex:
+    """
+    Read-only view of the index of a CSV file. The offsets are memory-mapped, so opening
+    an index is cheap even for files with tens of millions of rows.
+
+    Raises
+    ------
+    FileNotFoundError
+        If the CSV file has no index
+    ValueError
+        If the index does not match the current contents of the CSV file
+    """
+
+    def __init__(self, csv_file: str):
+        self.csv_file = csv_file
+        path = index_path(csv_file)
+        if os.path.getsize(path) == 0:
+            self._offsets = np.zeros(0, dtype=OFFSET_DTYPE)
+        else:
+            self._offsets = np.memmap(path, dtype=OFFSET_DTYPE, mode='r')
+        # The last offset is the end of the file
+        csv_stat = os.stat(csv_file)
+        if ((int(self._offsets[-1]) if len(self._offsets) else 0) != csv_stat.st_size
+                or csv_stat.st_mtime_ns > os.stat(path).st_mtime_ns):
+            raise ValueError(f'Index {path} is out of date with {csv_file}')
+
+    @property
+    def num_rows(self) -> int:
+        return max(len(self._offsets) - 1, 0)
+
+    def byte_range(self, offset: int, limit: int) -> tuple:
+        '''Get the start and end byte positions of the rows in the range [offset, limit)'''
+        return int(self._offsets[offset]), int(self._offsets[limit])
+
+
+def open_csv_index(csv_file: str) -> CsvIndex:
+    '''Open the index of a CSV file, (re)building it first if it is missing or out of date'''
+    try:
+        return CsvIndex(csv_file)
+    except (FileNotFoundError, ValueError):
+        build_csv_index(csv_file)
+        return CsvIndex(csv_file)
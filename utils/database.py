@@ -2,6 +2,7 @@
 Wrapper for a singleton SQLAlchemy engine 
 instance which adds extra ETL functionality.
 '''
+import io
 import logging
 import os
 import settings
@@ -9,6 +10,7 @@ import subprocess
 import pandas as pd
 import sqlalchemy as db
 from pathlib import Path
+from utils.csv_index import CsvIndexWriter, index_path
 
 class Database:
 
@@ -69,13 +71,65 @@ class Database:
         finally:
             conn.close()
 
-    def copy_table_to_csv(self, src_table: str, dst_file: str):
+    def copy_df_to_db(self, df: pd.DataFrame, dst_table: str) -> None:
+        """
+        Bulk copy a dataframe to a table that has already been created, streaming it through COPY
+        as CSV rather than inserting row by row
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            Rows to copy, with the columns of the table
+        dst_table : str
+            Full name of the database table, in the form of "schema.table"
+
+        Returns
+        -------
+        None
+        """
+        buffer = io.StringIO()
+        df.to_csv(buffer, index=False, header=False)
+        buffer.seek(0)
+        columns = ', '.join(df.columns)
+        conn = self.engine.raw_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.copy_expert(f"COPY {dst_table} ({columns}) FROM STDIN with CSV", buffer)
+            conn.commit()
+            logging.getLogger('root').debug(f"{len(df)} rows copied to {dst_table}")
+        finally:
+            conn.close()
+
+    def copy_table_to_csv(self, src_table: str, dst_file: str, index=True):
+        """
+        Export a table to a csv file with a header row
+
+        Parameters
+        ----------
+        src_table : str
+            Full name of the database table to export, in the form of "schema.table"
+        dst_file : str
+            Path of the csv file to write
+        index : boolean
+            Whether to also write a byte-offset index of the rows (see utils.csv_index) while exporting,
+            so readers can seek straight to any row of the file
+
+        Returns
+        -------
+        None
+        """
         conn = self.engine.raw_connection()
         try:
             cursor = conn.cursor()
             copy_statement = f"COPY (SELECT * FROM {src_table}) TO STDOUT WITH CSV HEADER"
-            with open(dst_file, 'w') as csv_file:
-                cursor.copy_expert(copy_statement, csv_file)
+            with open(dst_file, 'wb') as csv_file:
+                if index:
+                    with open(index_path(dst_file), 'wb') as index_file:
+                        writer = CsvIndexWriter(csv_file, index_file)
+                        cursor.copy_expert(copy_statement, writer)
+                        writer.close()
+                else:
+                    cursor.copy_expert(copy_statement, csv_file)
             cursor.close()
         finally:
             conn.close()
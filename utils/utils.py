@@ -1,8 +1,10 @@
 import yaml
 import calendar
 import holidays
-from datetime import datetime, timedelta, date
-from itertools import product
+import numpy as np
+from functools import lru_cache
+
+DAY_NAMES = list(calendar.day_name)
 
 def load_yaml(filename: str) -> dict:
     """
@@ -57,77 +59,83 @@ def load_data_dict(data_config):
     return text_dict, gis_dict, osm_file
 
 
-def date_range(start_date, end_date, weekdays=None, exclude_holidays=True):
+@lru_cache(maxsize=None)
+def uk_holidays(start_year, end_year):
     """
-    Generate a list of all dates within the given period
+    UK public holidays of the given years, computed once per range of years
 
     Parameters
     ----------
-    start_date : datetime.date object
-        Starting date of the period
-    end_date : datetime.date object
-        Ending date of the period
-    weekdays : list
-        If specified, constrain to these days of the week only, e.g., ['Tuesday', 'Friday']
-        
+    start_year : int
+    end_year : int
+        Last year, inclusive
+
     Returns
     -------
-    rng : list
-        List of dates in the format of datetime.date
+    days : numpy.ndarray
+        Sorted dates of the holidays as datetime64[D]
     """
-    rng = []
-    d = start_date
-    while d <= end_date:
-        if weekdays is None or list(calendar.day_name)[d.weekday()] in weekdays:
-            if not exclude_holidays or d not in holidays.UK():
-                rng.append(d)
-        d += timedelta(days=1)
-    return rng
+    return np.array(sorted(holidays.UK(years=range(start_year, end_year + 1))), dtype='datetime64[D]')
 
 
-def time_range(start_time, end_time, unit='m'):
+@lru_cache(maxsize=32)
+def day_calendar(start_date, end_date):
     """
-    Generate a list of all timepoints within the given period
+    Every date within the given period, with the day of the week of each and whether it is a
+    UK public holiday, computed once per period
 
     Parameters
     ----------
-    start_time : datetime.time object
-        Starting time of the period
-    end_time : datetime.time object
+    start_date : datetime.date object
+        Starting date of the period
+    end_date : datetime.date object
         Ending date of the period
-    unit : string
-        Unit of timepoint, supporting hour('h'), minute('m') and second('s')
 
     Returns
     -------
-    rng : list
-        List of timepoints in the format of datetime.time object
+    days : numpy.ndarray
+        Dates as datetime64[D]
+    weekdays : numpy.ndarray
+        Day of the week of each date, Monday being 0 as for datetime.date.weekday
+    is_holiday : numpy.ndarray
+        Boolean mask of the dates which are UK public holidays
     """
-    unit_dict = {'h': timedelta(hours=1), 'm': timedelta(minutes=1), 's': timedelta(seconds=1)}
-    delta = unit_dict[unit]
-
-    rng = []
-    t = datetime.combine(date.today(), start_time)
-    while t <= datetime.combine(date.today(), end_time):
-        rng.append(t.time())
-        t += delta
-    return rng
+    days = np.arange(np.datetime64(start_date, 'D'), np.datetime64(end_date, 'D') + 1)
+    # Day 0 of datetime64, 1970-01-01, was a Thursday
+    weekdays = (days.astype(np.int64) + 3) % 7
+    is_holiday = np.isin(days, uk_holidays(start_date.year, end_date.year))
+    for array in (days, weekdays, is_holiday):
+        # The arrays are shared between callers
+        array.setflags(write=False)
+    return days, weekdays, is_holiday
 
 
-def datetime_range(date_range, time_range):
+def date_range(start_date, end_date, weekdays=None, exclude_holidays=True):
     """
-    Generate a list of all combinations of given dates and timepoints
+    Generate all dates within the given period
 
     Parameters
     ----------
-    date_range : list of datetime.date object
-    time_range : list of datetime.time object
-
+    start_date : datetime.date object
+        Starting date of the period
+    end_date : datetime.date object
+        Ending date of the period
+    weekdays : list
+        If specified, constrain to these days of the week only, e.g., ['Tuesday', 'Friday']
+    exclude_holidays : bool
+        Leave out UK public holidays
+        
     Returns
     -------
-    rng : list of datetime.datetime object
+    rng : numpy.ndarray
+        Dates as datetime64[D], in order
     """
-    rng = []
-    for (date, time) in product(date_range, time_range):
-        rng.append(datetime.combine(date, time))
-    return rng
+    if start_date > end_date:
+        return np.array([], dtype='datetime64[D]')
+    (days, day_of_week, is_holiday) = day_calendar(start_date, end_date)
+    keep = np.ones(len(days), dtype=bool)
+    if weekdays is not None:
+        keep &= np.isin(day_of_week, [DAY_NAMES.index(day) for day in weekdays if day in DAY_NAMES])
+    if exclude_holidays:
+        keep &= ~is_holiday
+    return days[keep]